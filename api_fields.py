@@ -0,0 +1,98 @@
+"""
+Field projection of API calls, e.g. "__default__,episode[__default__,program[__default__,teachers]]".
+
+Smaller projections of cookpad_constants.fields make responses (and JSON parsing) much smaller,
+when only a part of the entity is needed:
+  'full'          everything the app requests
+  'streams-only'  just enough to create a project (title, start offset, archive streams)
+  'catalog-row'   one line of an episode list (title, dates, teachers, expiry)
+"""
+import typing
+
+import cookpad_constants
+
+FieldTree = typing.Dict[str, 'FieldTree']  # name -> sub fields ({} for leaf)
+
+PROFILES: typing.Dict[str, typing.Dict[str, typing.Optional[typing.List[str]]]] = {
+    # profile -> entity -> dotted paths to keep (None = all)
+    'full': {
+        'EpisodeDetailEntity': None,
+    },
+    'streams-only': {
+        'EpisodeDetailEntity': [
+            '__default__',
+            'episode.__default__',
+            'episode.program.__default__',
+            'episode.archive_start_offset',
+            'episode.archive_streamings',
+        ],
+    },
+    'catalog-row': {
+        'EpisodeDetailEntity': [
+            '__default__',
+            'episode.__default__',
+            'episode.started_at',
+            'episode.ended_at',
+            'episode.archive_expired_at',
+            'episode.teachers',
+            'episode.program.__default__',
+        ],
+    },
+}
+
+
+def parse_fields(s) -> FieldTree:
+    tree = {}
+    stack = [tree]
+    name = ''
+    for c in s + ',':
+        if c in ',[]':
+            if name:
+                stack[-1][name] = {}
+            if c == '[':
+                stack.append(stack[-1][name])
+            elif c == ']':
+                stack.pop()
+            name = ''
+        else:
+            name += c
+    return tree
+
+
+def format_fields(tree: FieldTree) -> str:
+    return ','.join(f'{k}[{format_fields(v)}]' if v else k for k, v in tree.items())
+
+
+def select_fields(tree: FieldTree, paths) -> FieldTree:
+    # keep only dotted paths (with their sub fields), KeyError if a path is not in tree
+    result = {}
+    for path in paths:
+        src = tree
+        dst = result
+        names = path.split('.')
+        for n, name in enumerate(names):
+            src = src[name]
+            if n == len(names) - 1:
+                dst[name] = src
+            else:
+                dst = dst.setdefault(name, {})
+    return result
+
+
+def fields_of(entity, profile='full') -> str:
+    full = cookpad_constants.fields[entity]
+    paths = PROFILES[profile].get(entity)
+    if paths is None:
+        return full
+    return format_fields(select_fields(parse_fields(full), paths))
+
+
+def _test_roundtrip():
+    for entity, s in cookpad_constants.fields.items():
+        assert format_fields(parse_fields(s)) == s, entity
+    for profile in PROFILES:
+        print(profile, fields_of('EpisodeDetailEntity', profile))
+
+
+if __name__ == '__main__':
+    _test_roundtrip()
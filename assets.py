@@ -0,0 +1,165 @@
+"""
+Download everything an episode JSON links to: program / teacher / recipe images, special videos,
+archived video, into <project>/assets/, in one DownloadQueue pass (together with the segments, if wanted).
+
+assets/manifest.json maps JSON paths (e.g. "episode.recipes[0].steps[2].image_url") to local files
+(or to a project subdir for HLS videos), same URLs are only downloaded once.
+"""
+import dataclasses
+import hashlib
+import json
+import os
+import posixpath
+import typing
+import urllib.parse
+
+import download
+import project as project_
+import verify_project
+
+ASSETS_DIR = 'assets'
+MANIFEST_FILE = 'manifest.json'
+# not assets: main video / comments are handled elsewhere
+SKIP_KEYS = {'streaming_url', 'archive_comments_url'}
+SKIP_PATHS = {'episode.archive_streamings'}
+
+
+def _is_url(value):
+    return isinstance(value, str) and value.startswith(('http://', 'https://'))
+
+
+def collect(j, path='') -> typing.List[typing.Tuple[str, str]]:
+    # [(json path, url)] of all asset urls, in document order
+    result = []
+    if path in SKIP_PATHS:
+        return result
+    if isinstance(j, dict):
+        for k, v in j.items():
+            sub = f'{path}.{k}' if path else k
+            if _is_url(v) and k.endswith('url') and k not in SKIP_KEYS:
+                result.append((sub, v))
+            else:
+                result += collect(v, sub)
+    elif isinstance(j, list):
+        for i, v in enumerate(j):
+            result += collect(v, f'{path}[{i}]')
+    return result
+
+
+def collect_hls(j) -> typing.List[typing.Tuple[str, str]]:
+    # [(json path, m3u8 url)] of special videos (they have own variants)
+    result = []
+    for i, video in enumerate(j.get('episode', {}).get('special_videos') or []):
+        if _is_url(video.get('streaming_url')):
+            result.append((f'episode.special_videos[{i}].streaming_url', video['streaming_url']))
+    return result
+
+
+def is_hls(url):
+    return urllib.parse.urlsplit(url).path.lower().endswith('.m3u8')
+
+
+def local_name(url):
+    # stable, unique per url (without query, signed urls change)
+    path = urllib.parse.urlsplit(url).path
+    ext = posixpath.splitext(path)[1][:8]
+    return hashlib.sha1(project_.strip_args(url).encode('utf-8')).hexdigest()[:20] + ext
+
+
+def load_manifest(dirname) -> dict:
+    try:
+        with open(os.path.join(dirname, ASSETS_DIR, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'files': {}, 'hls': {}, 'errors': {}}
+
+
+def save_manifest(dirname, manifest):
+    temp = os.path.join(dirname, ASSETS_DIR, MANIFEST_FILE + '.tmp')
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(temp, os.path.join(dirname, ASSETS_DIR, MANIFEST_FILE))
+
+
+def load_episode_json(dirname, project) -> dict:
+    info_json = os.path.join(dirname, project['info_json'])
+    if not os.path.isfile(info_json):
+        raise FileNotFoundError(f'project has no episode JSON ({project["info_json"]})')
+    with open(info_json, 'rb') as f:
+        return json.load(f)
+
+
+def plan(dirname, j, options: download.DownloaderOptions) -> typing.Tuple[list, dict, dict]:
+    """
+    Return (tasks, manifest, task_paths):
+      tasks: DownloadQueue tasks of files not downloaded yet (HLS playlists are fetched and written now)
+      manifest: json path -> relative filename (files) / subdir (hls)
+      task_paths: task filename -> json paths using it, to record failures
+    """
+    os.makedirs(os.path.join(dirname, ASSETS_DIR), exist_ok=True)
+    manifest = load_manifest(dirname)
+    manifest['errors'] = {}
+    tasks = []
+    task_paths: typing.Dict[str, typing.List[str]] = {}
+    queued = set()
+
+    hls = collect_hls(j)
+    hls_urls = {url for path, url in hls}
+    for path, url in collect(j):
+        if url in hls_urls:
+            continue
+        if is_hls(url):
+            hls.append((path, url))
+            continue
+        rel = posixpath.join(ASSETS_DIR, local_name(url))
+        manifest['files'][path] = rel
+        filename = os.path.join(dirname, rel)
+        task_paths.setdefault(filename, []).append(path)
+        if filename in queued or os.path.exists(filename):
+            continue
+        queued.add(filename)
+        tasks.append((url, filename, f'asset {path}'))
+
+    for path, url in hls:
+        subdir = posixpath.join(ASSETS_DIR, posixpath.splitext(local_name(url))[0])
+        manifest['hls'][path] = subdir
+        if not os.path.exists(os.path.join(dirname, subdir, project_.PROJECT_FILE)):
+            try:
+                # encrypted videos keep their (local) keys, segments share the queue of the main project
+                rendition = project_.resolve_rendition(url, 0, dataclasses.replace(options, decrypt_segments=False))
+            except Exception as e:
+                manifest['errors'][path] = repr(e)
+                continue
+            # a normal project in its own dir, can be converted to MP4 like others
+            sub_project = project_.write_rendition(os.path.join(dirname, subdir), rendition)
+            sub_project.update({'info_json': '?', 'start_offset': 0, 'stream_id': '?'})
+            project_.save_project(os.path.join(dirname, subdir), sub_project)
+        sub_project = project_.load_project(os.path.join(dirname, subdir))
+        for task in project_.pending_tasks(os.path.join(dirname, subdir), sub_project):
+            if task[1] not in queued:
+                queued.add(task[1])
+                task_paths[task[1]] = [path]
+                tasks.append((task[0], task[1], f'{path} {task[2]}'))
+    return tasks, manifest, task_paths
+
+
+def finish(dirname, tasks, results, manifest, task_paths):
+    # record failures of a DownloadQueue run of plan() tasks, save manifest
+    for (url, filename, info), (success, message) in zip(tasks, results):
+        if not success:
+            for path in task_paths.get(filename, []):
+                manifest['errors'][path] = message.strip().splitlines()[-1] if message.strip() else 'failed'
+    save_manifest(dirname, manifest)
+
+
+def download_assets(dirname, options: download.DownloaderOptions,
+                    context: download.DownloadContext = None) -> dict:
+    # standalone: one queue for all assets of the project, return manifest
+    j = load_episode_json(dirname, project_.load_project(dirname))
+    tasks, manifest, task_paths = plan(dirname, j, options)
+    dq = download.DownloadQueue(tasks, options, context=context)
+    if tasks:
+        dq.run()
+    verify_project.record_etags(dirname, tasks, dq.etags)
+    finish(dirname, tasks, dq.results, manifest, task_paths)
+    return manifest
@@ -0,0 +1,115 @@
+import email.utils
+import random
+import threading
+import time
+import typing
+import urllib.parse
+
+
+def decorrelated_jitter(previous, base, cap):
+    # https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    if base <= 0:
+        return 0
+    return min(cap, random.uniform(base, max(base, previous) * 3))
+
+
+def parse_retry_after(value) -> typing.Optional[float]:
+    # seconds, or HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, dt.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, cooldown=10.0, max_cooldown=None):
+        self.threshold = threshold  # consecutive failures to open
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown if max_cooldown is not None else cooldown * 8
+        self.state = self.CLOSED
+        self.failures = 0
+        self.cooldown = cooldown
+        self.open_until = 0.0
+        self._probe_since = None  # half open: time the probe request was let through
+        self._cond = threading.Condition()
+
+    def acquire(self, should_stop: typing.Callable[[], bool] = None) -> bool:
+        # block while host is unhealthy, return False if should_stop() became True
+        with self._cond:
+            while True:
+                if should_stop is not None and should_stop():
+                    return False
+                now = time.monotonic()
+                if self.state == self.CLOSED:
+                    return True
+                if self.state == self.OPEN:
+                    if now >= self.open_until:
+                        self.state = self.HALF_OPEN
+                        self._probe_since = None
+                    else:
+                        self._cond.wait(min(1.0, self.open_until - now))
+                        continue
+                # half open: let exactly one probe through
+                if self._probe_since is None or now - self._probe_since > self.cooldown:
+                    self._probe_since = now
+                    return True
+                self._cond.wait(1.0)
+
+    def record_success(self):
+        with self._cond:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self.state = self.CLOSED
+                self.cooldown = self.base_cooldown
+                self._cond.notify_all()
+
+    def record_failure(self, retry_after: typing.Optional[float] = None):
+        with self._cond:
+            self.failures += 1
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                # probe failed, stay open longer
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                self._open(now, retry_after)
+            elif self.state == self.CLOSED and self.threshold > 0 and self.failures >= self.threshold:
+                self._open(now, retry_after)
+            elif self.state == self.OPEN and retry_after is not None:
+                self.open_until = max(self.open_until, now + retry_after)
+
+    def _open(self, now, retry_after):
+        self.state = self.OPEN
+        self.open_until = now + max(self.cooldown, retry_after or 0)
+        self._probe_since = None
+
+
+class BreakerRegistry:
+    # one breaker per host, shared by all workers of a queue
+    def __init__(self, threshold=5, cooldown=10.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._breakers: typing.Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url) -> CircuitBreaker:
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.threshold, self.cooldown)
+            return self._breakers[host]
+
+
+def get_breakers(options) -> typing.Optional[BreakerRegistry]:
+    if options.breaker_threshold <= 0:
+        return None
+    return BreakerRegistry(options.breaker_threshold, options.breaker_cooldown)
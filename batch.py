@@ -0,0 +1,581 @@
+"""
+Non-interactive batch archiving of many episodes.
+
+Example:
+  python batch.py 1234 https://www.cookpad.tv/episodes/1235 --out archive
+  python batch.py --list episodes.txt --streams all --variants best
+
+Episodes go through 4 stages, each running in its own thread, with bounded queues in between:
+  metadata (episode JSON) -> resolve (playlists, project folder) -> download (segments) -> remux (ffmpeg)
+so while episode N remuxes, N+1 downloads and N+2 resolves. Remux runs several episodes at once
+(remux_.RemuxPool), so a fast download stage does not pile up behind ffmpeg.
+
+Every episode gets a normal project folder <out>/<title>/ (can still be opened in cui_main.py),
+the MP4 is saved as <out>/<title>.mp4. Existing projects and downloaded files are reused,
+so an interrupted batch can simply be run again.
+"""
+import argparse
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import traceback
+import typing
+from dataclasses import dataclass, field
+
+try:
+    import tqdm
+except ModuleNotFoundError:
+    tqdm = None
+
+import api_fields
+import assets
+import comments
+import download
+import login_manager
+import preflight
+import profiling
+import remux as remux_
+import project as project_
+import variant_probe
+import verify_project
+
+STAGES = ('metadata', 'resolve', 'download', 'remux')
+FINAL_STATES = ('done', 'failed', 'cancelled')
+KINDS = ('episode', 'm3u8', 'project')
+
+
+@dataclass
+class EpisodeJob:
+    ref: str  # episode id or url / m3u8 url / project dir, by kind
+    kind: str = 'episode'
+    id: str = ''
+    # per job settings, None = pipeline default
+    streams: typing.Optional[str] = None
+    variants: typing.Optional[str] = None
+    start_offset: typing.Optional[str] = None
+    remux: typing.Optional[bool] = None
+    fields: typing.Optional[str] = None  # api_fields.PROFILES
+    assets: typing.Optional[bool] = None  # also download images / special videos (assets.py)
+    comments: typing.Optional[bool] = None  # also archive comments (comments.py)
+
+    state: str = 'queued'  # queued / one of STAGES / one of FINAL_STATES
+    cancelled: bool = False
+    episode: typing.Optional[int] = None
+    title: str = ''
+    dirname: str = ''
+    detail: typing.Optional[dict] = None
+    project: typing.Optional[dict] = None
+    progress: typing.List[int] = field(default_factory=lambda: [0, 0])  # download: finished, total files
+    playable: int = 0  # download: segments on disk from the start of every rendition
+    eta: typing.Optional[float] = None  # download / remux: sec left
+    remux_progress: typing.Optional[float] = None  # 0 - 1, all renditions
+    outputs: typing.List[str] = field(default_factory=list)
+    failed_segments: int = 0
+    error: str = ''
+    times: typing.Dict[str, float] = field(default_factory=dict)  # stage -> sec
+
+
+def job_summary(job: EpisodeJob) -> dict:
+    # without the big parts (episode JSON, download list)
+    d = dataclasses.asdict(job)
+    del d['detail'], d['project']
+    return d
+
+
+STREAM_KEYWORDS = ('all', 'best')
+VARIANT_KEYWORDS = ('all', 'best', 'auto')
+
+
+def parse_ids(spec, keywords=STREAM_KEYWORDS) -> str:
+    # check a --streams / --variants spec, return it normalized ('1, 3' -> '1,3'), ValueError if invalid
+    if not isinstance(spec, str):
+        raise ValueError(f'{spec!r} should be a string')
+    spec = spec.strip().lower()
+    if spec in keywords:
+        return spec
+    parts = [part.strip() for part in spec.split(',')]
+    if not all(re.fullmatch(r'[0-9]+', part) and int(part) > 0 for part in parts):
+        raise ValueError(f'{spec!r} should be {" / ".join(keywords)} or ids separated by comma, e.g. 1,3')
+    return ','.join(parts)
+
+
+def parse_start_offset(value) -> str:
+    # seconds (int or digits) or 'auto', returned as str like the --start-offset argument
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return str(value)
+    if isinstance(value, str) and (value == 'auto' or re.fullmatch(r'[0-9]+', value)):
+        return value
+    raise ValueError(f'{value!r} should be seconds or auto')
+
+
+def arg_type(parse, *args):
+    # argparse type= from a parse function raising ValueError, keeps its message
+    def f(value):
+        try:
+            return parse(value, *args)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    f.__name__ = parse.__name__
+    return f
+
+
+def select_ids(spec, count, best=None) -> typing.List[int]:
+    # 'all' / 'best' / 'auto' / '1,3' -> 1-based ids, ids out of range are dropped; best: id for best / auto
+    if spec == 'all':
+        return list(range(1, count + 1))
+    if spec in ('best', 'auto'):
+        return [best or 1]
+    return [x for x in (int(part) for part in spec.split(',')) if 0 < x <= count]
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class BatchPipeline:
+    def __init__(self, refs, out_dir, options: download.DownloaderOptions = None, manager=None,
+                 streams='1', variants='best', start_offset='0', remux=True, queue_size=1, fields='full', assets=False,
+                 comments=False, remux_jobs=0, context: download.DownloadContext = None,
+                 callback: typing.Optional[typing.Callable[[EpisodeJob], None]] = None):
+        self.jobs = [EpisodeJob(str(ref), id=str(i)) for i, ref in enumerate(refs, start=1)]
+        self.out_dir = os.path.abspath(out_dir)
+        self.options = options or download.DownloaderOptions()
+        self.manager = manager
+        self.streams = streams
+        self.variants = variants
+        self.start_offset = start_offset  # seconds, or 'auto' for the offset suggested by cookpad
+        self.remux = remux
+        self.fields = fields  # projection of saved episode JSON, 'streams-only' is smaller and faster
+        self.assets = assets
+        self.comments = comments
+        self.queue_size = queue_size
+        self.context = context  # shared download state, one created per run() if None
+        self.callback = callback  # called (in stage threads) when state / progress of a job changes
+        self._queues: typing.Dict[str, download.DownloadQueue] = {}  # job id -> running download
+        self.remux_pool = remux_.RemuxPool(remux_jobs, fast_concat=self.options.fast_concat)
+        self._remuxes: typing.Dict[str, typing.List[remux_.RemuxJob]] = {}  # job id -> conversions
+        self._prefetched: typing.Dict[str, concurrent.futures.Future] = {}  # job id -> episode detail response
+        self._prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='Prefetch')
+        self._lock = threading.Lock()
+
+    def log(self, job: EpisodeJob, message):
+        name = job.title or job.ref
+        with self._lock:
+            if tqdm is not None and not self.options.hide_progress_bar:
+                tqdm.tqdm.write(f'[{name}] {message}')
+            else:
+                print(f'[{name}] {message}')
+
+    def prefetch(self, job: EpisodeJob):
+        # fetch episode JSON in the background, requests of many jobs share pooled connections
+        episode = project_.parse_episode(job.ref) if job.kind == 'episode' else None
+        if episode is None:
+            return
+        future = self._prefetch_pool.submit(
+            project_.fetch_episode_detail, self.manager, episode, self._setting(job, 'fields'))
+        with self._lock:
+            self._prefetched[job.id] = future
+
+    def run(self) -> typing.List[EpisodeJob]:
+        source = queue.Queue()
+        for job in self.jobs:
+            self.prefetch(job)
+            source.put(job)
+        source.put(None)
+        own_context = self.context is None
+        if own_context:
+            self.context = download.DownloadContext(self.options)
+        try:
+            for t in self.start(source):
+                while t.is_alive():
+                    t.join(0.5)  # wake up for KeyboardInterrupt
+        finally:
+            if own_context:
+                self.context.close()
+                self.context = None
+        return self.jobs
+
+    def start(self, source: queue.Queue) -> typing.List[threading.Thread]:
+        # start stage threads reading jobs from source, until None is put
+        stages = [self._metadata, self._resolve, self._download, self._remux]
+        # None in a queue = end of input
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages[1:]]
+        inputs = [source] + queues
+        outputs = queues + [None]
+        threads = [
+            threading.Thread(target=self._stage_loop, args=(name, f, inputs[i], outputs[i]),
+                             name=f'Batch {name}', daemon=True)
+            for i, (name, f) in enumerate(zip(STAGES[:-1], stages[:-1]))
+        ]
+        # last stage: one thread per conversion slot, they share the input queue
+        threads += [
+            threading.Thread(target=self._stage_loop, args=(STAGES[-1], stages[-1], inputs[-1], None, True),
+                             name=f'Batch {STAGES[-1]} #{n}', daemon=True)
+            for n in range(self.remux_pool.max_jobs)
+        ]
+        os.makedirs(self.out_dir, exist_ok=True)
+        for t in threads:
+            t.start()
+        return threads
+
+    def cancel(self, job: EpisodeJob):
+        job.cancelled = True
+        with self._lock:
+            future = self._prefetched.pop(job.id, None)
+        if future is not None:
+            future.cancel()
+        with self._lock:
+            dq = self._queues.get(job.id)
+        if dq is not None:
+            dq.stop()
+        with self._lock:
+            remux_jobs = self._remuxes.get(job.id, [])
+        for remux_job in remux_jobs:
+            self.remux_pool.cancel(remux_job)
+        if job.state == 'queued':
+            self._set_state(job, 'cancelled')
+
+    def _set_state(self, job: EpisodeJob, state):
+        job.state = state
+        self.callback and self.callback(job)
+
+    def _stage_loop(self, name, f, in_queue: queue.Queue, out_queue: typing.Optional[queue.Queue], shared=False):
+        # shared: other threads read in_queue too, pass end of input on to them
+        while True:
+            job = in_queue.get()
+            if job is None:
+                if shared:
+                    in_queue.put(None)
+                break
+            if job.cancelled:
+                if job.state != 'cancelled':
+                    self._set_state(job, 'cancelled')
+                continue
+            self._set_state(job, name)
+            t = time.perf_counter()
+            try:
+                with profiling.span(f'batch_{name}'):
+                    f(job)
+            except JobCancelled:
+                job.cancelled = True
+            except Exception as e:
+                job.error = f'{name}: {e!r}'
+                self.log(job, f'Error in {name}:\n{traceback.format_exc()}')
+            job.times[name] = time.perf_counter() - t
+            if job.cancelled:
+                self._set_state(job, 'cancelled')
+            elif job.error:
+                self._set_state(job, 'failed')
+            elif out_queue is not None:
+                out_queue.put(job)
+            else:
+                self._set_state(job, 'done')
+        if out_queue is not None:
+            out_queue.put(None)
+
+    def _setting(self, job: EpisodeJob, key):
+        value = getattr(job, key)
+        return getattr(self, key) if value is None else value
+
+    def _metadata(self, job: EpisodeJob):
+        if job.kind == 'project':
+            job.dirname = os.path.abspath(job.ref)
+            job.title = job.title or os.path.basename(job.dirname)
+            return
+        if job.kind == 'm3u8':
+            if not job.title:
+                name = project_.strip_args(job.ref).rsplit('/', maxsplit=1)[-1].rsplit('.', maxsplit=1)[0]
+                job.title = f'{name}-{hashlib.sha1(job.ref.encode("utf-8")).hexdigest()[:8]}'
+            job.dirname = os.path.join(self.out_dir, project_.safe_filename(job.title))
+            os.makedirs(job.dirname, exist_ok=True)
+            return
+        job.episode = project_.parse_episode(job.ref)
+        if job.episode is None:
+            raise ValueError(f'invalid episode id or url {job.ref!r}')
+        with self._lock:
+            future = self._prefetched.pop(job.id, None)
+        if future is not None:
+            r = future.result()
+        else:
+            r = project_.fetch_episode_detail(self.manager, job.episode, self._setting(job, 'fields'))
+        job.detail = self.manager.decode_json(r)
+        job.title = project_.episode_title(job.detail)
+        job.dirname = os.path.join(self.out_dir, project_.safe_filename(job.title))
+        os.makedirs(job.dirname, exist_ok=True)
+        with open(os.path.join(job.dirname, project_.EPISODE_JSON), 'wb') as f:
+            f.write(r.content)
+
+    def _resolve_stream(self, job: EpisodeJob, stream_url, stream_id) -> typing.List[dict]:
+        master = project_.fetch_playlist(stream_url, self.options)
+        if master[1].is_variant:
+            spec = self._setting(job, 'variants')
+            best = project_.best_variant(master[1])
+            if spec == 'auto':
+                best, link, estimates = variant_probe.recommend(master[1], self.options)
+                for line in variant_probe.describe(link, estimates):
+                    self.log(job, line)
+                self.log(job, f'Variant {best} ({self.options.variant_policy})')
+            variant_ids = select_ids(spec, len(master[1].playlists), best)
+        else:
+            variant_ids = [-1]
+        resolved = []
+        for variant_id in variant_ids:
+            rendition = project_.resolve_rendition(stream_url, variant_id, self.options, master)
+            rendition['stream_id'] = stream_id
+            rendition['name'] = f's{stream_id}v{variant_id}' if stream_id != '?' else f'v{variant_id}'
+            resolved.append(rendition)
+        return resolved
+
+    def _resolve(self, job: EpisodeJob):
+        if os.path.exists(os.path.join(job.dirname, project_.PROJECT_FILE)):
+            job.project = project_.load_project(job.dirname)
+            self.log(job, 'Using existing project')
+            return
+        if job.kind == 'project':
+            raise FileNotFoundError(f'no {project_.PROJECT_FILE} in {job.dirname}')
+        if job.kind == 'm3u8':
+            resolved = self._resolve_stream(job, job.ref, '?')
+            extra = {'info_json': '?', 'start_offset': 0}
+        else:
+            streams = job.detail['episode']['archive_streamings']
+            stream_ids = select_ids(self._setting(job, 'streams'), len(streams))
+            if not stream_ids:
+                raise ValueError(f'no stream selected, {len(streams)} available')
+            resolved = []
+            for stream_id in stream_ids:
+                resolved += self._resolve_stream(job, streams[stream_id - 1]['streaming_url'], stream_id)
+            extra = {
+                'info_json': project_.EPISODE_JSON,
+                'start_offset': job.detail['episode']['archive_start_offset'],
+            }
+        if not resolved:
+            raise ValueError('no variant selected')
+        job.project = project_.save_renditions(job.dirname, resolved, extra)
+        self.log(job, f'Project created, {len(resolved)} rendition(s)')
+
+    def _plan_assets(self, job: EpisodeJob):
+        # return: (tasks, manifest, task_paths) of assets.plan(), tasks empty if not wanted
+        if not self._setting(job, 'assets'):
+            return [], None, None
+        j = job.detail
+        if j is None:
+            try:
+                j = assets.load_episode_json(job.dirname, job.project)
+            except FileNotFoundError as e:
+                self.log(job, f'No assets: {e}')
+                return [], None, None
+        return assets.plan(job.dirname, j, self.options)
+
+    def _archive_comments(self, job: EpisodeJob):
+        # runs next to the segment download, failures only logged
+        try:
+            j = job.detail or assets.load_episode_json(job.dirname, job.project)
+            archiver = comments.archive_comments(job.dirname, j, self.manager)
+        except Exception as e:
+            self.log(job, f'Comments failed: {e!r}')
+            return
+        if archiver is None:
+            self.log(job, 'No archived comments (or not in episode JSON fields)')
+        else:
+            self.log(job, f'{archiver.count} comments archived')
+
+    def _download(self, job: EpisodeJob):
+        comments_thread = None
+        if self._setting(job, 'comments'):
+            comments_thread = threading.Thread(target=self._archive_comments, args=(job,), name='Comments')
+            comments_thread.start()
+        try:
+            self._download_files(job)
+        finally:
+            comments_thread is not None and comments_thread.join()
+
+    def _download_files(self, job: EpisodeJob):
+        segment_tasks = project_.pending_tasks(job.dirname, job.project)
+        asset_tasks, manifest, task_paths = self._plan_assets(job)
+        # one queue for both, assets are small and fill the gaps
+        tasks = segment_tasks + asset_tasks
+        if not tasks:
+            if manifest is not None:
+                assets.finish(job.dirname, [], [], manifest, task_paths)
+            self.log(job, 'All files already downloaded')
+            return
+        total_bytes = 0
+        if self.options.preflight:
+            est = preflight.estimate(job.dirname, job.project, tasks, self.options)
+            total_bytes = est.total_bytes
+            enough, free = preflight.check_space(job.dirname, total_bytes, self.options)
+            if not enough:
+                raise RuntimeError(f'not enough disk space: {preflight.describe(est, free)}')
+        self.log(job, f'Downloading {len(segment_tasks)} files' +
+                 (f' and {len(asset_tasks)} assets' if asset_tasks else '') +
+                 (f', {preflight.format_size(total_bytes)}' if total_bytes else ''))
+
+        def callback(dq: download.DownloadQueue):
+            job.progress = [dq.finished_count, len(dq.tasks)]
+            job.playable = dq.prefix_done
+            job.eta = dq.eta()
+            self.callback and self.callback(job)
+
+        dq = download.DownloadQueue(
+            tasks, self.options, callback=callback, context=self.context,
+            post_process=project_.segment_post_process(job.dirname, job.project, self.options),
+            ts_files=project_.ts_segment_files(job.dirname, job.project),
+            tracks=project_.playback_tracks(job.dirname, job.project))
+        dq.total_bytes = total_bytes
+        start_offset = self._start_offset(job)
+        if start_offset > 0 and self._setting(job, 'remux'):
+            # output starts there, segments before it are needed last (and skipped by fast concat)
+            dq.seek_time(start_offset,
+                         project_.segment_durations(job.dirname, project_.renditions(job.project)[0]))
+        job.progress = [0, len(tasks)]
+        with self._lock:
+            self._queues[job.id] = dq
+        if job.cancelled:
+            dq.stop()
+        try:
+            dq.run()
+        finally:
+            with self._lock:
+                del self._queues[job.id]
+            verify_project.record_etags(job.dirname, tasks, dq.etags)
+            if manifest is not None:
+                assets.finish(job.dirname, asset_tasks, dq.results[len(segment_tasks):], manifest, task_paths)
+            for rendition in project_.renditions(job.project):
+                r_dir = project_.rendition_dir(job.dirname, rendition)
+                for file in os.listdir(r_dir):
+                    if file.endswith(self.options.temp_suffix):
+                        os.remove(os.path.join(r_dir, file))
+        if dq.stopped:
+            raise JobCancelled
+        if len(dq.results) == 0:
+            raise RuntimeError('download failed due to severe error')
+        job.failed_segments = sum(1 for success, message in dq.results[:len(segment_tasks)] if not success)
+        failed_assets = sum(1 for success, message in dq.results[len(segment_tasks):] if not success)
+        if failed_assets:
+            self.log(job, f'{failed_assets} assets failed, see {assets.ASSETS_DIR}/{assets.MANIFEST_FILE}')
+        if job.failed_segments:
+            raise RuntimeError(f'{job.failed_segments} of {len(segment_tasks)} files failed, run again to retry')
+
+    def _start_offset(self, job: EpisodeJob) -> int:
+        # sec
+        start_offset = self._setting(job, 'start_offset')
+        if start_offset == 'auto':
+            return job.project['start_offset'] // 1000
+        return int(start_offset)
+
+    def _remux(self, job: EpisodeJob):
+        if not self._setting(job, 'remux'):
+            return
+        renditions = project_.renditions(job.project)
+        start_offset = self._start_offset(job)
+        base = os.path.join(self.out_dir, project_.safe_filename(job.title) + '.mp4')
+        job.outputs = []
+        remux_jobs = []
+
+        def callback(remux_job: remux_.RemuxJob):
+            progress = [x.progress for x in remux_jobs] or [None]  # called before the job is added
+            job.remux_progress = sum(progress) / len(progress) if None not in progress else None
+            job.eta = max((x.eta() or 0 for x in remux_jobs), default=0) or None
+            self.callback and self.callback(job)
+
+        with self._lock:
+            self._remuxes[job.id] = remux_jobs
+        try:
+            for rendition in renditions:
+                out = project_.output_filename(base, rendition, len(renditions))
+                remux_jobs.append(self.remux_pool.submit_rendition(
+                    job.dirname, rendition, out, start_offset, job.title, callback))
+            if job.cancelled:
+                self.cancel(job)
+            self.remux_pool.wait(remux_jobs)
+        finally:
+            with self._lock:
+                del self._remuxes[job.id]
+        if any(x.state == 'cancelled' for x in remux_jobs):
+            raise JobCancelled
+        for remux_job in remux_jobs:
+            if remux_job.state != 'done':
+                raise RuntimeError(f'{remux_job.error.strip()} ({remux_job.output})')
+            job.outputs.append(remux_job.output)
+            timings = remux_job.timings()
+            self.log(job, f'Saved "{remux_job.output}" ({timings["run"]:.1f}s, waited {timings["wait"]:.1f}s)')
+
+
+def read_list(filename) -> typing.List[str]:
+    # one episode id / url per line, # for comments
+    refs = []
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', maxsplit=1)[0].strip()
+            if line:
+                refs.append(line)
+    return refs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download and convert many episodes without prompts')
+    parser.add_argument('episodes', nargs='*', help='episode id or url')
+    parser.add_argument('--list', action='append', default=[], metavar='FILE',
+                        help='text file with one episode id / url per line (repeatable)')
+    parser.add_argument('--out', default='.', help='output dir for project folders and MP4 files')
+    parser.add_argument('--streams', default='1', type=arg_type(parse_ids, STREAM_KEYWORDS),
+                        help='stream ids, e.g. 1 / 1,2 / all')
+    parser.add_argument('--variants', default='best', type=arg_type(parse_ids, VARIANT_KEYWORDS),
+                        help='variant ids, e.g. best / 1,3 / all, or auto (by variant_policy, may probe the link)')
+    parser.add_argument('--start-offset', default='0', type=arg_type(parse_start_offset),
+                        help='seconds, or auto for the suggested offset')
+    parser.add_argument('--no-remux', action='store_true', help='only download, do not convert to MP4')
+    parser.add_argument('--assets', action='store_true',
+                        help='also download images, special videos etc. linked from episode JSON')
+    parser.add_argument('--comments', action='store_true', help='also archive comments (needs --fields full)')
+    parser.add_argument('--fields', default='full', choices=api_fields.PROFILES,
+                        help='fields of saved episode JSON, streams-only is enough for download')
+    parser.add_argument('--queue-size', type=int, default=1, help='episodes waiting between stages')
+    parser.add_argument('--remux-jobs', type=int, default=0, help='parallel MP4 conversions, 0 = by CPU count')
+    args = parser.parse_args(argv)
+
+    refs = list(args.episodes)
+    for filename in args.list:
+        refs += read_list(filename)
+    if not refs:
+        parser.error('no episode given')
+
+    try:
+        manager = login_manager.get_manager()
+    except FileNotFoundError:
+        manager = login_manager.LoginManager()
+    options = download.get_downloader_options()
+    profiling.configure(options)
+
+    pipeline = BatchPipeline(refs, args.out, options, manager,
+                             streams=args.streams, variants=args.variants, start_offset=args.start_offset,
+                             remux=not args.no_remux, queue_size=args.queue_size, fields=args.fields,
+                             assets=args.assets, comments=args.comments,
+                             remux_jobs=args.remux_jobs or options.remux_jobs)
+    try:
+        with profiling.run('batch'):
+            jobs = pipeline.run()
+    finally:
+        login_manager.save_manager(manager)
+
+    for endpoint, stat in manager.payload_stats().items():
+        print(f'API {endpoint}: {stat["requests"]} requests, {stat["wire_bytes"] / 1024:.1f} KiB transferred '
+              f'({stat["body_bytes"] / 1024:.1f} KiB decoded), JSON parse {stat["json_sec"]:.3f}s')
+    failed = [job for job in jobs if job.error]
+    print(f'{len(jobs) - len(failed)} of {len(jobs)} episodes done')
+    for job in failed:
+        print(f'{job.title or job.ref}: {job.error}')
+    with open(os.path.join(pipeline.out_dir, 'batch_result.json'), 'w', encoding='utf-8') as f:
+        json.dump([job_summary(job) for job in jobs], f, ensure_ascii=False, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""
+Offline benchmark of DownloadQueue against the local stand-in server (standin_server.py).
+
+Example:
+  python benchmark.py --segments 50 --segment-size 2000000 --bandwidth 2000000 --decay 0.5 \
+      --sweep queue_size=1,3,8 --sweep chunk_size=10240,65536 --out bench.jsonl
+
+Every case runs in a fresh process (so peak RSS is per case), results are appended as JSON lines.
+
+Fault profiles (retry path regression test, exit code 1 on corrupt files or too many failures):
+  python benchmark.py --faults none,reset,stall,short,bad_length,5xx,ignore_range,corrupt \
+      --set timeout_read=2 --set retry_delay=0
+"""
+import argparse
+import dataclasses
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+
+import m3u8
+import requests
+
+import download
+from standin_server import FAULTS, ServerOptions, ServerProcess, expected_segment, get_stats
+
+
+def _parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _parse_assign(s):
+    key, value = s.split('=', maxsplit=1)
+    return key, value
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def peak_rss():
+    # bytes, None if unavailable (windows)
+    try:
+        import resource
+    except ModuleNotFoundError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def resolve_tasks(master_url, variant, out_dir):
+    master = m3u8.loads(requests.get(master_url).text, master_url)
+    variant_url = master.playlists[variant].absolute_uri
+    playlist = m3u8.loads(requests.get(variant_url).text, variant_url)
+    tasks = []
+    for i, seg in enumerate(playlist.segments, start=1):
+        seg_url = seg.absolute_uri
+        seg_fn = seg_url.rsplit('/', maxsplit=1)[1]
+        tasks.append((seg_url, os.path.join(out_dir, seg_fn), f'{i}.ts'))
+    return tasks
+
+
+def count_corrupt(tasks, server_options: ServerOptions, variant) -> int:
+    # downloaded files that differ from server content
+    corrupt = 0
+    for url, filename, info in tasks:
+        if not os.access(filename, os.F_OK):
+            continue
+        index = int(re.search(r'seg_(\d+)\.ts$', filename).group(1))
+        with open(filename, 'rb') as f:
+            if f.read() != expected_segment(server_options, variant, index):
+                corrupt += 1
+    return corrupt
+
+
+def run_case(server_url, variant, overrides, server_options: dict = None) -> dict:
+    opt = download.DownloaderOptions()
+    opt.__dict__.update(overrides)
+    opt.hide_progress_bar = True
+    opt.no_output = True
+    with tempfile.TemporaryDirectory() as d:
+        tasks = resolve_tasks(server_url + '/master.m3u8', variant, d)
+        sent_before = get_stats(server_url)['bytes_sent']
+        dq = download.DownloadQueue(tasks, opt)
+        cpu_before = time.process_time()
+        t = time.perf_counter()
+        dq.run()
+        wall = time.perf_counter() - t
+        cpu = time.process_time() - cpu_before
+        sent = get_stats(server_url)['bytes_sent'] - sent_before
+        size = sum(os.path.getsize(filename) for url, filename, info in tasks if os.access(filename, os.F_OK))
+        corrupt = None if server_options is None else count_corrupt(tasks, ServerOptions(**server_options), variant)
+    durations = list(dq.durations.values())
+    return {
+        'files': len(tasks),
+        'failed': sum(1 for success, info in dq.results if not success),
+        'bytes': size,
+        'bytes_transferred': sent,
+        'bytes_retransferred': sent - size,
+        'corrupt': corrupt,
+        'wall_sec': wall,
+        'cpu_sec': cpu,
+        'throughput_bps': size / wall if wall > 0 else None,
+        'peak_rss': peak_rss(),
+        'latency_p50': percentile(durations, 50),
+        'latency_p90': percentile(durations, 90),
+        'latency_p99': percentile(durations, 99),
+        'latency_max': max(durations) if durations else None,
+    }
+
+
+def run_case_isolated(server_url, variant, overrides, server_options: dict = None) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_case, (server_url, variant, overrides, server_options))
+
+
+def iter_cases(sweeps, fixed):
+    keys = list(sweeps)
+    for values in itertools.product(*(sweeps[k] for k in keys)):
+        case = dict(fixed)
+        case.update(zip(keys, values))
+        yield case
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline DownloadQueue benchmark')
+    parser.add_argument('--sweep', action='append', default=[], metavar='KEY=V1,V2',
+                        help='DownloaderOptions field to sweep (repeatable)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='fixed DownloaderOptions field (repeatable)')
+    parser.add_argument('--segments', type=int, default=20)
+    parser.add_argument('--segment-size', type=int, default=1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=0, help='byte / sec per connection')
+    parser.add_argument('--decay', type=float, default=0.0)
+    parser.add_argument('--variant', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--label', default='', help='free text, e.g. release version')
+    parser.add_argument('--out', default='bench_results.jsonl')
+    parser.add_argument('--faults', default='', metavar='P1,P2',
+                        help=f'fault profiles to run one by one, from none,{",".join(FAULTS)}, '
+                             f'combine with +, e.g. short+ignore_range')
+    parser.add_argument('--fault-rate', type=float, default=ServerOptions.fault_rate)
+    parser.add_argument('--stall-time', type=float, default=ServerOptions.stall_time)
+    parser.add_argument('--max-failed', type=int, default=0,
+                        help='with --faults, failed downloads allowed per case before exit code 1')
+    args = parser.parse_args(argv)
+
+    fixed = {k: _parse_value(v) for k, v in map(_parse_assign, args.set)}
+    sweeps = {k: [_parse_value(x) for x in v.split(',')] for k, v in map(_parse_assign, args.sweep)}
+    unknown = (set(fixed) | set(sweeps)) - set(download.DownloaderOptions().__dict__)
+    if unknown:
+        parser.error(f'unknown DownloaderOptions fields: {sorted(unknown)}')
+    profiles = [x for x in args.faults.split(',') if x] or [None]
+    unknown = set(f for p in profiles if p is not None for f in p.split('+')) - set(FAULTS) - {'none'}
+    if unknown:
+        parser.error(f'unknown fault profiles: {sorted(unknown)}')
+
+    ok = True
+    for profile in profiles:
+        server_options = ServerOptions(
+            segment_count=args.segments, segment_size=args.segment_size,
+            latency=args.latency, bandwidth=args.bandwidth, decay=args.decay,
+            etag_chunksize=fixed.get('validator_chunk_size', download.DownloaderOptions.validator_chunk_size),
+            faults=profile.split('+') if profile not in (None, 'none') else [], fault_rate=args.fault_rate,
+            stall_time=args.stall_time,
+        )
+        check = dataclasses.asdict(server_options) if profile is not None else None
+        with ServerProcess(server_options) as server_url, open(args.out, 'a', encoding='utf-8') as out:
+            for case in iter_cases(sweeps, fixed):
+                for n in range(args.repeat):
+                    result = run_case_isolated(server_url, args.variant, case, check)
+                    record = {
+                        'label': args.label,
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'server': {
+                            'segments': args.segments, 'segment_size': args.segment_size,
+                            'latency': args.latency, 'bandwidth': args.bandwidth, 'decay': args.decay,
+                            'fault': profile, 'fault_rate': args.fault_rate,
+                        },
+                        'options': case,
+                        'repeat': n,
+                        'result': result,
+                    }
+                    out.write(json.dumps(record) + '\n')
+                    out.flush()
+                    prefix = f'[{profile}] ' if profile is not None else ''
+                    print(f'{prefix}{case} #{n}: {result["throughput_bps"] / 1024 / 1024:.2f} MiB/s, '
+                          f'{result["wall_sec"]:.2f}s, cpu {result["cpu_sec"]:.2f}s, '
+                          f'p99 {result["latency_p99"]:.2f}s, '
+                          f'retransferred {result["bytes_retransferred"]}, failed {result["failed"]}'
+                          + (f', corrupt {result["corrupt"]}' if result['corrupt'] is not None else ''))
+                    if profile is not None and (result['corrupt'] or result['failed'] > args.max_failed):
+                        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
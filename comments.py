@@ -0,0 +1,309 @@
+"""
+Archive comments of an episode (archive_comments_url in episode JSON) into the project dir.
+
+  comments.ndjson     one comment per line: {...original fields, "t": <sec from video start>}
+                      (an original "t" field is replaced)
+  comments.idx.json   sparse time index [[t, byte offset], ...] for seeking (see iter_comments),
+                      no comment before the offset is later than t (comments are in fetch order, not sorted)
+  comments.state.json resume point (next page / cursor), removed when finished
+
+Pages are written as they arrive, memory use does not grow with comment count.
+Page numbered APIs (total_pages in response) are fetched with bounded concurrency, cursor / next url APIs
+page by page. Both resume from the last written page.
+"""
+import bisect
+import concurrent.futures
+import datetime
+import json
+import os
+import typing
+import urllib.parse
+
+import requests
+
+import login_manager
+
+COMMENTS_FILE = 'comments.ndjson'
+INDEX_FILE = 'comments.idx.json'
+STATE_FILE = 'comments.state.json'
+INDEX_INTERVAL = 10.0  # sec of video between index entries
+
+LIST_KEYS = ('comments', 'data', 'items', 'results')
+NEXT_URL_KEYS = ('next_url', 'next_page_url', 'next')
+CURSOR_KEYS = ('next_cursor', 'cursor')
+TOTAL_PAGES_KEYS = ('total_pages', 'last_page', 'page_count')
+TIME_KEYS = ('created_at', 'posted_at', 'commented_at', 'timestamp')  # absolute time
+OFFSET_KEYS = ('vpos', 'offset', 'elapsed', 'elapsed_time', 'playback_time')  # ms from stream start
+
+
+def _find(d, keys, nested=('meta', 'pagination', 'links', 'paging')):
+    # first present key, also in common nested meta objects
+    if not isinstance(d, dict):
+        return None
+    for key in keys:
+        if d.get(key) is not None:
+            return d[key]
+    for n in nested:
+        value = _find(d.get(n), keys, ())
+        if value is not None:
+            return value
+    return None
+
+
+def parse_time(value) -> typing.Optional[float]:
+    # ISO 8601 or unix time (sec / ms) -> unix time
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def comment_time(comment, stream_start) -> typing.Optional[float]:
+    # sec from video start
+    for key in OFFSET_KEYS:
+        if isinstance(comment.get(key), (int, float)):
+            return comment[key] / 1000
+    if stream_start is not None:
+        for key in TIME_KEYS:
+            ts = parse_time(comment.get(key))
+            if ts is not None:
+                return ts - stream_start
+    return None
+
+
+def page_comments(page) -> list:
+    if isinstance(page, list):
+        return page
+    value = _find(page, LIST_KEYS, ())
+    return value if isinstance(value, list) else []
+
+
+def _set_query(url, **params):
+    parts = urllib.parse.urlsplit(url)
+    query = dict(urllib.parse.parse_qsl(parts.query))
+    query.update({k: str(v) for k, v in params.items()})
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+class CommentArchiver:
+    def __init__(self, dirname, url, manager: login_manager.LoginManager = None, stream_start=None,
+                 concurrency=4, callback=None):
+        self.dirname = dirname
+        self.url = url
+        self.manager = manager
+        self.stream_start = stream_start  # unix time of video start, for comments with absolute time only
+        self.concurrency = concurrency
+        self.callback = callback  # called with self after every written page
+        self.count = 0
+        self.pages = 0
+        self._session = None
+        self._index: typing.List[typing.List[float]] = []
+        self._last_indexed = None
+        self._max_t = None  # latest comment time written so far
+        self._offset = 0
+        self._out = None
+
+    def fetch(self, url):
+        # API host: with login, others (e.g. signed CDN url): plain
+        if url.startswith(login_manager.COOKPAD_TV_API_ENDPOINT) and self.manager is not None:
+            parts = urllib.parse.urlsplit(url)
+            r = self.manager.api_get(parts.path, dict(urllib.parse.parse_qsl(parts.query)))
+            r.raise_for_status()
+            return self.manager.decode_json(r)
+        if self._session is None:
+            self._session = requests.Session()
+        r = self._session.get(url, timeout=30)
+        r.raise_for_status()
+        return r.json()
+
+    def run(self):
+        state = self._load_state()
+        path = os.path.join(self.dirname, COMMENTS_FILE)
+        if state is not None and (not os.path.exists(path) or os.path.getsize(path) < state['offset']):
+            state = None  # written comments lost, start over
+        with open(path, 'r+b' if state is not None else 'wb') as self._out:
+            if state is None:
+                state = {'page': 1, 'next_url': self.url, 'offset': 0, 'count': 0, 'index': []}
+            # drop anything written after the last saved state (interrupted mid page)
+            self._out.truncate(state['offset'])
+            self._out.seek(state['offset'])
+            self._offset = state['offset']
+            self.count = state['count']
+            self._index = state['index']
+            self._last_indexed = self._index[-1][0] if self._index else None
+            self._max_t = state.get('max_t', self._last_indexed)
+            if state.get('total_pages'):
+                self._run_numbered(state)
+            else:
+                self._run_cursor(state)
+        self._save_index()
+        os.remove(os.path.join(self.dirname, STATE_FILE))
+        self._session is not None and self._session.close()
+
+    def _run_cursor(self, state):
+        url = state['next_url']
+        while url:
+            page = self.fetch(url)
+            total_pages = _find(page, TOTAL_PAGES_KEYS)
+            if state['page'] == 1 and isinstance(total_pages, int) and total_pages > 1:
+                # numbered pages, switch to parallel fetching
+                self._write_page(page)
+                state.update(page=2, total_pages=total_pages)
+                self._save_state(state)
+                self._run_numbered(state)
+                return
+            self._write_page(page)
+            next_url = _find(page, NEXT_URL_KEYS)
+            cursor = _find(page, CURSOR_KEYS)
+            if isinstance(next_url, str) and next_url:
+                url = urllib.parse.urljoin(url, next_url)
+            elif cursor and page_comments(page):
+                url = _set_query(self.url, cursor=cursor)
+            else:
+                url = None
+            state.update(page=state['page'] + 1, next_url=url)
+            self._save_state(state)
+
+    def _run_numbered(self, state):
+        # at most `concurrency` pages in flight / waiting to be written, written in page order
+        total_pages = state['total_pages']
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency, thread_name_prefix='Comments') as pool:
+            futures = {}
+            next_submit = state['page']
+            for page_no in range(state['page'], total_pages + 1):
+                while next_submit <= total_pages and next_submit < page_no + self.concurrency:
+                    futures[next_submit] = pool.submit(self.fetch, _set_query(self.url, page=next_submit))
+                    next_submit += 1
+                self._write_page(futures.pop(page_no).result())
+                state['page'] = page_no + 1
+                self._save_state(state)
+
+    def _write_page(self, page):
+        lines = []
+        for comment in page_comments(page):
+            if not isinstance(comment, dict):
+                continue
+            t = comment_time(comment, self.stream_start)
+            t = round(t, 3) if t is not None else None
+            line = json.dumps({**comment, 't': t}, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+            if self._max_t is not None and (self._last_indexed is None or
+                                            self._max_t >= self._last_indexed + INDEX_INTERVAL):
+                # entry t: latest time before this line, grows with the offset even if pages are not in time order
+                self._index.append([self._max_t, self._offset + sum(len(x) for x in lines)])
+                self._last_indexed = self._max_t
+            if t is not None and (self._max_t is None or t > self._max_t):
+                self._max_t = t
+            lines.append(line)
+        data = b''.join(lines)
+        self._out.write(data)
+        self._out.flush()
+        self._offset += len(data)
+        self.count += len(lines)
+        self.pages += 1
+        self.callback and self.callback(self)
+
+    def _load_state(self) -> typing.Optional[dict]:
+        try:
+            with open(os.path.join(self.dirname, STATE_FILE), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        return state if state.get('url') == self.url else None
+
+    def _save_state(self, state):
+        state.update(url=self.url, offset=self._offset, count=self.count, index=self._index, max_t=self._max_t)
+        temp = os.path.join(self.dirname, STATE_FILE + '.tmp')
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(temp, os.path.join(self.dirname, STATE_FILE))
+
+    def _save_index(self):
+        with open(os.path.join(self.dirname, INDEX_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'interval': INDEX_INTERVAL, 'count': self.count, 'index': self._index}, f)
+
+
+def archive_comments(dirname, j, manager=None, callback=None) -> typing.Optional[CommentArchiver]:
+    # j: episode JSON, return None if episode has no comments url
+    episode = j.get('episode', {})
+    url = episode.get('archive_comments_url')
+    if not url:
+        return None
+    archiver = CommentArchiver(dirname, url, manager, parse_time(episode.get('started_at')), callback=callback)
+    archiver.run()
+    return archiver
+
+
+def iter_comments(dirname, start=0.0) -> typing.Iterator[dict]:
+    # comments from video time `start` (sec), seeks with the index instead of reading from the beginning
+    with open(os.path.join(dirname, INDEX_FILE), 'r', encoding='utf-8') as f:
+        index = json.load(f)['index']
+    n = bisect.bisect_left([t for t, offset in index], start) - 1  # last entry with every comment before < start
+    with open(os.path.join(dirname, COMMENTS_FILE), 'rb') as f:
+        f.seek(index[n][1] if n >= 0 else 0)
+        for line in f:
+            comment = json.loads(line)
+            if comment['t'] is None or comment['t'] >= start:
+                yield comment
+
+
+def _test_write_page():
+    import io
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        archiver = CommentArchiver(d, 'https://example.com/comments')
+        archiver._out = io.BytesIO()
+        # original "t" (e.g. a type field) must not clash with the video time
+        archiver._write_page({'comments': [{'id': 1, 't': 'text', 'elapsed_time': 12500},
+                                           {'id': 2, 'elapsed_time': 30000}]})
+        lines = [json.loads(line) for line in archiver._out.getvalue().splitlines()]
+        assert [(c['id'], c['t']) for c in lines] == [(1, 12.5), (2, 30)], lines
+        assert archiver.count == 2
+    print('check ok')
+
+
+def _test_resume():
+    # state saved but comments file gone: start from page 1 instead of padding the file to the saved offset
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        archiver = CommentArchiver(d, 'https://example.com/comments')
+        with open(os.path.join(d, STATE_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'url': archiver.url, 'page': 3, 'next_url': archiver.url + '?page=3', 'offset': 100,
+                       'count': 5, 'index': []}, f)
+        urls = []
+        archiver.fetch = lambda url: urls.append(url) or {'comments': [{'id': 1, 'elapsed_time': 1000}]}
+        archiver.run()
+        assert urls == [archiver.url] and archiver.count == 1
+        assert [c['id'] for c in iter_comments(d)] == [1]
+    print('check ok')
+
+
+def _test_seek():
+    # pages not in time order, iter_comments still finds every comment from start
+    import random
+    import tempfile
+    rnd = random.Random(1)
+    times = sorted(rnd.randrange(0, 3600_000) for _ in range(1000))
+    pages = [rnd.sample(times[n:n + 50], 50) for n in range(0, len(times), 50)]  # not sorted within a page
+    pages[4], pages[5] = pages[5], pages[4]
+    pages.insert(12, sorted(rnd.randrange(0, 600_000) for _ in range(50)))  # late page of early comments
+    with tempfile.TemporaryDirectory() as d:
+        archiver = CommentArchiver(d, 'https://example.com/comments')
+        with open(os.path.join(d, COMMENTS_FILE), 'wb') as archiver._out:
+            for page in pages:
+                archiver._write_page([{'vpos': ms} for ms in page])
+        archiver._save_index()
+        assert len(archiver._index) > 10
+        for start in [0, 5.5, 100, 599.999, 1800, 3599, 4000]:
+            expected = sorted(ms for page in pages for ms in page if ms / 1000 >= start)
+            assert sorted(c['vpos'] for c in iter_comments(d, start)) == expected, start
+    print('check ok')
+
+
+if __name__ == '__main__':
+    _test_write_page()
+    _test_resume()
+    _test_seek()
@@ -1,4 +1,3 @@
-import io
 import json
 import os
 import shutil
@@ -6,17 +5,21 @@ import time
 import traceback
 from getpass import getpass
 import re
-import subprocess
 
 from tkinter import Tk  # from tkinter import Tk for Python 3.x
 import tkinter.filedialog
-import m3u8
 
-import cookpad_constants
+import assets
+import comments
 import login_manager
+import preflight
 import download
+import profiling
+import remux
+import project as project_
+import variant_probe
+import verify_project
 from query_input import query_input
-from find_ffmpeg import find_ffmpeg
 
 try:
     g_manager = login_manager.get_manager()
@@ -24,15 +27,21 @@ except FileNotFoundError:
     g_manager = login_manager.LoginManager()
 
 g_downloader_options = download.get_downloader_options()
+profiling.configure(g_downloader_options)
 
 
-def _get_episode_title(j):
-    episode_id = j['episode']['id']
-    program = j['episode']['program']['title']
-    part = j['episode']['part']
-    title = j['episode']['title']
-    full_title = f'{program} #{part} ({episode_id}) {title}'
-    return full_title
+def _on_remux(job: remux.RemuxJob):
+    if job.state in ('done', 'failed'):
+        print(f'\n[MP4] {job.describe()} ({job.timings().get("run", 0):.0f}s): "{job.output}"')
+
+
+g_remux_pool = remux.RemuxPool(g_downloader_options.remux_jobs, callback=_on_remux,
+                               fast_concat=g_downloader_options.fast_concat)
+
+
+def _remux_status():
+    # menu lines of running / queued conversions
+    return ''.join(f'[MP4] {job.describe()}\n' for job in g_remux_pool.active())
 
 
 def login_manage():
@@ -100,19 +109,14 @@ def download_json():
     def valid_url(url):
         if url.lower() == 'q':
             return 'q'
-        try:
-            episode = int(url)
+        episode = project_.parse_episode(url)
+        if episode is not None:
             return episode
-        except ValueError:
-            m = re.match(r'https://www\.cookpad\.tv/episodes/(\d+)', url)
-            if m is not None:
-                episode = int(m.group(1))
-                return episode
-            print(
-                'Invalid URL! Please check and retry.\n'
-                'Should be like: https://www.cookpad.tv/episodes/1234'
-            )
-            return False
+        print(
+            'Invalid URL! Please check and retry.\n'
+            'Should be like: https://www.cookpad.tv/episodes/1234'
+        )
+        return False
 
     print('========== Download Episode JSON ==========')
     episode = query_input(
@@ -125,16 +129,10 @@ def download_json():
         return
 
     print(f'Getting info for episode {episode}')
-    r = g_manager.api_get(f'/api/v2/episode_details/{episode}', {
-        'geometry[episode][width]': 640,  # image size (px)
-        'geometry[teacher][width]': 640,
-        'geometry[recipe][width]': 640,
-        'fields': cookpad_constants.fields['EpisodeDetailEntity'],
-    })
-    _ = r.content  # pre-fetch content
-    j = r.json()
+    r = project_.fetch_episode_detail(g_manager, episode)
+    j = g_manager.decode_json(r)
 
-    full_title = _get_episode_title(j)
+    full_title = project_.episode_title(j)
     print(f'Episode title:\n{full_title}')
 
     print('Input filename to save\nPress Enter to bring up file browser')
@@ -156,105 +154,60 @@ def download_json():
     time.sleep(1)
 
 
-def create_project():
-    global g_downloader_options
-    print('========== Create Project Folder from JSON ==========')
-    print('Input episode JSON file\nPress Enter to bring up file browser')
-    input_json = input('? ')
-    if not input_json:
-        Tk().withdraw()
-        input_json = tkinter.filedialog.askopenfilename(
-            filetypes=[('JSON', '*.json'), ('All files', '*.*')], defaultextension='.json')
-    if not input_json:
-        print('Canceled!')
-        time.sleep(1)
-        return
-    input_json = os.path.abspath(input_json)
-    with open(input_json, 'rb') as f:
-        j = json.load(f)
-    full_title = _get_episode_title(j)
-    print(f'Episode title:\n{full_title}')
+def _parse_id_list(x, count):
+    # '1' / '1,3' / 'a' (all) -> [1, 3], False if invalid
+    if x == 'a':
+        return list(range(1, count + 1))
+    ids = []
+    for part in x.split(','):
+        part = part.strip()
+        if not part.isdigit() or not 0 < int(part) <= count:
+            return False
+        if int(part) not in ids:
+            ids.append(int(part))
+    return ids or False
 
-    print('Available streams:')
-    streams = j['episode']['archive_streamings']
-    for i, stream in enumerate(streams, start=1):
-        name = stream['name']
-        w, h = stream['max_width'], stream['max_height']
-        print(f'{i}: {name} ({w}x{h})')
-    stream_id = query_input('Download which stream?\n'
-                            'Q to cancel',
-                            lambda x: (x.isdigit() and 0 < int(x) <= len(streams)) or x == 'q')
-    if stream_id == 'q':
-        print('Canceled!')
-        time.sleep(1)
-        return
-    stream_id = int(stream_id)
-    stream = streams[stream_id - 1]
-    stream_url = stream['streaming_url']
 
-    print('Checking stream url, please wait...')
-    base_url, m3u8_filename = stream_url.rsplit('/', maxsplit=1)
-    with io.BytesIO() as m3u8_file:
-        dl = download.SingleDownloader(stream_url, m3u8_file, g_downloader_options)
-        dl.start()
-        assert dl.status() == download.DownloadStatus.DONE
-        m3u8_content = m3u8_file.getbuffer().tobytes()
-    m3u8_obj = m3u8.loads(m3u8_content.decode('utf-8'), stream_url)
-    assert m3u8_obj.is_variant, 'should be variant'
-
-    best_quality_id = 0
-    best_quality_br = 0
+def _print_variants(m3u8_obj):
     print('Available variants (quality):')
     for i, playlist in enumerate(m3u8_obj.playlists, start=1):
-        w, h = playlist.stream_info.resolution
-        br = playlist.stream_info.average_bandwidth
+        w, h = playlist.stream_info.resolution or (0, 0)
+        br = project_.variant_bandwidth(playlist)
         print(f'{i}: {w}x{h} {br // 1024}kbps ({(br * 60) // (1024 * 1024 * 8)}MB per minute)')
-        if br > best_quality_br:
-            best_quality_id = i
-            best_quality_br = br
-    variant_id = query_input(
+
+
+def _ask_variants(m3u8_obj):
+    # return: list of 1-based variant id, or 'q'
+    _print_variants(m3u8_obj)
+    default = project_.best_variant(m3u8_obj)
+    if g_downloader_options.variant_policy != 'best':
+        print(f'Probing download speed for variant policy "{g_downloader_options.variant_policy}", please wait...')
+        try:
+            default, link, estimates = variant_probe.recommend(m3u8_obj, g_downloader_options)
+            print('\n'.join(variant_probe.describe(link, estimates)))
+            print(f'Recommended variant: {default}')
+        except Exception:
+            traceback.print_exc()
+            print('Probe failed, default to the best variant')
+    return query_input(
         'Download which variant?\n'
+        '(Multiple variants separated by comma, e.g. 1,2, A for all)\n'
         'Q to cancel',
-        lambda x: (x.isdigit() and 0 < int(x) <= len(m3u8_obj.playlists)) or x == 'q',
-        default_input=str(best_quality_id))
-    if variant_id == 'q':
-        print('Canceled!')
-        time.sleep(1)
-        return
-    variant_id = int(variant_id)
-    variant_url = m3u8_obj.playlists[variant_id - 1].absolute_uri
-
-    print('Checking variant_url, please wait...')
-    base_url, m3u8_variant_filename = variant_url.rsplit('/', maxsplit=1)
-    with io.BytesIO() as m3u8_file:
-        dl = download.SingleDownloader(variant_url, m3u8_file, g_downloader_options)
-        dl.start()
-        assert dl.status() == download.DownloadStatus.DONE
-        m3u8_variant_content = m3u8_file.getbuffer().tobytes()
-    m3u8_obj = m3u8.loads(m3u8_variant_content.decode('utf-8'), variant_url)
-
-    # patch m3u8 file
-    download_list = []
-    for i, seg in enumerate(m3u8_obj.segments, start=1):
-        seg_url = seg.absolute_uri
-        base_url, seg_fn = seg_url.rsplit('/', maxsplit=1)
-        seg.uri = seg_fn
-        download_list.append((seg_url, seg_fn, f'{i}.ts'))
+        lambda x: x == 'q' or _parse_id_list(x, len(m3u8_obj.playlists)),
+        default_input=str(default))
 
-    start_offset = j['episode']['archive_start_offset']
 
+def _ask_project_dir(initialdir=None):
+    # return: empty dir, or None if canceled
     while True:
         print('Input a empty dir to save project\nPress Enter to bring up file browser')
         dirname = input('? ')
         if not dirname:
-            path, file = os.path.split(input_json)
             Tk().withdraw()
             dirname = tkinter.filedialog.askdirectory(
-                initialdir=path, mustexist=False)
+                initialdir=initialdir, mustexist=False)
         if not dirname:
-            print('Canceled!')
-            time.sleep(1)
-            return
+            return None
         dirname = os.path.abspath(dirname)
         os.makedirs(dirname, exist_ok=True)
         files = os.listdir(dirname)
@@ -269,29 +222,79 @@ def create_project():
             if do_delete:
                 shutil.rmtree(dirname)
                 os.makedirs(dirname, exist_ok=True)
-                break
+                return dirname
         else:
-            break
+            return dirname
+
+
+def create_project():
+    global g_downloader_options
+    print('========== Create Project Folder from JSON ==========')
+    print('Input episode JSON file\nPress Enter to bring up file browser')
+    input_json = input('? ')
+    if not input_json:
+        Tk().withdraw()
+        input_json = tkinter.filedialog.askopenfilename(
+            filetypes=[('JSON', '*.json'), ('All files', '*.*')], defaultextension='.json')
+    if not input_json:
+        print('Canceled!')
+        time.sleep(1)
+        return
+    input_json = os.path.abspath(input_json)
+    with open(input_json, 'rb') as f:
+        j = json.load(f)
+    full_title = project_.episode_title(j)
+    print(f'Episode title:\n{full_title}')
+
+    print('Available streams:')
+    streams = j['episode']['archive_streamings']
+    for i, stream in enumerate(streams, start=1):
+        name = stream['name']
+        w, h = stream['max_width'], stream['max_height']
+        print(f'{i}: {name} ({w}x{h})')
+    stream_ids = query_input('Download which stream?\n'
+                             '(Multiple streams separated by comma, e.g. 1,2, A for all)\n'
+                             'Q to cancel',
+                             lambda x: x == 'q' or _parse_id_list(x, len(streams)))
+    if stream_ids == 'q':
+        print('Canceled!')
+        time.sleep(1)
+        return
+
+    resolved = []
+    for stream_id in stream_ids:
+        stream = streams[stream_id - 1]
+        stream_url = stream['streaming_url']
+        print(f'Checking stream url ({stream["name"]}), please wait...')
+        master = project_.fetch_playlist(stream_url, g_downloader_options)
+        assert master[1].is_variant, 'should be variant'
+        variant_ids = _ask_variants(master[1])
+        if variant_ids == 'q':
+            print('Canceled!')
+            time.sleep(1)
+            return
+        for variant_id in variant_ids:
+            print('Checking variant_url, please wait...')
+            rendition = project_.resolve_rendition(stream_url, variant_id, g_downloader_options, master)
+            rendition['stream_id'] = stream_id
+            rendition['name'] = f's{stream_id}v{variant_id}'
+            resolved.append(rendition)
+
+    start_offset = j['episode']['archive_start_offset']
+
+    path, file = os.path.split(input_json)
+    dirname = _ask_project_dir(path)
+    if dirname is None:
+        print('Canceled!')
+        time.sleep(1)
+        return
 
     print(f'Saving to "{dirname}"')
-    project = {
-        'info_json': 'episode_detail.json',
-        'stream_id': stream_id,
-        'stream_url': stream_url,
-        'variant_id': variant_id,
-        'variant_url': variant_url,
+    project_.save_renditions(dirname, resolved, {
+        'info_json': project_.EPISODE_JSON,
         'start_offset': start_offset,
-        'playlist_patched': 'patched.m3u8',
-        'download_list': download_list,
-    }
-    shutil.copy(input_json, os.path.join(dirname, 'episode_detail.json'))
-    with open(os.path.join(dirname, m3u8_filename), 'wb') as f:
-        f.write(m3u8_content)
-    with open(os.path.join(dirname, m3u8_variant_filename), 'wb') as f:
-        f.write(m3u8_variant_content)
-    m3u8_obj.dump(os.path.join(dirname, 'patched.m3u8'))
-    with open(os.path.join(dirname, 'project.json'), 'w', encoding='utf-8') as f:
-        json.dump(project, f)
+    })
+    shutil.copy(input_json, os.path.join(dirname, project_.EPISODE_JSON))
     print('Done!')
     time.sleep(1)
 
@@ -318,114 +321,36 @@ def create_project_from_m3u8():
         return
 
     print('Checking stream url, please wait...')
-    base_url, m3u8_filename = stream_url.rsplit('/', maxsplit=1)
-    with io.BytesIO() as m3u8_file:
-        dl = download.SingleDownloader(stream_url, m3u8_file, g_downloader_options)
-        dl.start()
-        assert dl.status() == download.DownloadStatus.DONE
-        m3u8_content = m3u8_file.getbuffer().tobytes()
-    m3u8_obj = m3u8.loads(m3u8_content.decode('utf-8'), stream_url)
-    if m3u8_obj.is_variant:
-        best_quality_id = 0
-        best_quality_br = 0
-        print('Available variants (quality):')
-        for i, playlist in enumerate(m3u8_obj.playlists, start=1):
-            w, h = playlist.stream_info.resolution or (0, 0)
-            br = playlist.stream_info.average_bandwidth or playlist.stream_info.bandwidth or 0
-            print(f'{i}: {w}x{h} {br // 1024}kbps ({(br * 60) // (1024 * 1024 * 8)}MB per minute)')
-            if br > best_quality_br:
-                best_quality_id = i
-                best_quality_br = br
-        variant_id = query_input(
-            'Download which variant?\n'
-            'Q to cancel',
-            lambda x: (x.isdigit() and 0 < int(x) <= len(m3u8_obj.playlists)) or x == 'q',
-            default_input=str(best_quality_id))
-        if variant_id == 'q':
+    master = project_.fetch_playlist(stream_url, g_downloader_options)
+    if master[1].is_variant:
+        variant_ids = _ask_variants(master[1])
+        if variant_ids == 'q':
             print('Canceled!')
             time.sleep(1)
             return
-        variant_id = int(variant_id)
-        variant_url = m3u8_obj.playlists[variant_id - 1].absolute_uri
-
-        print('Checking variant_url, please wait...')
-        base_url, m3u8_variant_filename = variant_url.rsplit('/', maxsplit=1)
-        with io.BytesIO() as m3u8_file:
-            dl = download.SingleDownloader(variant_url, m3u8_file, g_downloader_options)
-            dl.start()
-            assert dl.status() == download.DownloadStatus.DONE
-            m3u8_variant_content = m3u8_file.getbuffer().tobytes()
-        m3u8_obj = m3u8.loads(m3u8_variant_content.decode('utf-8'), variant_url)
     else:
-        variant_id = -1
-        variant_url = stream_url
-        m3u8_variant_content = m3u8_content
-        m3u8_variant_filename = m3u8_filename
-
-    # patch m3u8 file
-    download_list = []
-    for i, seg in enumerate(m3u8_obj.segments, start=1):
-        seg_url = seg.absolute_uri
-        base_url, seg_fn = seg_url.rsplit('/', maxsplit=1)
-        if '?' in seg_fn:
-            # strip args
-            seg_fn, _ = seg_fn.split('?', maxsplit=1)
-        seg.uri = seg_fn
-        download_list.append((seg_url, seg_fn, f'{i}.ts'))
-
-    while True:
-        print('Input a empty dir to save project\nPress Enter to bring up file browser')
-        dirname = input('? ')
-        if not dirname:
-            Tk().withdraw()
-            dirname = tkinter.filedialog.askdirectory(
-                mustexist=False)
-        if not dirname:
-            print('Canceled!')
-            time.sleep(1)
-            return
-        dirname = os.path.abspath(dirname)
-        os.makedirs(dirname, exist_ok=True)
-        files = os.listdir(dirname)
-        if files:
-            do_delete = query_input(
-                'There are files in this directory, empty it?\n'
-                f'Directory: {dirname}\n'
-                f'Files: {files}\n'
-                'Choose N to select a new directory',
-                lambda x: x in 'yn',
-                '[YN]? ', 'N') == 'y'
-            if do_delete:
-                shutil.rmtree(dirname)
-                os.makedirs(dirname, exist_ok=True)
-                break
-        else:
-            break
+        variant_ids = [-1]
+
+    resolved = []
+    for variant_id in variant_ids:
+        if variant_id > 0:
+            print('Checking variant_url, please wait...')
+        rendition = project_.resolve_rendition(stream_url, variant_id, g_downloader_options, master)
+        rendition['stream_id'] = '?'
+        rendition['name'] = f'v{variant_id}'
+        resolved.append(rendition)
+
+    dirname = _ask_project_dir()
+    if dirname is None:
+        print('Canceled!')
+        time.sleep(1)
+        return
 
     print(f'Saving to "{dirname}"')
-    project = {
+    project_.save_renditions(dirname, resolved, {
         'info_json': '?',
-        'stream_id': '?',
-        'stream_url': stream_url,
-        'variant_id': variant_id,
-        'variant_url': variant_url,
         'start_offset': 0,
-        'playlist_patched': 'patched.m3u8',
-        'download_list': download_list,
-    }
-    # strip args
-    if '?' in m3u8_filename:
-        m3u8_filename, _ = m3u8_filename.split('?', maxsplit=1)
-    if '?' in m3u8_variant_filename:
-        m3u8_variant_filename, _ = m3u8_variant_filename.split('?', maxsplit=1)
-
-    with open(os.path.join(dirname, m3u8_filename), 'wb') as f:
-        f.write(m3u8_content)
-    with open(os.path.join(dirname, m3u8_variant_filename), 'wb') as f:
-        f.write(m3u8_variant_content)
-    m3u8_obj.dump(os.path.join(dirname, 'patched.m3u8'))
-    with open(os.path.join(dirname, 'project.json'), 'w', encoding='utf-8') as f:
-        json.dump(project, f)
+    })
     print('Done!')
     time.sleep(1)
 
@@ -443,42 +368,62 @@ def process_project():
         return
     dirname = os.path.abspath(dirname)
 
-    with open(os.path.join(dirname, 'project.json'), 'rb') as f:
-        project = json.load(f)
+    project = project_.load_project(dirname)
+    renditions = project_.renditions(project)
 
     while True:
         r = query_input(
             f'========== Process Project ==========\n'
             f'Current project: {dirname}\n'
+            + (f'Renditions: {", ".join(x["name"] for x in renditions)}\n' if len(renditions) > 1 else '')
+            + _remux_status() +
             f'1. Download all files\n'
             f'2. Tweak downloader options\n'
             f'3. Reset downloader options\n'
             f'4. To MP4 file\n'
+            f'5. Verify downloaded files\n'
+            f'6. Download episode assets (images, special videos)\n'
+            f'7. Archive comments\n'
             f'Q. Back',
-            lambda x: x in '1234q',
-            '[1234Q]? '
+            lambda x: x in '1234567q',
+            '[1234567Q]? '
         )
         try:
             if r == '1':
-                queue = project['download_list']
-                queue_new = []
-                for url, filename, info in queue:
-                    filename_full = os.path.join(dirname, filename)
-                    if os.access(filename_full, os.F_OK):
-                        continue
-                    queue_new.append((url, filename_full, info))
+                with profiling.span('queue_build'):
+                    queue_new = project_.pending_tasks(dirname, project)
                 if len(queue_new) == 0:
                     print('Nothing to download!')
                     time.sleep(1)
                     continue
-                dq = download.DownloadQueue(queue_new, g_downloader_options)
+                total_bytes = 0
+                if g_downloader_options.preflight:
+                    print('Estimating download size, please wait...')
+                    with profiling.span('preflight'):
+                        est = preflight.estimate(dirname, project, queue_new, g_downloader_options)
+                    total_bytes = est.total_bytes
+                    enough, free = preflight.check_space(dirname, total_bytes, g_downloader_options)
+                    print(preflight.describe(est, free))
+                    if not enough:
+                        print('Not enough disk space! (MP4 conversion needs about the same space again)')
+                        if query_input('Download anyway?', lambda x: x in 'yn', '[YN]? ', 'N') != 'y':
+                            continue
+                dq = download.DownloadQueue(
+                    queue_new, g_downloader_options,
+                    post_process=project_.segment_post_process(dirname, project, g_downloader_options),
+                    ts_files=project_.ts_segment_files(dirname, project),
+                    tracks=project_.playback_tracks(dirname, project))
+                dq.total_bytes = total_bytes
                 try:
-                    dq.run()
+                    with profiling.run('download'):
+                        dq.run()
                 finally:
-                    files = os.listdir(dirname)
-                    for file in files:
-                        if file.endswith(g_downloader_options.temp_suffix):
-                            os.remove(os.path.join(dirname, file))
+                    verify_project.record_etags(dirname, queue_new, dq.etags)
+                    for rendition in renditions:
+                        r_dir = project_.rendition_dir(dirname, rendition)
+                        for file in os.listdir(r_dir):
+                            if file.endswith(g_downloader_options.temp_suffix):
+                                os.remove(os.path.join(r_dir, file))
                 if len(dq.results) == 0:
                     print('Download failed due to severe error!')
                     time.sleep(1)
@@ -499,19 +444,17 @@ def process_project():
                 print('Please edit "downloader_option.json" with a text editor')
                 input('Press Enter to load...')
                 g_downloader_options = download.get_downloader_options(show_exceptions=True)
+                profiling.configure(g_downloader_options)
+                g_remux_pool.configure(g_downloader_options.remux_jobs, g_downloader_options.fast_concat)
             elif r == '3':
                 download.save_downloader_options(download.DownloaderOptions())
                 print('Reset "downloader_option.json" done')
             elif r == '4':
                 print('Checking...')
-                files = os.listdir(dirname)
-                missing = []
-                for url, filename, info in project['download_list']:
-                    if filename not in files:
-                        missing.append(filename)
+                missing = sum(len(project_.missing_files(dirname, x)) for x in renditions)
                 if missing:
                     force = query_input(
-                        f'{len(missing)} files are missing, really convert now?',
+                        f'{missing} files are missing, really convert now?',
                         lambda x: x in 'yn',
                         '[YN] ', 'N') == 'y'
                     if not force:
@@ -520,17 +463,19 @@ def process_project():
                         continue
 
                 print('Input MP4 filename\nPress Enter to bring up file browser')
+                if len(renditions) > 1:
+                    print('(One file per rendition, rendition name will be appended)')
                 filename = input('? ')
                 if not filename:
                     Tk().withdraw()
                     filename = tkinter.filedialog.asksaveasfilename(
                         initialfile=dirname + '-out.mp4',
                         filetypes=[('mp4', '*.mp4'), ('All files', '*.*')], defaultextension='.mp4')
-                filename = os.path.abspath(filename)
                 if not filename:
                     print('Canceled!')
                     time.sleep(1)
                     continue
+                filename = os.path.abspath(filename)
                 print(f'Saving to "{filename}"')
 
                 start_offset_suggested = project['start_offset'] // 1000
@@ -545,19 +490,55 @@ def process_project():
                     time.sleep(1)
                     continue
 
-                args = [find_ffmpeg(), '-y']
-                if int(start_offset) > 0:
-                    args += ['-ss', f'{start_offset}']
-                args += ['-i', project['playlist_patched'],
-                         '-c', 'copy',
-                         '-bsf:v', 'filter_units=remove_types=12',  # TODO: only for h264 streams!
-                         '-movflags', '+faststart',
-                         filename]
-                p = subprocess.run(args, cwd=dirname)
-                if p.returncode != 0:
-                    print('Something went wrong!')
+                for rendition in renditions:
+                    out = project_.output_filename(filename, rendition, len(renditions))
+                    g_remux_pool.submit_rendition(dirname, rendition, out, start_offset)
+                print('Converting in background, progress is shown in the menu')
+            elif r == '5':
+                use_server = query_input(
+                    'Also compare with server ETags? (Needs network, slower)\n'
+                    'Files without recorded ETag are always compared with server',
+                    lambda x: x in 'yn',
+                    '[YN]? ', 'N') == 'y'
+                print('Verifying, please wait...')
+                bad, unchecked = verify_project.verify_project(
+                    dirname, project_.flat_download_list(project), g_downloader_options, use_server,
+                    local_only=project_.decrypted_files(project))
+                for url, filename, info, reason in bad:
+                    print(f'{filename}: {reason}')
+                if unchecked:
+                    print(f'{unchecked} files have no ETag, can not verify')
+                if not bad:
+                    print('All files OK')
                 else:
-                    print('Done!')
+                    print(f'{len(bad)} files are missing or corrupted')
+                    do_requeue = query_input(
+                        'Delete corrupted files, so they will be downloaded again?',
+                        lambda x: x in 'yn',
+                        '[YN]? ', 'Y') == 'y'
+                    if do_requeue:
+                        verify_project.requeue(dirname, bad)
+                        print('Done, please download again')
+            elif r == '6':
+                print('Checking assets, please wait...')
+                with profiling.run('assets'):
+                    manifest = assets.download_assets(dirname, g_downloader_options)
+                print(f'{len(manifest["files"])} files, {len(manifest["hls"])} videos '
+                      f'in "{os.path.join(dirname, assets.ASSETS_DIR)}"')
+                for path, error in manifest['errors'].items():
+                    print(f'Error: {path}: {error}')
+                if manifest['hls']:
+                    print('Videos are saved as projects, open them (e.g. "assets/xxx") to convert to MP4')
+            elif r == '7':
+                j = assets.load_episode_json(dirname, project)
+                with profiling.run('comments'):
+                    archiver = comments.archive_comments(
+                        dirname, j, g_manager,
+                        lambda a: print(f'\r{a.count} comments ({a.pages} pages)', end='', flush=True))
+                if archiver is None:
+                    print('This episode has no archived comments')
+                else:
+                    print(f'\nSaved to "{os.path.join(dirname, comments.COMMENTS_FILE)}"')
             elif r == 'q':
                 return
             time.sleep(1)
@@ -576,6 +557,7 @@ def main():
             r = query_input(
                 f'========== Main Menu ==========\n'
                 f'Current login: {login_info}\n'
+                + _remux_status() +
                 f'1. Login / logout / status\n'
                 f'2. Download JSON\n'
                 f'3. Create project from JSON\n'
@@ -586,6 +568,13 @@ def main():
                 '[12345Q]? '
             )
             if r == 'q':
+                if g_remux_pool.active():
+                    print('Waiting for MP4 conversions to finish... (Ctrl-C to abort them)')
+                    try:
+                        g_remux_pool.wait()
+                    except KeyboardInterrupt:
+                        for job in g_remux_pool.active():
+                            g_remux_pool.cancel(job)
                 return
             f = {
                 '1': login_manage,
@@ -595,7 +584,11 @@ def main():
                 '5': create_project_from_m3u8,
             }[r]
             try:
-                f()
+                if f in (create_project, create_project_from_m3u8):
+                    with profiling.run(f.__name__):
+                        f()
+                else:
+                    f()
             except (Exception, KeyboardInterrupt) as e:
                 traceback.print_exc()
             login_manager.save_manager(g_manager)
@@ -604,4 +597,6 @@ def main():
 
 
 if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()  # verify uses process pool, needed for pyinstaller build
     main()
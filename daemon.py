@@ -0,0 +1,365 @@
+"""
+Long running downloader with a local HTTP / JSON job API.
+
+  python daemon.py --port 8765 --out archive
+
+Keeps login, HTTP connection pools, segment store, breakers and proxy stats warm between jobs,
+and runs all jobs through one batch pipeline (see batch.py), so downloads of different jobs never compete.
+The job list is saved to daemon_jobs.json, unfinished jobs are resumed after a restart.
+
+API (localhost only):
+  POST   /jobs              {"kind": "episode", "ref": "1234"}  -> job
+                            kind: episode (id or url) / m3u8 (url) / project (dir of an existing project)
+                            optional: streams, variants, start_offset, remux, fields, assets, comments (see batch.py)
+                            body must be sent with Content-Type: application/json
+  GET    /jobs              -> [job, ...]
+  GET    /jobs/<id>         -> job
+  GET    /jobs/<id>/events  -> job as JSON lines, one per change, until the job is finished
+  DELETE /jobs/<id>         -> cancel job
+Requests with an Origin header or a non-loopback Host are refused (403), so web pages can not submit jobs.
+
+Example:
+  curl -H 'Content-Type: application/json' -d '{"kind": "episode", "ref": "1234"}' http://127.0.0.1:8765/jobs
+  curl -N http://127.0.0.1:8765/jobs/1/events
+"""
+import argparse
+import http.server
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import typing
+
+import api_fields
+import batch
+import download
+import login_manager
+import profiling
+
+JOBS_FILE = 'daemon_jobs.json'
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+
+def _host_name(host: str) -> str:
+    # Host header without port, '[::1]:8765' -> '::1'
+    if host.startswith('['):
+        return host[1:].split(']', maxsplit=1)[0]
+    return host.rsplit(':', maxsplit=1)[0] if host.count(':') == 1 else host
+
+
+class Daemon:
+    def __init__(self, out_dir, options: download.DownloaderOptions = None, manager=None,
+                 jobs_file=JOBS_FILE, **pipeline_args):
+        self.options = options or download.DownloaderOptions()
+        self.manager = manager
+        self.jobs_file = jobs_file
+        self.context = download.DownloadContext(self.options)
+        self.pipeline = batch.BatchPipeline([], out_dir, self.options, manager, context=self.context,
+                                            callback=self._on_change, **pipeline_args)
+        self.jobs: typing.Dict[str, batch.EpisodeJob] = {}
+        self.source = queue.Queue()
+        self.version = 0  # bumped on every job change
+        self._cond = threading.Condition()
+        self._server = None
+        self._threads = []
+        self._next_id = 1
+
+    def start(self, port=8765):
+        self._load()
+        self._threads = self.pipeline.start(self.source)
+        self._serve(port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        # stop running downloads, unfinished jobs are resumed on next start
+        unfinished = [job for job in self.jobs.values() if job.state not in batch.FINAL_STATES]
+        for job in unfinished:
+            self.pipeline.cancel(job)
+        self.source.put(None)
+        for t in self._threads:
+            t.join()
+        for job in unfinished:
+            job.cancelled = False
+            job.state = 'queued'
+        self._save()
+        self.context.close()
+
+    def submit(self, d: dict) -> batch.EpisodeJob:
+        kind = d.get('kind', 'episode')
+        if kind not in batch.KINDS:
+            raise ValueError(f'kind should be one of {batch.KINDS}')
+        if not isinstance(d.get('ref'), str) or not d['ref']:
+            raise ValueError('ref should be a non-empty string')
+        if d.get('fields', 'full') not in api_fields.PROFILES:
+            raise ValueError(f'fields should be one of {tuple(api_fields.PROFILES)}')
+        settings = {k: d[k] for k in ('streams', 'variants', 'start_offset', 'remux', 'fields', 'assets', 'comments',
+                                      'title') if k in d}
+        if 'streams' in settings:
+            settings['streams'] = batch.parse_ids(settings['streams'], batch.STREAM_KEYWORDS)
+        if 'variants' in settings:
+            settings['variants'] = batch.parse_ids(settings['variants'], batch.VARIANT_KEYWORDS)
+        if 'start_offset' in settings:
+            settings['start_offset'] = batch.parse_start_offset(settings['start_offset'])
+        for k in ('remux', 'assets', 'comments'):
+            if not isinstance(settings.get(k, False), bool):
+                raise ValueError(f'{k} should be true or false')
+        if not isinstance(settings.get('title', ''), str):
+            raise ValueError('title should be a string')
+        with self._cond:
+            job = batch.EpisodeJob(d['ref'], kind=kind, id=str(self._next_id), **settings)
+            self._next_id += 1
+            self.jobs[job.id] = job
+        self._on_change(job)
+        self.pipeline.prefetch(job)
+        self.source.put(job)
+        return job
+
+    def cancel(self, job_id) -> typing.Optional[batch.EpisodeJob]:
+        job = self.jobs.get(job_id)
+        if job is not None and job.state not in batch.FINAL_STATES:
+            self.pipeline.cancel(job)
+            self._on_change(job)
+        return job
+
+    def events(self, job_id, timeout=15.0) -> typing.Iterator[typing.Optional[dict]]:
+        # yield job summary on every change, None as keep-alive, stop when job is finished
+        last = None
+        version = -1
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.version != version, timeout)
+                version = self.version
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return
+                summary = batch.job_summary(job)
+            if summary != last:
+                last = summary
+                yield summary
+            else:
+                yield None
+            if summary['state'] in batch.FINAL_STATES:
+                return
+
+    def _on_change(self, job: batch.EpisodeJob):
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+        if job.progress[0] in (0, job.progress[1]) or job.state in batch.FINAL_STATES:
+            # not on every downloaded file
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.jobs_file, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        fields = set(batch.EpisodeJob.__dataclass_fields__)
+        for d in saved:
+            job = batch.EpisodeJob(**{k: v for k, v in d.items() if k in fields})
+            self.jobs[job.id] = job
+            self._next_id = max(self._next_id, int(job.id) + 1)
+            if job.state not in batch.FINAL_STATES:
+                # start over, finished stages are fast (existing project / files are reused)
+                job.state = 'queued'
+                job.error = ''
+                job.progress = [0, 0]
+                self.pipeline.prefetch(job)
+                self.source.put(job)
+
+    def _save(self):
+        with self._cond:
+            data = [batch.job_summary(job) for job in self.jobs.values()]
+            tmp = self.jobs_file + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.jobs_file)
+        if self.manager is not None:
+            login_manager.save_manager(self.manager)
+
+    def _serve(self, port):
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _send_json(self, code, obj):
+                body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _path(self):
+                return [x for x in self.path.split('?', maxsplit=1)[0].split('/') if x]
+
+            def _allowed(self):
+                # browsers send Origin on cross-site requests, DNS rebinding gives a foreign Host
+                if 'Origin' in self.headers:
+                    self._send_json(403, {'error': 'cross-origin requests are not allowed'})
+                    return False
+                if _host_name(self.headers.get('Host', '').lower()) not in LOOPBACK_HOSTS:
+                    self._send_json(403, {'error': 'Host should be a loopback address'})
+                    return False
+                return True
+
+            def do_GET(self):
+                if not self._allowed():
+                    return
+                path = self._path()
+                if path == ['jobs']:
+                    with daemon._cond:
+                        jobs = [batch.job_summary(job) for job in daemon.jobs.values()]
+                    self._send_json(200, jobs)
+                elif len(path) == 2 and path[0] == 'jobs':
+                    job = daemon.jobs.get(path[1])
+                    if job is None:
+                        self._send_json(404, {'error': 'no such job'})
+                    else:
+                        self._send_json(200, batch.job_summary(job))
+                elif len(path) == 3 and path[0] == 'jobs' and path[2] == 'events':
+                    if path[1] not in daemon.jobs:
+                        self._send_json(404, {'error': 'no such job'})
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+                    self.end_headers()
+                    try:
+                        for summary in daemon.events(path[1]):
+                            line = json.dumps(summary, ensure_ascii=False) if summary is not None else ''
+                            self.wfile.write(line.encode('utf-8') + b'\n')
+                            self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                else:
+                    self._send_json(404, {'error': 'not found'})
+
+            def do_POST(self):
+                if not self._allowed():
+                    return
+                if self._path() != ['jobs']:
+                    self._send_json(404, {'error': 'not found'})
+                    return
+                content_type = self.headers.get('Content-Type', '').split(';', maxsplit=1)[0].strip().lower()
+                if content_type != 'application/json':
+                    self._send_json(415, {'error': 'Content-Type should be application/json'})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    d = json.loads(self.rfile.read(length) or b'{}')
+                    if not isinstance(d, dict):
+                        raise ValueError('body should be a JSON object')
+                    job = daemon.submit(d)
+                except (ValueError, TypeError) as e:
+                    self._send_json(400, {'error': str(e)})
+                    return
+                self._send_json(201, batch.job_summary(job))
+
+            def do_DELETE(self):
+                if not self._allowed():
+                    return
+                path = self._path()
+                job = daemon.cancel(path[1]) if len(path) == 2 and path[0] == 'jobs' else None
+                if job is None:
+                    self._send_json(404, {'error': 'no such job'})
+                else:
+                    self._send_json(200, batch.job_summary(job))
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(('127.0.0.1', port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='Daemon API server', daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Downloader daemon with a local job API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--out', default='.', help='output dir for project folders and MP4 files')
+    parser.add_argument('--jobs-file', default=JOBS_FILE)
+    parser.add_argument('--streams', default='1', type=batch.arg_type(batch.parse_ids, batch.STREAM_KEYWORDS),
+                        help='default stream ids, e.g. 1 / 1,2 / all')
+    parser.add_argument('--variants', default='best', type=batch.arg_type(batch.parse_ids, batch.VARIANT_KEYWORDS),
+                        help='default variant ids, e.g. best / 1,3 / all / auto')
+    parser.add_argument('--start-offset', default='0', type=batch.arg_type(batch.parse_start_offset),
+                        help='default, seconds or auto')
+    parser.add_argument('--no-remux', action='store_true', help='by default only download, do not convert')
+    parser.add_argument('--fields', default='full', choices=api_fields.PROFILES, help='default fields of episode JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        manager = login_manager.get_manager()
+    except FileNotFoundError:
+        manager = login_manager.LoginManager()
+    options = download.get_downloader_options()
+    options.hide_progress_bar = True
+    options.no_output = True
+    profiling.configure(options)
+
+    daemon = Daemon(args.out, options, manager, jobs_file=args.jobs_file,
+                    streams=args.streams, variants=args.variants, start_offset=args.start_offset,
+                    remux=not args.no_remux, fields=args.fields, remux_jobs=options.remux_jobs)
+    daemon.start(args.port)
+    print(f'Listening on {daemon.url}, Ctrl-C to stop')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print('Stopping, unfinished jobs will be resumed on next start...')
+    finally:
+        daemon.stop()
+    return 0
+
+
+def _test_api():
+    """
+    Bad job settings and non-local requests are refused:
+    python -c "import daemon; daemon._test_api()"
+    """
+    import http.client
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        daemon = Daemon(d, jobs_file=os.path.join(d, JOBS_FILE))
+        daemon._serve(0)
+        port = daemon._server.server_address[1]
+
+        def request(method, body=None, headers=None):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request(method, '/jobs', body=json.dumps(body) if body is not None else None, headers=headers or {})
+            response = conn.getresponse()
+            result = response.status, json.loads(response.read())
+            conn.close()
+            return result
+
+        json_type = {'Content-Type': 'application/json'}
+        for bad in [{'start_offset': 'abc'}, {'streams': 5}, {'variants': '1,,2'}, {'remux': 'no'},
+                    {'assets': 1}, {'comments': None}, {'title': 3}, {'start_offset': -1}]:
+            code, result = request('POST', {'ref': '1234', **bad}, json_type)
+            assert code == 400 and result['error'], (bad, code, result)
+        assert request('POST', {'ref': '1234'})[0] == 415
+        assert request('POST', {'ref': '1234'}, {'Content-Type': 'text/plain'})[0] == 415
+        assert request('POST', {'ref': '1234'}, {**json_type, 'Origin': 'https://example.com'})[0] == 403
+        assert request('POST', {'ref': '1234'}, {**json_type, 'Host': f'example.com:{port}'})[0] == 403
+        assert request('GET', headers={'Host': 'evil.localhost'})[0] == 403
+        assert request('GET', headers={'Host': f'[::1]:{port}'}) == (200, [])
+        assert request('GET', headers={'Host': f'localhost:{port}'}) == (200, [])
+        assert not daemon.jobs
+        daemon.stop()
+    print('check ok')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""
+Download one project with several worker processes / machines.
+
+Segments of the project are leased out in batches from a SQLite database in the project dir,
+so the project dir has to be on a filesystem shared by all workers (SMB / NFS share, or local for processes).
+A worker keeps its lease alive with heartbeats while downloading; leases of crashed / stuck workers expire
+and are given to another worker.
+
+  python distributed.py init <project dir>                       create / update the lease database
+  python distributed.py worker <project dir> [--processes 4]     download until every segment is done
+  python distributed.py status <project dir>
+
+Workers on different machines may mount the project dir at different paths, only relative paths are stored.
+Lease expiry uses wall clock time, keep clocks of the machines roughly in sync (within a few seconds).
+"""
+import argparse
+import contextlib
+import dataclasses
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import typing
+
+import download
+import project as project_
+import verify_project
+
+LEASE_DB = 'leases.sqlite3'
+
+
+class LeaseStore:
+    def __init__(self, dirname, lease_time=60.0, max_attempts=5):
+        self.dirname = dirname
+        self.path = os.path.join(dirname, LEASE_DB)
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts  # failed downloads of a segment before giving up
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # short lived connections, the database may be on a network share
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def init(self, project):
+        # add segments of project (existing files count as done), keep state of known ones
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS segments ('
+                ' idx INTEGER PRIMARY KEY, url TEXT, filename TEXT UNIQUE, info TEXT,'
+                ' state TEXT, worker TEXT, lease_until REAL, attempts INTEGER, etag TEXT, message TEXT)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS workers ('
+                ' worker TEXT PRIMARY KEY, last_seen REAL, done INTEGER, failed INTEGER)')
+            for i, (url, filename, info) in enumerate(project_.flat_download_list(project)):
+                state = 'done' if os.path.exists(os.path.join(self.dirname, filename)) else 'pending'
+                conn.execute(
+                    'INSERT OR IGNORE INTO segments (idx, url, filename, info, state, attempts) VALUES (?, ?, ?, ?, ?, 0)',
+                    (i, url, filename, info, state))
+                if state == 'pending':
+                    # deleted after download (e.g. by verify), download again
+                    conn.execute("UPDATE segments SET state = 'pending', attempts = 0 "
+                                 "WHERE filename = ? AND state = 'done'", (filename,))
+            conn.execute('COMMIT')
+
+    def lease(self, worker, count) -> typing.List[typing.Tuple[int, str, str, str]]:
+        # return: [(idx, url, relative filename, info)], expired leases of other workers included
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                "SELECT idx, url, filename, info FROM segments "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY idx LIMIT ?", (now, count)).fetchall()
+            conn.executemany(
+                "UPDATE segments SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE idx = ?", [(worker, now + self.lease_time, row[0]) for row in rows])
+            self._seen(conn, worker, now)
+            conn.execute('COMMIT')
+        return rows
+
+    def heartbeat(self, worker, indexes):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                "UPDATE segments SET lease_until = ? WHERE idx = ? AND state = 'leased' AND worker = ?",
+                [(now + self.lease_time, i, worker) for i in indexes])
+            self._seen(conn, worker, now)
+            conn.execute('COMMIT')
+
+    def complete(self, worker, results):
+        # results: [(idx, success, etag, message)], ignored if the lease was given to another worker
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            done = failed = 0  # counted only for segments still leased to this worker
+            for i, success, etag, message in results:
+                if success:
+                    done += conn.execute(
+                        "UPDATE segments SET state = 'done', etag = ?, message = ? "
+                        "WHERE idx = ? AND state = 'leased' AND worker = ?", (etag, message, i, worker)).rowcount
+                else:
+                    failed += conn.execute(
+                        "UPDATE segments SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                        "message = ? WHERE idx = ? AND state = 'leased' AND worker = ?",
+                        (self.max_attempts, message, i, worker)).rowcount
+            conn.execute(
+                'UPDATE workers SET done = done + ?, failed = failed + ? WHERE worker = ?', (done, failed, worker))
+            conn.execute('COMMIT')
+
+    def release(self, worker, indexes):
+        # give back unfinished leases (worker stopping)
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                "UPDATE segments SET state = 'pending', attempts = attempts - 1 "
+                "WHERE idx = ? AND state = 'leased' AND worker = ?", [(i, worker) for i in indexes])
+            conn.execute('COMMIT')
+
+    def retry_failed(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE segments SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+
+    def counts(self) -> typing.Dict[str, int]:
+        with self._connect() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) FROM segments GROUP BY state').fetchall()
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(rows)
+        return counts
+
+    def workers(self) -> typing.List[typing.Tuple[str, float, int, int]]:
+        with self._connect() as conn:
+            return conn.execute('SELECT worker, last_seen, done, failed FROM workers ORDER BY worker').fetchall()
+
+    def failed(self) -> typing.List[typing.Tuple[str, str, str]]:
+        with self._connect() as conn:
+            return conn.execute("SELECT url, filename, message FROM segments WHERE state = 'failed'").fetchall()
+
+    def etags(self) -> typing.Dict[str, str]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT filename, etag FROM segments WHERE state = 'done' AND etag IS NOT NULL").fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def _seen(conn, worker, now):
+        conn.execute('INSERT OR IGNORE INTO workers (worker, last_seen, done, failed) VALUES (?, ?, 0, 0)',
+                     (worker, now))
+        conn.execute('UPDATE workers SET last_seen = ? WHERE worker = ?', (now, worker))
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def run_worker(dirname, options: download.DownloaderOptions, worker=None, batch_size=0,
+               lease_time=60.0, idle_wait=5.0) -> int:
+    """
+    Lease and download batches until nothing is left. Return count of segments downloaded by this worker.
+    batch_size: segments per lease, default 2 * queue_size.
+    """
+    worker = worker or default_worker_id()
+    store = LeaseStore(dirname, lease_time)
+    batch_size = batch_size or options.queue_size * 2
+    # own temp files, an expired lease may still be downloading when re-leased to another worker
+    options = dataclasses.replace(options, temp_suffix=f'.{project_.safe_filename(worker)}{options.temp_suffix}')
+    context = download.DownloadContext(options)
+    project = project_.load_project(dirname)
+    post_process = project_.segment_post_process(dirname, project, options)
+    ts_files = project_.ts_segment_files(dirname, project)
+    downloaded = 0
+    try:
+        while True:
+            rows = store.lease(worker, batch_size)
+            if not rows:
+                counts = store.counts()
+                if counts['leased'] == 0:
+                    break  # everything done or failed
+                time.sleep(idle_wait)  # wait for leases of other workers, may expire
+                continue
+            tasks = [(url, os.path.join(dirname, filename), info) for i, url, filename, info in rows]
+            dq = download.DownloadQueue(tasks, options, context=context, post_process=post_process,
+                                        ts_files=ts_files)
+            stop_heartbeat = threading.Event()
+
+            def heartbeat():
+                while not stop_heartbeat.wait(lease_time / 3):
+                    try:
+                        store.heartbeat(worker, [row[0] for row in rows])
+                    except sqlite3.Error:
+                        pass  # try again next time, lease_time covers a few misses
+
+            t = threading.Thread(target=heartbeat, name='Lease heartbeat', daemon=True)
+            t.start()
+            try:
+                dq.run()
+            except BaseException:
+                store.release(worker, [row[0] for row in rows])
+                raise
+            finally:
+                stop_heartbeat.set()
+                t.join()
+            results = [
+                (row[0], success, dq.etags.get(n), message)
+                for n, (row, (success, message)) in enumerate(zip(rows, dq.results))
+            ]
+            store.complete(worker, results)
+            downloaded += sum(1 for x in results if x[1])
+    finally:
+        context.close()
+    return downloaded
+
+
+def _worker_process(dirname, options_dict, worker, batch_size, lease_time):
+    options = download.DownloaderOptions(**options_dict)
+    print(f'{worker}: downloaded {run_worker(dirname, options, worker, batch_size, lease_time)} files')
+
+
+def print_status(store: LeaseStore):
+    counts = store.counts()
+    total = sum(counts.values())
+    print(f'{counts["done"]}/{total} done, {counts["leased"]} leased, '
+          f'{counts["pending"]} pending, {counts["failed"]} failed')
+    now = time.time()
+    for worker, last_seen, done, failed in store.workers():
+        print(f'  {worker}: {done} done, {failed} failed, last seen {now - last_seen:.0f}s ago')
+    for url, filename, message in store.failed():
+        print(f'  failed {filename}: {message.strip().splitlines()[-1] if message else ""}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download one project with several workers')
+    parser.add_argument('command', choices=('init', 'worker', 'status'))
+    parser.add_argument('project', help='project dir (shared by all workers)')
+    parser.add_argument('--worker-id', default='', help='default: hostname-pid')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes to start on this machine')
+    parser.add_argument('--batch-size', type=int, default=0, help='segments per lease, default 2 * queue_size')
+    parser.add_argument('--lease-time', type=float, default=60.0, help='seconds without heartbeat before re-lease')
+    parser.add_argument('--retry-failed', action='store_true', help='with init: download failed segments again')
+    args = parser.parse_args(argv)
+
+    dirname = os.path.abspath(args.project)
+    store = LeaseStore(dirname, args.lease_time)
+    if args.command == 'init':
+        store.init(project_.load_project(dirname))
+        if args.retry_failed:
+            store.retry_failed()
+        print_status(store)
+        return 0
+    if args.command == 'status':
+        print_status(store)
+        return 0
+
+    if not os.path.exists(store.path):
+        store.init(project_.load_project(dirname))
+    options = download.get_downloader_options()
+    options.hide_progress_bar = True
+    options.no_output = True
+    worker = args.worker_id or default_worker_id()
+    if args.processes <= 1:
+        print(f'{worker}: downloaded {run_worker(dirname, options, worker, args.batch_size, args.lease_time)} files')
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        processes = [
+            ctx.Process(target=_worker_process, name=f'Worker #{n}',
+                        args=(dirname, options.__dict__, f'{worker}-{n}', args.batch_size, args.lease_time))
+            for n in range(args.processes)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        for p in processes:
+            if p.exitcode != 0:
+                print(f'{p.name} exited with {p.exitcode}')
+    counts = store.counts()
+    complete = counts['pending'] == 0 and counts['leased'] == 0
+    if complete:
+        etags = verify_project.load_etags(dirname)
+        etags.update(store.etags())
+        verify_project.save_etags(dirname, etags)
+    print_status(store)
+    # nonzero unless every segment is done, so a coordinating script sees crashed workers / left over segments
+    return 0 if complete and counts['failed'] == 0 else 1
+
+
+def _test_workers():
+    """
+    Several worker processes against the stand-in server, one of them killed while holding leases:
+    python -c "import distributed; distributed._test_workers()"
+    """
+    import subprocess
+    import tempfile
+    import standin_server
+
+    script = os.path.abspath(__file__)
+    options = standin_server.ServerOptions(segment_count=30, segment_size=188 * 2000, bandwidth=200 * 1024)
+    server = standin_server.StandinServer(options)
+    server.start()
+    try:
+        with tempfile.TemporaryDirectory() as cwd:  # no downloader_option.json: defaults
+            dirname = os.path.join(cwd, 'project')
+            download_options = download.DownloaderOptions(hide_progress_bar=True, no_output=True)
+            rendition = project_.resolve_rendition(server.url + '/master.m3u8', 1, download_options)
+            rendition['stream_id'] = '?'
+            project = project_.save_renditions(dirname, [rendition], {'info_json': '?', 'start_offset': 0})
+
+            def run(*args, stderr=None):
+                return subprocess.run([sys.executable, script, *args, dirname], cwd=cwd,
+                                      stdout=subprocess.DEVNULL, stderr=stderr).returncode
+
+            assert run('init') == 0
+            store = LeaseStore(dirname)
+            victim = subprocess.Popen([sys.executable, script, 'worker', dirname, '--worker-id', 'victim',
+                                       '--lease-time', '2'], cwd=cwd, stdout=subprocess.DEVNULL)
+            while store.counts()['leased'] == 0:
+                time.sleep(0.1)
+            victim.kill()
+            victim.wait()
+            leased = store.counts()['leased']
+            assert leased > 0
+
+            # workers can not load the project: they crash, segments are left over
+            os.replace(os.path.join(dirname, project_.PROJECT_FILE), os.path.join(cwd, 'moved'))
+            assert run('worker', '--processes', '2', stderr=subprocess.DEVNULL) != 0
+            os.replace(os.path.join(cwd, 'moved'), os.path.join(dirname, project_.PROJECT_FILE))
+
+            assert run('worker', '--processes', '3', '--lease-time', '2') == 0
+            counts = store.counts()
+            assert counts['done'] == options.segment_count, counts
+            workers = {worker: done for worker, last_seen, done, failed in store.workers()}
+            assert sum(workers.values()) == options.segment_count, workers  # each segment done once
+            assert workers['victim'] == 0  # its leases were reclaimed
+            for n, (url, filename, info) in enumerate(project_.flat_download_list(project)):
+                with open(os.path.join(dirname, filename), 'rb') as f:
+                    assert f.read() == standin_server.expected_segment(options, 0, n), filename
+            assert len(verify_project.load_etags(dirname)) == options.segment_count
+        print(f'check ok ({leased} leases reclaimed)')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
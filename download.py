@@ -1,5 +1,12 @@
+import bisect
+import dataclasses
+import heapq
+import itertools
+import math
 import os
 import queue
+import socket
+import statistics
 import threading
 import time
 import traceback
@@ -17,8 +24,15 @@ except ModuleNotFoundError:
     tqdm = None
 
 from s3_etag import check_etag_header
+import backoff
+import ts_check
+import profiling
+import proxy_pool
+import segment_store
+import telemetry as telemetry_
 
 validator = check_etag_header
+ts_validator = ts_check.check_header  # for MPEG-TS segments: ETag, or structure if the server sent none
 
 
 @dataclass
@@ -30,6 +44,8 @@ class DownloaderOptions:
     headers: typing.Dict[str, str] = field(default_factory=dict)
     cookies: typing.Dict[str, str] = field(default_factory=dict)
     proxies: typing.Dict[str, str] = field(default_factory=dict)
+    proxy_pool: typing.List[typing.Dict[str, str]] = field(default_factory=list)  # overrides proxies if set
+    proxy_eject_time: int = 30  # sec, before re-probing a failing proxy from proxy_pool
 
     temp_suffix: str = '.download'
     retry: int = 3  # on connection fail (i.e. 0 bytes during resuming)
@@ -38,14 +54,40 @@ class DownloaderOptions:
     use_validator: bool = True
     validator_chunk_size: int = 10 * 1024 * 1024
     validate_retry: int = 1
-    retry_delay: int = 1  # delay between retries
+    ts_validation: bool = True  # check MPEG-TS structure of segments downloaded without ETag
+    retry_delay: int = 1  # delay between retries (base of exponential backoff with jitter)
+    retry_delay_max: int = 30  # max delay between retries
+    breaker_threshold: int = 5  # consecutive failures of a host to pause all downloads from it, 0 to disable
+    breaker_cooldown: int = 10  # sec, pause before probing an unhealthy host again
 
     queue_size: int = 3
+    hedge: bool = True  # idle workers duplicate slow downloads at the tail of the queue, first finisher wins
+    hedge_after: float = 5  # sec, min running time of a download before it is hedged
+    hedge_factor: float = 3  # hedge downloads running longer than hedge_factor * median task time
     progress_bar_ascii: typing.Any = True if os.name == 'nt' else None
 
     hide_progress_bar: bool = False
     no_output: bool = False
 
+    segment_store: str = ''  # shared segment cache dir, empty to disable
+    segment_store_max_size: int = 0  # bytes, 0 = unlimited
+    decrypt_segments: bool = False  # decrypt AES-128 HLS segments while downloading (new projects only)
+    preflight: str = 'probe'  # size estimate before download: 'probe' (HEAD) / 'playlist' (bitrate) / '' (off)
+    min_free_space: int = 512 * 1024 * 1024  # bytes to keep free on disk after download
+    remux_jobs: int = 0  # parallel MP4 conversions, 0 = by CPU count
+    fast_concat: bool = True  # feed segments to ffmpeg as one MPEG-TS stream instead of reading the playlist
+    variant_policy: str = 'best'  # default variant: 'best' / 'budget' (within time_budget) / 'smallest' (>= min_height)
+    time_budget: int = 0  # sec to download one stream, for variant_policy 'budget', 0 = no limit
+    min_height: int = 0  # lowest resolution (height), for variant_policy 'smallest'
+    probe_segments: int = 2  # segments per variant downloaded to measure the link
+    probe_cache_ttl: int = 6 * 3600  # sec to reuse link measurements of a CDN host
+
+    telemetry_log: str = ''  # JSON lines file for per-attempt events, empty to disable
+    telemetry_port: int = 0  # serve prometheus text on 127.0.0.1:port, 0 to disable
+
+    profile: str = ''  # '' / 'spans' / 'sampling', env COOKPAD_PROFILE overrides
+    profile_dir: str = 'profiles'
+
 
 class DownloadStatus(Enum):
     IDLE = 0
@@ -56,7 +98,12 @@ class DownloadStatus(Enum):
 
 class SingleDownloader:
     def __init__(self, url: str, out_file: typing.Union[str, typing.BinaryIO], options: DownloaderOptions = None,
-                 callback=None, session=None):
+                 callback=None, session=None, telemetry: typing.Optional[telemetry_.Telemetry] = None,
+                 breakers: typing.Optional[backoff.BreakerRegistry] = None,
+                 proxies: typing.Optional[typing.Dict[str, str]] = None,
+                 claim: typing.Optional[typing.Callable[[], bool]] = None,
+                 post_process: typing.Optional[typing.Callable[[str], typing.Optional[str]]] = None,
+                 is_ts: bool = False):
         self.url = url
         self.out_file = out_file
         self.options = options or DownloaderOptions()
@@ -67,8 +114,19 @@ class SingleDownloader:
         self.status_string = 'Idle'
         self.size_dl = 0
         self.size_all = -1
+        self.response_headers = {}
+        self.retries = 0  # counted retries, over all attempts
+        self.reconnects = 0  # reconnects due to min_rate
         self.callback = callback
         self.session = session or requests.Session()
+        self.telemetry = telemetry
+        self.breakers = breakers
+        self.proxies = self.options.proxies if proxies is None else proxies
+        self.claim = claim  # called before moving temp file to out_file, False = another download won, discard
+        self.post_process = post_process  # called with temp filename before moving, return etag of new content
+        self.content_etag: typing.Optional[str] = None
+        self.is_ts = is_ts  # out_file is a clear MPEG-TS segment, validated with ts_validator
+        self._response: typing.Optional[requests.Response] = None
 
     def start_threaded(self):
         if self._status not in (DownloadStatus.IDLE, DownloadStatus.FAILED):
@@ -79,6 +137,17 @@ class SingleDownloader:
         self.callback and self.callback(self)
         self._thread.start()
 
+    def cancel(self):
+        # stop from another thread, also aborts a blocked read
+        self.request_stop = True
+        r = self._response
+        sock = getattr(getattr(getattr(r, 'raw', None), '_connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def status(self) -> DownloadStatus:
         if self._status == DownloadStatus.RUNNING:
             if not self._thread.is_alive():
@@ -97,13 +166,26 @@ class SingleDownloader:
                 temp_fn = self.out_file + self.options.temp_suffix
                 with open(temp_fn, 'w+b') as f:
                     ok = self._download_temp_file(f)
+                if ok and self.post_process is not None:
+                    self.status_string = 'Processing'
+                    self.callback and self.callback(self)
+                    try:
+                        with profiling.span('post_process'):
+                            self.content_etag = self.post_process(temp_fn)
+                    except Exception as e:
+                        ok = False
+                        self.status_string = f'Processing failed: {e!r}'
             else:
                 ok = self._download_temp_file(self.out_file)
+            if ok and self.claim is not None and not self.claim():
+                ok = False
+                self.status_string = 'Cancelled (duplicate finished first)'
             if ok:
                 if use_temp:
                     self.status_string = 'Moving file'
                     self.callback and self.callback(self)
-                    os.replace(temp_fn, self.out_file)
+                    with profiling.span('move_file'):
+                        os.replace(temp_fn, self.out_file)
                 self.status_string = 'Done'
                 self._status = DownloadStatus.DONE
             else:
@@ -119,10 +201,15 @@ class SingleDownloader:
     def _download_temp_file(self, f):
         validate_count = 0
         retry_count = 0
+        retry_delay = self.options.retry_delay
         while True:
+            if self.request_stop:
+                self.status_string = 'Cancelled'
+                return False
             self.update_status_string(retry_count, validate_count)
 
-            done, error, headers = self._download_piece(f)
+            with profiling.span('download_piece'):
+                done, error, headers = self._download_piece(f)
             if not done:
                 if error <= 0:
                     # simply retry
@@ -133,20 +220,33 @@ class SingleDownloader:
                         f.truncate(0)
                     # retry with limit
                     retry_count += 1
+                    self.retries += 1
                     if retry_count > self.options.retry:
                         error_type = 'soft' if error <= 1 else 'hard'
                         self.status_string = f'Retry count exceed ({error_type} error)'
                         return False
                     self.update_status_string(retry_count, validate_count)
-                    time.sleep(self.options.retry_delay)
+                    retry_delay = backoff.decorrelated_jitter(
+                        retry_delay, self.options.retry_delay, self.options.retry_delay_max)
+                    retry_after = backoff.parse_retry_after(headers.get('Retry-After'))
+                    if retry_after is not None:
+                        retry_delay = max(retry_delay, min(retry_after, self.options.retry_delay_max))
+                    time.sleep(retry_delay)
             else:
                 retry_count = 0
                 # validate
                 if self.options.use_validator:
-                    valid = validator(f, headers, self.options.validator_chunk_size)
+                    t = time.monotonic()
+                    with profiling.span('validate'):
+                        check = ts_validator if self.is_ts and self.options.ts_validation else validator
+                        valid = check(f, headers, self.options.validator_chunk_size)
+                    if self.telemetry is not None:
+                        self.telemetry.event('validate', url=self.url, host=self.telemetry.host_of(self.url),
+                                             valid=bool(valid), duration=time.monotonic() - t)
                 else:
                     valid = True
                 if valid:
+                    self.response_headers = headers
                     return True
                 validate_count += 1
                 f.truncate(0)
@@ -173,6 +273,17 @@ class SingleDownloader:
         downloaded_bytes = 0
         error = 0
         response_headers = {}
+        start_len = 0
+        status_code = None
+        ttfb = None
+        result = 'error'
+        t_start = time.monotonic()
+        breaker = self.breakers.get(self.url) if self.breakers is not None else None
+        if breaker is not None:
+            # wait while host is unhealthy, without using up retries
+            self.status_string = 'Waiting (host unhealthy)' if breaker.state != breaker.CLOSED else self.status_string
+            if not breaker.acquire(lambda: self.request_stop):
+                return False, 0, response_headers
         try:
             headers = {'User-Agent': None}
             headers.update(self.options.headers)
@@ -188,15 +299,28 @@ class SingleDownloader:
                 headers=headers,
                 cookies=self.options.cookies,
                 timeout=(self.options.timeout_connect, self.options.timeout_read),
-                proxies=self.options.proxies,
+                proxies=self.proxies,
                 stream=True,
             )
+            self._response = r
             response_headers = r.headers
+            status_code = r.status_code
+            ttfb = r.elapsed.total_seconds()
+            if breaker is not None:
+                if status_code >= 500 or status_code == 429:
+                    breaker.record_failure(backoff.parse_retry_after(response_headers.get('Retry-After')))
+                else:
+                    breaker.record_success()
             try:
                 r.raise_for_status()
             except requests.exceptions.HTTPError:
                 error = 2
                 raise
+            if start_len > 0 and r.status_code != 206:
+                # server ignored Range, restart from beginning
+                f.seek(0, io.SEEK_SET)
+                f.truncate(0)
+                start_len = 0
             # print('headers:')
             # print(response_headers)
             self._can_resume = response_headers.get('Accept-Ranges') == 'bytes'
@@ -209,6 +333,9 @@ class SingleDownloader:
             t = time.time()
             download_finished = False
             for data in r.iter_content(self.options.chunk_size):
+                if self.request_stop:
+                    result = 'stopped'
+                    break
                 # print(len(data))
                 downloaded_bytes += len(data)
                 self.size_dl = start_len + downloaded_bytes
@@ -220,36 +347,236 @@ class SingleDownloader:
                 t = t1
                 if rate < self.options.min_rate:
                     # print('rate too slow')
+                    self.reconnects += 1
+                    result = 'min_rate'
                     break
             else:
                 download_finished = True
+            self._response = None
             done = (total_bytes < 0 and download_finished) or downloaded_bytes == total_bytes
+            if done:
+                result = 'done'
+            elif download_finished:
+                result = 'incomplete'
         except requests.exceptions.RequestException:
+            if breaker is not None and status_code is None:
+                breaker.record_failure()  # can not connect
             if downloaded_bytes <= 0:
                 # only set error for empty payloads
                 error = 1 if error <= 1 else error
+        if self.telemetry is not None:
+            duration = time.monotonic() - t_start
+            self.telemetry.event(
+                'attempt', url=self.url, host=self.telemetry.host_of(self.url), status=status_code,
+                result=result, error=error, offset=start_len, bytes=downloaded_bytes, ttfb=ttfb,
+                duration=duration, rate=downloaded_bytes / duration if duration > 0 else None)
         return done, error, response_headers
 
 
+class TaskScheduler:
+    # priority queue of tasks (id url filename info), earliest playback position first
+    # position(id): segment position of the task in its rendition, same position of several renditions by id
+    # seek(position) moves tasks from position onwards to the front, earlier ones are done after them
+    def __init__(self, position=None):
+        self._position = position or (lambda i: i)
+        self._heap = []
+        self._seek = 0
+        self._cond = threading.Condition()
+
+    def _key(self, i):
+        position = self._position(i)
+        return (0 if position >= self._seek else 1), position, i
+
+    def put(self, task):
+        with self._cond:
+            heapq.heappush(self._heap, (self._key(task[0]), task))
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._heap, timeout):
+                raise queue.Empty
+            return heapq.heappop(self._heap)[1]
+
+    def seek(self, position):
+        with self._cond:
+            self._seek = position
+            self._heap = [(self._key(task[0]), task) for key, task in self._heap]
+            heapq.heapify(self._heap)
+
+    def empty(self):
+        with self._cond:
+            return not self._heap
+
+
+class DownloadContext:
+    """
+    State shared by consecutive DownloadQueue runs (HTTP connection pools, segment store, breakers, proxies,
+    telemetry), so a long running process keeps them warm. Use with one running queue at a time.
+    """
+
+    def __init__(self, options: DownloaderOptions):
+        self.options = options
+        self.store = segment_store.get_store(options)
+        self.breakers = backoff.get_breakers(options)
+        self.proxy_pool = proxy_pool.get_proxy_pool(options)
+        self.telemetry = telemetry_.get_telemetry(options)
+        self._sessions: typing.List[requests.Session] = []
+        self._lock = threading.Lock()
+
+    def session(self, index) -> requests.Session:
+        # one session per worker thread index
+        with self._lock:
+            while len(self._sessions) <= index:
+                self._sessions.append(requests.Session())
+            return self._sessions[index]
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+
+class _TaskState:
+    # one task in flight, may have several (hedged) downloads
+    def __init__(self, url, filename, desc):
+        self.url = url
+        self.filename = filename
+        self.desc = desc
+        self.start = time.monotonic()
+        self.downloads: typing.List[SingleDownloader] = []
+        self.running = 0
+        self.hedged = False
+        self.claimed = False
+        self.finished = False
+
+
 class DownloadQueue:
-    def __init__(self, tasks, options: DownloaderOptions = None):
+    def __init__(self, tasks, options: DownloaderOptions = None,
+                 telemetry: typing.Optional[telemetry_.Telemetry] = None,
+                 callback: typing.Optional[typing.Callable[['DownloadQueue'], None]] = None,
+                 context: typing.Optional[DownloadContext] = None,
+                 post_process: typing.Optional[typing.Callable[[str, str], typing.Optional[str]]] = None,
+                 ts_files: typing.Optional[typing.Collection[str]] = None,
+                 tracks: typing.Optional[typing.Dict[str, typing.List[str]]] = None):
         self.tasks: typing.List[typing.Tuple[str, str, str]] = tasks
         self.results: typing.List[typing.Tuple[bool, str]] = []
+        self.etags: typing.Dict[int, typing.Optional[str]] = {}  # etag of finished tasks, for later verification
+        self.durations: typing.Dict[int, float] = {}  # wall time of each task (sec)
         self.options = options
         self.running = False
-        self.task_queue = queue.SimpleQueue()  # id url filename info
+        self.stopped = False
+        self.finished_count = 0
+        self.total_bytes = 0  # estimate of all tasks (e.g. preflight.estimate), for eta()
+        self.bytes_done = 0  # size of finished tasks
+        self._t_start = time.monotonic()
+        self.callback = callback  # called (in polling thread) after every finished task
+        self.context = context
+        # (url, temp filename) -> etag, with changes(url) -> bool, e.g. hls_keys.Decryptor
+        self.post_process = post_process
+        self.ts_files = ts_files or ()  # filenames of clear MPEG-TS segments, see SingleDownloader.is_ts
+        # {rendition: full filenames of its segments in playback order}, see project.playback_tracks
+        # None: tasks are one track in list order
+        self.tracks = tracks
+        self._positions = self._task_positions()  # task id -> (track, segment position), None for e.g. assets
+        self.task_queue = TaskScheduler(self._position_of)  # id url filename info
+        self.prefix_done = 0  # segments on disk from the start of every track (playable watermark)
+        self._done: typing.Dict[str, typing.List[bool]] = {}
+        self._prefix: typing.Dict[str, int] = {}
         self.result_queue = queue.SimpleQueue()  # is_message? id success message
+        self._in_flight: typing.Dict[int, _TaskState] = {}
+        self._lock = threading.Lock()
+        if context is not None:
+            self.store = context.store
+            self.breakers = context.breakers
+            self.proxy_pool = context.proxy_pool
+            self._own_telemetry = False
+            self.telemetry = telemetry or context.telemetry
+        else:
+            self.store = segment_store.get_store(self.options)
+            self.breakers = backoff.get_breakers(self.options)
+            self.proxy_pool = proxy_pool.get_proxy_pool(self.options)
+            self._own_telemetry = telemetry is None
+            self.telemetry = telemetry or telemetry_.get_telemetry(self.options)
 
         if self.options.no_output or tqdm is None:
             self.options.hide_progress_bar = True
 
+    def seek(self, position):
+        # download segments from position onwards first (e.g. start offset of the output)
+        self.task_queue.seek(position)
+
+    def seek_time(self, offset, segment_durations):
+        # offset (sec) -> segment position by cumulative segment durations (#EXTINF)
+        ends = list(itertools.accumulate(segment_durations))
+        self.seek(min(bisect.bisect_right(ends, offset), max(0, len(ends) - 1)))
+
+    def _task_positions(self) -> list:
+        if self.tracks is None:
+            return [('', i) for i in range(len(self.tasks))]
+        where = {filename: (track, n) for track, files in self.tracks.items() for n, filename in enumerate(files)}
+        return [where.get(filename) for url, filename, info in self.tasks]
+
+    def _position_of(self, i):
+        position = self._positions[i]
+        return position[1] if position is not None else math.inf  # after all segments
+
+    def _reset_prefix(self):
+        # segments already on disk count as done
+        if self.tracks is None:
+            self._done = {'': [False] * len(self.tasks)}
+        else:
+            self._done = {track: [os.access(filename, os.F_OK) for filename in files]
+                          for track, files in self.tracks.items()}
+        self._prefix = dict.fromkeys(self._done, 0)
+        for track in self._done:
+            self._advance_prefix(track)
+
+    def _advance_prefix(self, track, n=None):
+        done = self._done[track]
+        if n is not None:
+            done[n] = True
+        prefix = self._prefix[track]
+        while prefix < len(done) and done[prefix]:
+            prefix += 1
+        self._prefix[track] = prefix
+        self.prefix_done = min(self._prefix.values())
+
+    def eta(self) -> typing.Optional[float]:
+        # sec left by average rate so far, None if unknown
+        if self.total_bytes <= 0 or self.bytes_done <= 0:
+            return None
+        rate = self.bytes_done / max(time.monotonic() - self._t_start, 0.001)
+        return max(0, self.total_bytes - self.bytes_done) / rate
+
+    def stop(self):
+        # from another thread: cancel running downloads, run() returns with unfinished tasks failed
+        self.stopped = True
+        self.running = False
+        with self._lock:
+            for state in self._in_flight.values():
+                for dl in state.downloads:
+                    dl.cancel()
+        self.result_queue.put((True, -1, None, None))  # wake up polling
+
+    def _session(self, index):
+        if self.context is not None:
+            return self.context.session(index)
+        return requests.Session()
+
     def run(self):
-        self.task_queue.empty()
         self.result_queue.empty()
+        self._reset_prefix()
+        self.finished_count = 0
+        self.bytes_done = 0
+        self._t_start = time.monotonic()
         threads = []
         results = []
         try:
-            self.running = True
+            self.running = not self.stopped
             if self.options.hide_progress_bar:
                 target = self.download_thread_no_bar
             else:
@@ -276,21 +603,34 @@ class DownloadQueue:
             for thread in threads:
                 thread.join()
             self.results = results
+            if self._own_telemetry and self.telemetry is not None:
+                self.telemetry.close()
 
     def _poll_download_tasks(self, bar=None):
         finish_count = 0
-        results = [(False, '') for i in range(len(self.tasks))]
+        results = [(False, 'Cancelled') for i in range(len(self.tasks))]
         try:
-            while finish_count < len(self.tasks):
+            while finish_count < len(self.tasks) and not self.stopped:
                 is_message, i, success, info = self.result_queue.get()
+                if self.stopped:
+                    break
                 if is_message:
                     if bar is None:
                         print(info)
                 else:
                     results[i] = (success, info)
+                    if success and self._positions[i] is not None:
+                        self._advance_prefix(*self._positions[i])
                     if bar is not None:
+                        eta = self.eta()
+                        bar.set_postfix_str(f'playable {self.prefix_done}' +
+                                            (f', ETA {int(eta // 3600)}:{int(eta // 60 % 60):02d}:{int(eta % 60):02d}'
+                                             if eta is not None else ''),
+                                            refresh=False)
                         bar.update(1)
                     finish_count += 1
+                    self.finished_count = finish_count
+                    self.callback and self.callback(self)
         except KeyboardInterrupt:
             msg = 'Please wait for running downloads to finish...'
             if bar is not None:
@@ -315,25 +655,19 @@ class DownloadQueue:
                     bar.set_postfix_str(status)
                 bar.update(delta)
 
-            session = requests.Session()
+            session = self._session(index)
             while self.running:
-                try:
-                    i, url, filename, desc = self.task_queue.get(timeout=1)
-                except queue.Empty:
+                job = self._next_job()
+                if job is None:
                     continue
-                dl = SingleDownloader(url, filename, self.options, callback, session=session)
+                i, url, filename, desc, hedge_of = job
                 downloaded = 0
                 status = ''
                 bar.reset()
                 bar.set_description(desc)
-                try:
-                    dl.start()
-                    success = dl.status() == DownloadStatus.DONE
-                    info = dl.status_string
-                except Exception as e:
-                    success = False
-                    info = traceback.format_exc()
-                self.result_queue.put((False, i, success, info))
+                result = self._run_task(i, url, filename, desc, callback, session, hedge_of)
+                if result is not None:
+                    self.result_queue.put((False, i, *result))
 
     def download_thread_no_bar(self, index):
         def callback(dl: SingleDownloader):
@@ -344,22 +678,145 @@ class DownloadQueue:
                     self.result_queue.put((True, i, None, f'{desc}: {status}'))
                     # print(f'{desc}: {status}')
 
-        session = requests.Session()
+        session = self._session(index)
         while self.running:
-            try:
-                i, url, filename, desc = self.task_queue.get(timeout=1)
-            except queue.Empty:
+            job = self._next_job()
+            if job is None:
                 continue
-            dl = SingleDownloader(url, filename, self.options, callback, session=session)
+            i, url, filename, desc, hedge_of = job
             status = ''
-            try:
+            result = self._run_task(i, url, filename, desc, callback, session, hedge_of)
+            if result is not None:
+                self.result_queue.put((False, i, *result))
+
+    def _next_job(self):
+        # return: (id, url, filename, info, state of the hedged task or None) or None
+        try:
+            i, url, filename, desc = self.task_queue.get(timeout=1)
+            return i, url, filename, desc, None
+        except queue.Empty:
+            pass
+        if not self.options.hedge:
+            return None
+        return self._pick_hedge()
+
+    def _pick_hedge(self):
+        # queue drained: duplicate the slowest in-flight download
+        with self._lock:
+            if not self.durations:
+                return None
+            median = statistics.median(self.durations.values())
+            threshold = max(self.options.hedge_after, self.options.hedge_factor * median)
+            now = time.monotonic()
+            candidates = [
+                (now - state.start, i, state) for i, state in self._in_flight.items()
+                if not state.hedged and not state.finished and state.running == 1 and isinstance(state.filename, str)
+            ]
+            if not candidates:
+                return None
+            elapsed, i, state = max(candidates, key=lambda x: x[0])
+            if elapsed < threshold:
+                return None
+            state.hedged = True
+            return i, state.url, state.filename, f'{state.desc} (hedge)', state
+
+    def _run_task(self, i, url, filename, desc, callback, session, hedge_of: typing.Optional[_TaskState] = None):
+        # return: (success, info) to report, None if another download of the same task reports
+        # hedge_of: state picked by _pick_hedge, the primary download may have finished since
+        hedge = hedge_of is not None
+        with self._lock:
+            state = self._in_flight.get(i)
+            if hedge and (state is not hedge_of or state.finished or state.claimed):
+                return None
+            if state is None:
+                state = self._in_flight[i] = _TaskState(url, filename, desc)
+            elif state.finished or state.claimed:
+                return None
+            state.running += 1
+        options = self.options
+        if hedge:
+            # own temp file, the primary download keeps writing its own
+            options = dataclasses.replace(self.options, temp_suffix='.hedge' + self.options.temp_suffix)
+
+        def claim():
+            with self._lock:
+                if state.claimed:
+                    return False
+                state.claimed = True
+                for other in state.downloads:
+                    if other is not dl:
+                        other.cancel()
+                return True
+
+        # store holds files as downloaded, not post processed ones
+        use_store = (self.store is not None and isinstance(filename, str)
+                     and (self.post_process is None or not self.post_process.changes(url)))
+        t = time.monotonic()
+        dl = None
+        success = False
+        info = ''
+        from_store = False
+        proxy = None
+        done_size = 0
+        try:
+            entry = self.store.materialize(url, filename) if use_store and not hedge else None
+            if entry is not None:
+                self.etags[i] = entry['etag']
+                done_size = os.path.getsize(filename)
+                success = from_store = True
+                info = 'Done (from store)'
+            else:
+                proxy = self.proxy_pool.acquire() if self.proxy_pool is not None else None
+                dl = SingleDownloader(url, filename, options, callback, session=session, telemetry=self.telemetry,
+                                      breakers=self.breakers, proxies=proxy and proxy.proxies,
+                                      claim=claim if isinstance(filename, str) else None,
+                                      post_process=self.post_process and (lambda path: self.post_process(url, path)),
+                                      is_ts=filename in self.ts_files)
+                with self._lock:
+                    state.downloads.append(dl)
                 dl.start()
                 success = dl.status() == DownloadStatus.DONE
                 info = dl.status_string
-            except Exception as e:
-                success = False
-                info = traceback.format_exc()
-            self.result_queue.put((False, i, success, info))
+                if success:
+                    self.etags[i] = dl.content_etag or dl.response_headers.get('etag', None)
+                    done_size = dl.size_dl
+                if success and use_store:
+                    try:
+                        self.store.add(url, filename, dl.response_headers)
+                    except OSError:
+                        pass  # cache failure should not fail the download
+                if hedge and success:
+                    info += ' (hedge won)'
+        except Exception as e:
+            success = False
+            info = traceback.format_exc()
+        finally:
+            duration = time.monotonic() - t
+            if proxy is not None:
+                # hedge losers and stopped queues are cancelled by us, not failures of the proxy
+                cancelled = dl is not None and (dl.request_stop or state.claimed or self.stopped)
+                self.proxy_pool.release(proxy, dl.size_dl if dl is not None else 0, duration, success, cancelled)
+            if self.telemetry is not None:
+                size = dl.size_dl if dl is not None else None
+                self.telemetry.event(
+                    'task', url=url, host=self.telemetry.host_of(url), success=success, from_store=from_store,
+                    hedge=hedge, duration=duration, bytes=size, rate=size / duration if size and duration > 0 else None,
+                    retries=dl.retries if dl is not None else 0, reconnects=dl.reconnects if dl is not None else 0)
+        return self._finish_task(i, state, success, info, done_size)
+
+    def _finish_task(self, i, state, success, info, size=0):
+        with self._lock:
+            state.running -= 1
+            if state.finished:
+                return None
+            if not success and state.running > 0:
+                return None  # another download of this task is still running
+            state.finished = True
+            del self._in_flight[i]
+            self.durations[i] = time.monotonic() - state.start
+            if success:
+                self.bytes_done += size
+            return success, info
 
 
 def get_downloader_options(show_exceptions=False):
@@ -408,6 +865,102 @@ def _test_queue():
     dq.run()
 
 
+def _test_hedge_race():
+    # primary finishes between _pick_hedge and the start of the hedge: nothing is downloaded or reported again
+    opt = DownloaderOptions(hide_progress_bar=True, no_output=True, hedge_after=0)
+    dq = DownloadQueue([('http://127.0.0.1:9/a.ts', 'test/a.ts', 'a')], opt)
+    dq.durations[1] = 0.1
+    state = dq._in_flight[0] = _TaskState('http://127.0.0.1:9/a.ts', 'test/a.ts', 'a')
+    state.running = 1
+    state.start -= 10
+    job = dq._pick_hedge()
+    assert job is not None and job[4] is state
+    assert dq._finish_task(0, state, True, 'Done') == (True, 'Done')
+    i, url, filename, desc, hedge_of = job
+    assert dq._run_task(i, url, filename, desc, None, None, hedge_of) is None
+    assert not dq._in_flight and not state.downloads
+    print('check ok')
+
+
+def _test_playback():
+    # two renditions of 4 segments, a/0 a/1 b/0 already downloaded, plus one asset
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        tracks = {r: [os.path.join(d, r, f'{n}.ts') for n in range(4)] for r in 'ab'}
+        for r in 'ab':
+            os.makedirs(os.path.join(d, r))
+        for filename in tracks['a'][:2] + tracks['b'][:1]:
+            open(filename, 'wb').close()
+        tasks = [(f'http://x/{filename}', filename, '')
+                 for n in range(4) for r in 'ab' for filename in [tracks[r][n]] if not os.access(filename, os.F_OK)]
+        tasks.insert(0, ('http://x/asset.jpg', os.path.join(d, 'asset.jpg'), 'asset'))
+        dq = DownloadQueue(tasks, DownloaderOptions(hide_progress_bar=True, no_output=True), tracks=tracks)
+        dq._reset_prefix()
+        assert dq.prefix_done == 1  # b/1 missing
+
+        def order():
+            for task in [(i, *task) for i, task in enumerate(tasks)]:
+                dq.task_queue.put(task)
+            result = []
+            while not dq.task_queue.empty():
+                result.append(os.path.relpath(dq.task_queue.get()[2], d))
+            return result
+
+        assert order() == ['b/1.ts', 'a/2.ts', 'b/2.ts', 'a/3.ts', 'b/3.ts', 'asset.jpg']
+        dq.seek_time(25, [10, 10, 10, 10])
+        assert order() == ['a/2.ts', 'b/2.ts', 'a/3.ts', 'b/3.ts', 'asset.jpg', 'b/1.ts']
+
+        index = {os.path.relpath(filename, d): i for i, (url, filename, info) in enumerate(tasks)}
+
+        def finish(name):
+            # as _poll_download_tasks on success
+            if dq._positions[index[name]] is not None:
+                dq._advance_prefix(*dq._positions[index[name]])
+            return dq.prefix_done
+
+        finished = ['a/2.ts', 'asset.jpg', 'b/2.ts', 'b/1.ts', 'b/3.ts', 'a/3.ts']
+        assert [finish(name) for name in finished] == [1, 1, 1, 3, 3, 4]
+    print('check ok')
+
+
+def _test_store_post_process():
+    # only files changed by post_process bypass the segment store
+    import tempfile
+    import standin_server
+
+    class Decrypted:
+        def __init__(self, urls):
+            self.urls = urls
+
+        def changes(self, url):
+            return url in self.urls
+
+        def __call__(self, url, filename):
+            if url not in self.urls:
+                return None
+            with open(filename, 'r+b') as f:
+                f.write(b'decrypted')
+            return None
+
+    server = standin_server.StandinServer(standin_server.ServerOptions(segment_count=2, variants=[100 * 1024]))
+    server.start()
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            urls = [f'{server.url}/v0/seg_{i:05d}.ts' for i in range(2)]
+            opt = DownloaderOptions(hide_progress_bar=True, no_output=True, segment_store=os.path.join(d, 'store'))
+            tasks = [(url, os.path.join(d, f'{i}.ts'), str(i)) for i, url in enumerate(urls)]
+            dq = DownloadQueue(tasks, opt, post_process=Decrypted(urls[:1]))
+            dq.run()
+            assert all(success for success, info in dq.results), dq.results
+            assert dq.store.lookup(urls[0]) is None and dq.store.lookup(urls[1]) is not None
+    finally:
+        server.stop()
+    print('check ok')
+
+
 if __name__ == '__main__':
+    _test_hedge_race()
+    _test_store_post_process()
+    _test_playback()
     _test_single()
     _test_queue()
@@ -0,0 +1,177 @@
+"""
+Encrypted HLS (#EXT-X-KEY): keys are downloaded once per project into keys/ (one file per key URI),
+and the patched playlist points at the local copies, so converting to MP4 never needs the network.
+
+With DownloaderOptions.decrypt_segments (set before creating the project), AES-128 segments are decrypted
+right after download instead, before the temp file is moved in place; the patched playlist then has no keys.
+The recorded etag of a decrypted segment is the hash of the clear file; verify compares decrypted segments only
+with that record (project.decrypted_files), the server ETag is of the encrypted bytes.
+"""
+import hashlib
+import io
+import os
+import posixpath
+import typing
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ModuleNotFoundError:
+    Cipher = None
+
+import download
+from s3_etag import s3_etag
+
+KEYS_DIR = 'keys'
+
+
+def can_decrypt():
+    return Cipher is not None
+
+
+def key_filename(uri):
+    # relative to project root, same uri -> same file
+    return posixpath.join(KEYS_DIR, hashlib.sha1(uri.encode('utf-8')).hexdigest()[:20] + '.key')
+
+
+def _iv_hex(iv):
+    # '0x...' attribute -> 32 hex digits
+    iv = iv[2:] if iv[:2] in ('0x', '0X') else iv
+    return iv.rjust(32, '0')
+
+
+def discover(m3u8_obj) -> typing.Tuple[typing.List[dict], typing.List[typing.Optional[list]]]:
+    """
+    Return (keys, segment_keys):
+      keys: [{'uri', 'method', 'file'}], one per distinct key uri
+      segment_keys: per segment [key index, iv hex] or None (not encrypted),
+        iv is the IV attribute, or the media sequence number of the segment if not given
+    """
+    keys = []
+    index = {}
+    segment_keys = []
+    media_sequence = m3u8_obj.media_sequence or 0
+    for n, seg in enumerate(m3u8_obj.segments):
+        key = seg.key
+        if key is None or key.method == 'NONE' or not key.uri:
+            segment_keys.append(None)
+            continue
+        uri = key.absolute_uri
+        if uri not in index:
+            index[uri] = len(keys)
+            keys.append({'uri': uri, 'method': key.method, 'file': key_filename(uri)})
+        iv = _iv_hex(key.iv) if key.iv else f'{media_sequence + n:032x}'
+        segment_keys.append([index[uri], iv])
+    return keys, segment_keys
+
+
+def fetch_keys(keys, options: download.DownloaderOptions) -> typing.Dict[str, bytes]:
+    # file -> key bytes
+    result = {}
+    for key in keys:
+        if key['file'] in result:
+            continue
+        with io.BytesIO() as f:
+            dl = download.SingleDownloader(key['uri'], f, options)
+            dl.start()
+            assert dl.status() == download.DownloadStatus.DONE, f'Can not download key {key["uri"]}: {dl.status_string}'
+            data = f.getvalue()
+        if key['method'] == 'AES-128' and len(data) != 16:
+            raise ValueError(f'AES-128 key should be 16 bytes, got {len(data)} ({key["uri"]})')
+        result[key['file']] = data
+    return result
+
+
+def write_keys(dirname, key_data):
+    # existing files are kept, keys are shared by all renditions of the project
+    os.makedirs(os.path.join(dirname, KEYS_DIR), exist_ok=True)
+    for filename, data in key_data.items():
+        filename = os.path.join(dirname, filename)
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as f:
+                f.write(data)
+
+
+def patch_playlist(m3u8_obj, rendition):
+    # point keys at local files (relative to rendition dir), drop keys of segments decrypted at download
+    subdir = rendition.get('subdir', '')
+    local = {}  # id(key) -> local uri, key objects are shared by segments
+    for seg in m3u8_obj.segments:
+        key = seg.key
+        if key is None or key.method == 'NONE' or not key.uri:
+            continue
+        if rendition.get('decrypt') and key.method == 'AES-128':
+            seg.key = None
+        elif id(key) not in local:
+            file = key_filename(key.absolute_uri)
+            local[id(key)] = posixpath.relpath(file, subdir) if subdir else file
+    for seg in m3u8_obj.segments:
+        if seg.key is not None and id(seg.key) in local:
+            seg.key.uri = local[id(seg.key)]
+
+
+def decrypt_file(filename, key, iv, chunk_size):
+    # AES-128-CBC with PKCS7 padding, in place (through a temp file), chunk_size bytes at a time
+    size = os.path.getsize(filename)
+    if size == 0 or size % 16 != 0:
+        raise ValueError(f'encrypted size should be a multiple of 16, got {size}')
+    chunk_size = max(16, chunk_size // 16 * 16)
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    temp = filename + '.decrypt'
+    try:
+        with open(filename, 'rb') as src, open(temp, 'wb') as dst:
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                dst.write(unpadder.update(decryptor.update(data)))
+            dst.write(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+        os.replace(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+class Decryptor:
+    """
+    DownloadQueue post_process of a project: decrypt segments of renditions created with decrypt_segments.
+    False if there is nothing to decrypt.
+    """
+
+    def __init__(self, dirname, renditions, chunk_size=10 * 1024 * 1024):
+        self.chunk_size = chunk_size
+        self._segments: typing.Dict[str, typing.Tuple[str, bytes]] = {}  # url -> (key file, iv)
+        self._keys: typing.Dict[str, bytes] = {}
+        for rendition in renditions:
+            if not rendition.get('decrypt'):
+                continue
+            keys = rendition['keys']
+            for (url, filename, info), segment_key in zip(rendition['download_list'], rendition['segment_keys']):
+                if segment_key is not None and keys[segment_key[0]]['method'] == 'AES-128':
+                    key_file = os.path.join(dirname, keys[segment_key[0]]['file'])
+                    self._segments[url] = (key_file, bytes.fromhex(segment_key[1]))
+
+    def __bool__(self):
+        return bool(self._segments)
+
+    def changes(self, url) -> bool:
+        # True if the file of url is decrypted after download
+        return url in self._segments
+
+    def _key(self, key_file):
+        key = self._keys.get(key_file)
+        if key is None:
+            with open(key_file, 'rb') as f:
+                key = self._keys[key_file] = f.read()
+        return key
+
+    def __call__(self, url, filename) -> typing.Optional[str]:
+        # return etag of the decrypted file, None if url is not encrypted
+        entry = self._segments.get(url)
+        if entry is None:
+            return None
+        key_file, iv = entry
+        decrypt_file(filename, self._key(key_file), iv, self.chunk_size)
+        with open(filename, 'rb') as f:
+            return s3_etag(f, self.chunk_size)
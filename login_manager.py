@@ -2,9 +2,13 @@ import time
 import json
 import hmac
 import hashlib
+import re
+import threading
 import typing
+from concurrent.futures import Future
 
 import requests
+import requests.adapters
 import urllib.parse
 import cookpad_constants
 
@@ -29,6 +33,17 @@ AUTH_HEADERS = {
 COOKPAD_TV_API_ENDPOINT = 'https://api.natslive.jp/'
 
 
+def _accept_encoding():
+    # br is decoded by urllib3 only if brotli / brotlicffi is installed
+    for module in ('brotli', 'brotlicffi'):
+        try:
+            __import__(module)
+            return 'br, gzip, deflate'
+        except ModuleNotFoundError:
+            pass
+    return 'gzip, deflate'
+
+
 class NotLoggedInError(ValueError):
     def __str__(self):
         return 'Not logged in!'
@@ -59,6 +74,57 @@ class LoginManager:
 
         self.modified = False
 
+        # not saved (dump_json skips _ names)
+        self._session: typing.Optional[requests.Session] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.RLock()
+        self._in_flight: typing.Dict[typing.Tuple[str, str], Future] = {}  # identical GET running -> its result
+        self._payload: typing.Dict[str, typing.List[float]] = {}  # endpoint -> [requests, wire, body, json sec]
+
+    @staticmethod
+    def _endpoint_of(r: requests.Response):
+        # /api/v2/episode_details/123 -> /api/v2/episode_details/{id}
+        return re.sub(r'/\d+(?=/|$)', '/{id}', urllib.parse.urlsplit(r.url).path)
+
+    def _account(self, r: requests.Response):
+        # compressed (wire) and decoded size of a fully read response
+        try:
+            wire = r.raw.tell()
+        except (AttributeError, ValueError):
+            wire = len(r.content)
+        with self._lock:
+            stat = self._payload.setdefault(self._endpoint_of(r), [0, 0, 0, 0.0])
+            stat[0] += 1
+            stat[1] += wire
+            stat[2] += len(r.content)
+
+    def decode_json(self, r: requests.Response):
+        # r.json(), with parse time accounted
+        t = time.perf_counter()
+        j = r.json()
+        elapsed = time.perf_counter() - t
+        with self._lock:
+            self._payload.setdefault(self._endpoint_of(r), [0, 0, 0, 0.0])[3] += elapsed
+        return j
+
+    def payload_stats(self) -> typing.Dict[str, dict]:
+        with self._lock:
+            return {
+                endpoint: {'requests': n, 'wire_bytes': wire, 'body_bytes': body, 'json_sec': sec}
+                for endpoint, (n, wire, body, sec) in self._payload.items()
+            }
+
+    def _get_session(self) -> requests.Session:
+        # pooled keep-alive connections, shared by all threads
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                self._session.headers['Accept-Encoding'] = _accept_encoding()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
     def login(self, username, password, save_password=False) -> None:
         self.modified = True
         self.username = username
@@ -88,6 +154,17 @@ class LoginManager:
     def refresh(self, force=False) -> bool:
         # True: refresh OK
         # False: no need to refresh
+        with self._refresh_lock:
+            return self._refresh(force)
+
+    def _refresh_rejected(self, access_token):
+        # request with access_token got 401, refresh once even if several threads see it
+        with self._refresh_lock:
+            if self.access_token != access_token:
+                return  # already refreshed by another thread
+            self._refresh(force=True)
+
+    def _refresh(self, force):
         if self.refresh_token is None:
             raise NotLoggedInError()
         if not force and time.time() < self.expire_ts:
@@ -109,37 +186,63 @@ class LoginManager:
         if path.startswith('/'):
             path = path[1:]
         url = COOKPAD_TV_API_ENDPOINT + path
+        access_token = self.access_token
         headers = {
             'User-Agent': None,
             'X-COOKPAD-TV-CDID': self._get_cdid(),
-            'X-Authorization': self.access_token,
+            'X-Authorization': access_token,
         }
-        r = requests.post(url, *args, **kwargs, headers=headers)
+        r = self._get_session().post(url, *args, **kwargs, headers=headers)
+        self._account(r)
         try:
             self._api_auth_check(r)
             return r
         except NotLoggedInError:
             if fail_raise: raise
-            self.refresh(force=True)
+            self._refresh_rejected(access_token)
             return self.api_post(path, *args, **kwargs, fail_raise=True)
 
     def api_get(self, path, params=None, fail_raise=False):
+        # identical concurrent calls are sent once, all callers get the same (fully read) response
         if path.startswith('/'):
             path = path[1:]
+        key = (path, json.dumps(params, sort_keys=True))
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            r = self._api_get(path, params, fail_raise)
+            _ = r.content  # pre-fetch content, response is shared
+            future.set_result(r)
+            return r
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _api_get(self, path, params=None, fail_raise=False):
         url = COOKPAD_TV_API_ENDPOINT + path
+        access_token = self.access_token
         headers = {
             'User-Agent': None,
             'X-COOKPAD-TV-CDID': self._get_cdid(),
-            'X-Authorization': self.access_token,
+            'X-Authorization': access_token,
         }
-        r = requests.get(url, params=params, headers=headers)
+        r = self._get_session().get(url, params=params, headers=headers)
+        self._account(r)
         try:
             self._api_auth_check(r)
             return r
         except NotLoggedInError:
             if fail_raise: raise
-            self.refresh(force=True)
-            return self.api_get(path, params, fail_raise=True)
+            self._refresh_rejected(access_token)
+            return self._api_get(path, params, fail_raise=True)
 
     def api_graphql(self, operationName, query, variables=None):
         variables = variables or {}
@@ -162,13 +265,13 @@ class LoginManager:
         return True, result
 
     def dump_json(self) -> str:
-        d = self.__dict__.copy()
+        d = {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
         d.pop('modified', None)
         return json.dumps(d, ensure_ascii=False, separators=(',', ':'))
 
     def load_json(self, data):
         d = json.loads(data)
-        self.__dict__.update((k, v) for k, v in d.items() if k in self.__dict__)
+        self.__dict__.update((k, v) for k, v in d.items() if k in self.__dict__ and not k.startswith('_'))
         self.modified = False
 
     @staticmethod
@@ -0,0 +1,124 @@
+"""
+Pre-flight check before downloading a project: bytes to transfer, and whether they fit on the disk.
+
+Sizes come from HEAD requests (or a 1 byte Range request if HEAD has no length), run with bounded concurrency,
+or from variant bitrate * #EXTINF duration of the local playlists (DownloaderOptions.preflight = 'playlist').
+Files with no size from either are counted at the average size of the others.
+"""
+import concurrent.futures
+import os
+import re
+import shutil
+import threading
+import typing
+from dataclasses import dataclass, field
+
+import m3u8
+import requests
+
+import project as project_
+
+
+@dataclass
+class Estimate:
+    sizes: typing.List[int] = field(default_factory=list)  # per task, bytes
+    probed: int = 0  # tasks with size from server
+    from_playlist: int = 0  # tasks with size from bitrate * duration
+    guessed: int = 0  # tasks counted at the average
+
+    @property
+    def total_bytes(self):
+        return sum(self.sizes)
+
+
+def format_size(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024:
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} B'
+        n /= 1024
+    return f'{n:.2f} TiB'
+
+
+def probe_sizes(urls, options, max_workers=None) -> typing.List[typing.Optional[int]]:
+    # Content-Length of HEAD, or total of Content-Range of a 1 byte GET; None if unknown
+    local = threading.local()
+    sessions = []
+    headers = {'User-Agent': None}
+    headers.update(options.headers)
+    kwargs = dict(cookies=options.cookies, proxies=options.proxies,
+                  timeout=(options.timeout_connect, options.timeout_read), allow_redirects=True)
+
+    def probe(url):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            sessions.append(local.session)
+        try:
+            r = local.session.head(url, headers=headers, **kwargs)
+            if r.status_code == 200 and r.headers.get('Content-Length', '').isdigit():
+                return int(r.headers['Content-Length'])
+            with local.session.get(url, headers=dict(headers, Range='bytes=0-0'), stream=True, **kwargs) as r:
+                m = re.match(r'^bytes \d+-\d+/(\d+)$', r.headers.get('Content-Range', ''))
+                return int(m.group(1)) if r.status_code == 206 and m is not None else None
+        except requests.exceptions.RequestException:
+            return None
+
+    # HEADs are cheap for the server, more in flight than downloads
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or options.queue_size * 4) as ex:
+            return list(ex.map(probe, urls))
+    finally:
+        for session in sessions:
+            session.close()
+
+
+def playlist_sizes(dirname, project) -> typing.Dict[str, int]:
+    # full filename -> bytes, from variant bandwidth of the saved master playlist and segment durations
+    result = {}
+    for rendition in project_.renditions(project):
+        r_dir = project_.rendition_dir(dirname, rendition)
+        if rendition.get('variant_id', -1) <= 0:
+            continue  # not from a master playlist, no bitrate
+        master_file = project_.strip_args(rendition['stream_url'].rsplit('/', maxsplit=1)[1])
+        try:
+            with open(os.path.join(r_dir, master_file), 'r', encoding='utf-8') as f:
+                master = m3u8.loads(f.read())
+            durations = project_.segment_durations(dirname, rendition)
+        except (OSError, ValueError):
+            continue
+        bandwidth = project_.variant_bandwidth(master.playlists[rendition['variant_id'] - 1])
+        for duration, (url, filename, info) in zip(durations, rendition['download_list']):
+            result[os.path.join(r_dir, filename)] = int(bandwidth * duration / 8)
+    return result
+
+
+def estimate(dirname, project, tasks, options) -> Estimate:
+    # tasks: DownloadQueue tasks (url, full filename, info)
+    result = Estimate()
+    sizes = [None] * len(tasks)
+    if options.preflight == 'probe':
+        sizes = probe_sizes([url for url, filename, info in tasks], options)
+        result.probed = sum(1 for x in sizes if x is not None)
+    if None in sizes:
+        from_playlist = playlist_sizes(dirname, project)
+        for n, (url, filename, info) in enumerate(tasks):
+            if sizes[n] is None and filename in from_playlist:
+                sizes[n] = from_playlist[filename]
+                result.from_playlist += 1
+    known = [x for x in sizes if x is not None]
+    average = sum(known) // len(known) if known else 0
+    result.guessed = len(sizes) - len(known)
+    result.sizes = [average if x is None else x for x in sizes]
+    return result
+
+
+def check_space(dirname, needed, options) -> typing.Tuple[bool, int]:
+    # return: (enough, free bytes), keeps min_free_space free
+    free = shutil.disk_usage(dirname).free
+    return free - needed >= options.min_free_space, free
+
+
+def describe(est: Estimate, free) -> str:
+    text = f'{format_size(est.total_bytes)} to download in {len(est.sizes)} files'
+    if est.from_playlist or est.guessed:
+        text += f' ({est.probed} probed, {est.from_playlist} from bitrate, {est.guessed} guessed)'
+    return text + f', {format_size(free)} free'
@@ -0,0 +1,178 @@
+"""
+Opt-in profiling.
+
+Modes (DownloaderOptions.profile, or environment variable COOKPAD_PROFILE, which takes precedence):
+  ''          disabled, span() is a no-op
+  'spans'     time named spans (playlist fetch, download pieces, validation, ffmpeg ...)
+  'sampling'  spans + sample all thread stacks, written as folded stacks (flamegraph.pl / speedscope)
+
+Every run() writes <profile_dir>/<name>-<time>.spans.json (and .folded in sampling mode),
+with the spans finished while it was running (runs may overlap, e.g. batch stages and conversions).
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import typing
+
+ENV_MODE = 'COOKPAD_PROFILE'
+ENV_DIR = 'COOKPAD_PROFILE_DIR'
+MODES = ('', 'spans', 'sampling')
+
+_null_span = contextlib.nullcontext()
+_profiler: typing.Optional['Profiler'] = None
+
+
+class Sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks: typing.Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Profile sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(';', ','))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f'{stack} {count}\n')
+
+
+class Profiler:
+    def __init__(self, mode, output_dir):
+        self.mode = mode
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self._runs: typing.Dict[int, typing.Dict[str, typing.List[float]]] = {}  # run -> name -> [count, total, max]
+        self._next_run = 0
+
+    @contextlib.contextmanager
+    def span(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t
+            with self._lock:
+                for spans in self._runs.values():
+                    stat = spans.setdefault(name, [0, 0.0, 0.0])
+                    stat[0] += 1
+                    stat[1] += elapsed
+                    stat[2] = max(stat[2], elapsed)
+
+    @contextlib.contextmanager
+    def run(self, name):
+        with self._lock:
+            run_id = self._next_run
+            self._next_run += 1
+            self._runs[run_id] = {}
+        sampler = None
+        if self.mode == 'sampling':
+            sampler = Sampler()
+            sampler.start()
+        t = time.perf_counter()
+        try:
+            with self.span(name):
+                yield
+        finally:
+            wall = time.perf_counter() - t
+            if sampler is not None:
+                sampler.stop()
+            os.makedirs(self.output_dir, exist_ok=True)
+            prefix = os.path.join(self.output_dir, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}')
+            with self._lock:
+                spans = self._runs.pop(run_id)
+            spans = {k: {'count': c, 'total': total, 'max': m} for k, (c, total, m) in spans.items()}
+            with open(prefix + '.spans.json', 'w', encoding='utf-8') as f:
+                json.dump({'name': name, 'wall': wall, 'spans': spans}, f, indent=2)
+            if sampler is not None:
+                sampler.dump(prefix + '.folded')
+
+
+def configure(options=None):
+    # call again after options change
+    global _profiler
+    mode = os.environ.get(ENV_MODE)
+    if mode is None:
+        mode = getattr(options, 'profile', '') if options is not None else ''
+    if mode not in MODES:
+        # like other bad options, should not stop the program
+        print(f'Bad profile mode {mode!r}, should be one of {MODES}, profiling disabled', file=sys.stderr)
+        mode = ''
+    output_dir = os.environ.get(ENV_DIR) or (getattr(options, 'profile_dir', '') if options is not None else '')
+    _profiler = Profiler(mode, output_dir or 'profiles') if mode else None
+
+
+def span(name):
+    if _profiler is None:
+        return _null_span
+    return _profiler.span(name)
+
+
+def run(name):
+    if _profiler is None:
+        return _null_span
+    return _profiler.run(name)
+
+
+def _test_bad_mode():
+    os.environ[ENV_MODE] = 'bad'
+    try:
+        configure()
+        assert _profiler is None
+    finally:
+        del os.environ[ENV_MODE]
+        configure()
+    print('check ok')
+
+
+def _test_overlap():
+    import glob
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        profiler = Profiler('spans', d)
+        with profiler.run('outer'):
+            with profiler.span('a'):
+                pass
+            with profiler.run('inner'):
+                with profiler.span('b'):
+                    pass
+            with profiler.span('c'):
+                pass
+        result = {}
+        for filename in glob.glob(os.path.join(d, '*.spans.json')):
+            with open(filename, 'r', encoding='utf-8') as f:
+                j = json.load(f)
+            result[j['name']] = sorted(j['spans'])
+        assert result == {'outer': ['a', 'b', 'c', 'inner', 'outer'], 'inner': ['b', 'inner']}, result
+    print('check ok')
+
+
+configure()
+
+if __name__ == '__main__':
+    _test_bad_mode()
+    _test_overlap()
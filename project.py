@@ -0,0 +1,315 @@
+import io
+import json
+import os
+import re
+import typing
+
+import m3u8
+
+import api_fields
+import download
+import hls_keys
+import profiling
+from find_ffmpeg import find_ffmpeg
+
+PROJECT_FILE = 'project.json'
+PATCHED_PLAYLIST = 'patched.m3u8'
+EPISODE_JSON = 'episode_detail.json'
+
+
+def parse_episode(text) -> typing.Optional[int]:
+    # episode id or url (https://www.cookpad.tv/episodes/1234), None if invalid
+    try:
+        return int(text)
+    except ValueError:
+        m = re.match(r'https://www\.cookpad\.tv/episodes/(\d+)', text)
+        if m is not None:
+            return int(m.group(1))
+        return None
+
+
+def fetch_episode_detail(manager, episode, profile='full'):
+    # profile: api_fields.PROFILES, 'streams-only' is enough to create a project
+    params = {}
+    if profile == 'full':
+        params.update({
+            'geometry[episode][width]': 640,  # image size (px)
+            'geometry[teacher][width]': 640,
+            'geometry[recipe][width]': 640,
+        })
+    params['fields'] = api_fields.fields_of('EpisodeDetailEntity', profile)
+    r = manager.api_get(f'/api/v2/episode_details/{episode}', params)
+    _ = r.content  # pre-fetch content
+    return r
+
+
+def episode_title(j):
+    episode_id = j['episode']['id']
+    program = j['episode']['program']['title']
+    part = j['episode']['part']
+    title = j['episode']['title']
+    full_title = f'{program} #{part} ({episode_id}) {title}'
+    return full_title
+
+
+def safe_filename(name):
+    # usable as file / dir name on Windows too
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip().rstrip('.')
+    return name or '_'
+
+
+def strip_args(filename):
+    if '?' in filename:
+        filename, _ = filename.split('?', maxsplit=1)
+    return filename
+
+
+def fetch_playlist(url, options) -> typing.Tuple[bytes, m3u8.M3U8]:
+    with io.BytesIO() as m3u8_file:
+        dl = download.SingleDownloader(url, m3u8_file, options)
+        with profiling.span('playlist_fetch'):
+            dl.start()
+        assert dl.status() == download.DownloadStatus.DONE, f'Can not download {url}: {dl.status_string}'
+        content = m3u8_file.getbuffer().tobytes()
+    with profiling.span('playlist_parse'):
+        obj = m3u8.loads(content.decode('utf-8'), url)
+    return content, obj
+
+
+def variant_bandwidth(playlist) -> int:
+    return playlist.stream_info.average_bandwidth or playlist.stream_info.bandwidth or 0
+
+
+def best_variant(m3u8_obj) -> int:
+    # 1-based index of highest bandwidth variant
+    best_quality_id = 0
+    best_quality_br = 0
+    for i, playlist in enumerate(m3u8_obj.playlists, start=1):
+        br = variant_bandwidth(playlist)
+        if br > best_quality_br:
+            best_quality_id = i
+            best_quality_br = br
+    return best_quality_id
+
+
+def build_download_list(m3u8_obj) -> list:
+    # patch segment uri to local filename, return [(url, filename, info)]
+    download_list = []
+    for i, seg in enumerate(m3u8_obj.segments, start=1):
+        seg_url = seg.absolute_uri
+        base_url, seg_fn = seg_url.rsplit('/', maxsplit=1)
+        seg_fn = strip_args(seg_fn)
+        seg.uri = seg_fn
+        download_list.append((seg_url, seg_fn, f'{i}.ts'))
+    return download_list
+
+
+def resolve_rendition(stream_url, variant_id, options, master=None) -> dict:
+    """
+    Fetch playlists of one stream, variant_id: 1-based, 0 = best, ignored for non-variant playlists.
+    master: (content, m3u8 obj) of stream_url if already fetched.
+    Return a rendition dict, with in-memory files to write in 'files' (filename -> bytes) and patched playlist obj.
+    """
+    m3u8_filename = strip_args(stream_url.rsplit('/', maxsplit=1)[1])
+    m3u8_content, m3u8_obj = master or fetch_playlist(stream_url, options)
+    files = {m3u8_filename: m3u8_content}
+    if m3u8_obj.is_variant:
+        variant_id = variant_id or best_variant(m3u8_obj)
+        variant_url = m3u8_obj.playlists[variant_id - 1].absolute_uri
+        m3u8_variant_filename = strip_args(variant_url.rsplit('/', maxsplit=1)[1])
+        m3u8_variant_content, m3u8_obj = fetch_playlist(variant_url, options)
+        files[m3u8_variant_filename] = m3u8_variant_content
+    else:
+        variant_id = -1
+        variant_url = stream_url
+    download_list = build_download_list(m3u8_obj)
+    rendition = {
+        'stream_url': stream_url,
+        'variant_id': variant_id,
+        'variant_url': variant_url,
+        'playlist_patched': PATCHED_PLAYLIST,
+        'download_list': download_list,
+        'files': files,
+        'patched': m3u8_obj,
+    }
+    keys, segment_keys = hls_keys.discover(m3u8_obj)
+    if keys:
+        decrypt = options.decrypt_segments and any(key['method'] == 'AES-128' for key in keys)
+        if decrypt and not hls_keys.can_decrypt():
+            raise RuntimeError('decrypt_segments needs the cryptography package (pip install cryptography)')
+        rendition.update({
+            'keys': keys,
+            'segment_keys': segment_keys,
+            'decrypt': decrypt,
+            'key_data': hls_keys.fetch_keys(keys, options),
+        })
+    return rendition
+
+
+def write_rendition(dirname, rendition):
+    # write playlists of a resolved rendition, strip in-memory parts, return project entry
+    rendition = dict(rendition)
+    files = rendition.pop('files')
+    patched = rendition.pop('patched')
+    key_data = rendition.pop('key_data', None)
+    rendition_dir = os.path.join(dirname, rendition.get('subdir', ''))
+    os.makedirs(rendition_dir, exist_ok=True)
+    for filename, content in files.items():
+        with open(os.path.join(rendition_dir, filename), 'wb') as f:
+            f.write(content)
+    if key_data is not None:
+        hls_keys.write_keys(dirname, key_data)
+        hls_keys.patch_playlist(patched, rendition)
+    patched.dump(os.path.join(rendition_dir, rendition['playlist_patched']))
+    return rendition
+
+
+def save_renditions(dirname, resolved, extra) -> dict:
+    """
+    Write a project of resolve_rendition() results, each with 'stream_id' and 'name' set.
+    One rendition: old style project (files in project root), more: one subdir per rendition.
+    extra: project level keys (info_json, start_offset).
+    """
+    if len(resolved) == 1:
+        rendition = dict(resolved[0])
+        rendition.pop('name', None)
+        project = dict(extra)
+        project.update(write_rendition(dirname, rendition))
+    else:
+        rendition_list = []
+        for rendition in resolved:
+            rendition = dict(rendition)
+            rendition['subdir'] = rendition['name']
+            rendition_list.append(write_rendition(dirname, rendition))
+        project = dict(extra)
+        project['renditions'] = rendition_list
+    save_project(dirname, project)
+    return project
+
+
+def save_project(dirname, project):
+    with open(os.path.join(dirname, PROJECT_FILE), 'w', encoding='utf-8') as f:
+        json.dump(project, f)
+
+
+def load_project(dirname) -> dict:
+    with open(os.path.join(dirname, PROJECT_FILE), 'rb') as f:
+        return json.load(f)
+
+
+def renditions(project) -> typing.List[dict]:
+    # multi rendition projects have 'renditions', each in its own subdir
+    # single rendition (old style) projects are the rendition themselves, in project root
+    if 'renditions' in project:
+        return project['renditions']
+    r = dict(project)
+    r.setdefault('subdir', '')
+    r.setdefault('name', '')
+    return [r]
+
+
+def rendition_dir(dirname, rendition):
+    return os.path.join(dirname, rendition.get('subdir', ''))
+
+
+def flat_download_list(project) -> list:
+    # [(url, filename relative to project root, info)], renditions interleaved so they share bandwidth fairly
+    lists = []
+    for r in renditions(project):
+        subdir = r.get('subdir', '')
+        name = r.get('name', '')
+        lists.append([
+            (url, os.path.join(subdir, filename) if subdir else filename, f'{name} {info}' if name else info)
+            for url, filename, info in r['download_list']
+        ])
+    result = []
+    for n in range(max((len(x) for x in lists), default=0)):
+        for x in lists:
+            if n < len(x):
+                result.append(x[n])
+    return result
+
+
+def pending_tasks(dirname, project) -> list:
+    # DownloadQueue tasks of files not downloaded yet
+    tasks = []
+    for url, filename, info in flat_download_list(project):
+        filename_full = os.path.join(dirname, filename)
+        if os.access(filename_full, os.F_OK):
+            continue
+        tasks.append((url, filename_full, info))
+    return tasks
+
+
+def playback_tracks(dirname, project) -> typing.Dict[str, typing.List[str]]:
+    # DownloadQueue tracks: full filenames of each rendition's segments in playlist order
+    return {rendition.get('subdir', ''): [os.path.join(rendition_dir(dirname, rendition), filename)
+                                          for url, filename, info in rendition['download_list']]
+            for rendition in renditions(project)}
+
+
+def segment_durations(dirname, rendition) -> typing.List[float]:
+    # #EXTINF of each segment, from the patched playlist
+    with open(os.path.join(rendition_dir(dirname, rendition), rendition['playlist_patched']), 'r',
+              encoding='utf-8') as f:
+        return [seg.duration or 0.0 for seg in m3u8.loads(f.read()).segments]
+
+
+def segment_post_process(dirname, project, options):
+    # DownloadQueue post_process (decryption of segments), None if not needed
+    decryptor = hls_keys.Decryptor(dirname, renditions(project), options.validator_chunk_size)
+    return decryptor or None
+
+
+def ts_segment_files(dirname, project) -> typing.Set[str]:
+    # full filenames of segments downloaded as clear MPEG-TS (checked by structure when there is no ETag)
+    result = set()
+    for rendition in renditions(project):
+        if rendition.get('keys'):
+            continue  # encrypted on the wire, also when decrypted after download
+        r_dir = rendition_dir(dirname, rendition)
+        result.update(os.path.join(r_dir, filename) for url, filename, info in rendition['download_list']
+                      if filename.lower().endswith('.ts'))
+    return result
+
+
+def decrypted_files(project) -> typing.Set[str]:
+    # filenames (relative to project root) decrypted after download, server ETags are of the encrypted bytes
+    result = set()
+    for rendition in renditions(project):
+        if rendition.get('decrypt'):
+            subdir = rendition.get('subdir', '')
+            result.update(os.path.join(subdir, filename) if subdir else filename
+                          for url, filename, info in rendition['download_list'])
+    return result
+
+
+def missing_files(dirname, rendition) -> list:
+    r_dir = rendition_dir(dirname, rendition)
+    files = set(os.listdir(r_dir)) if os.path.isdir(r_dir) else set()
+    return [filename for url, filename, info in rendition['download_list'] if filename not in files]
+
+
+def remux_args(rendition, filename, start_offset=0, source=None) -> list:
+    # ffmpeg args, run with cwd=rendition_dir(); source: MPEG-TS input instead of the playlist (e.g. pipe:0)
+    args = [find_ffmpeg(), '-y']
+    if source is None and rendition.get('keys') and not rendition.get('decrypt'):
+        args += ['-allowed_extensions', 'ALL']  # local key files
+    if start_offset > 0:
+        args += ['-ss', f'{start_offset:g}']
+    if source is not None:
+        args += ['-f', 'mpegts']
+    args += ['-i', rendition['playlist_patched'] if source is None else source,
+             '-c', 'copy',
+             '-bsf:v', 'filter_units=remove_types=12',  # TODO: only for h264 streams!
+             '-movflags', '+faststart',
+             filename]
+    return args
+
+
+def output_filename(base, rendition, count):
+    # one mp4 per rendition, suffix with rendition name if more than one
+    if count <= 1 or not rendition.get('name'):
+        return base
+    root, ext = os.path.splitext(base)
+    return f'{root}-{rendition["name"]}{ext or ".mp4"}'
@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+import typing
+
+
+class ProxyEntry:
+    def __init__(self, proxies: typing.Dict[str, str]):
+        self.proxies = proxies  # requests style mapping, {} = direct connection
+        self.rate: typing.Optional[float] = None  # EWMA of task throughput (byte / sec)
+        self.error_rate = 0.0  # EWMA of task failures
+        self.consecutive_failures = 0
+        self.in_flight = 0
+        self.ejected_until = 0.0
+        self.probing = False
+
+    def __repr__(self):
+        return f'<ProxyEntry {self.proxies} rate={self.rate} error_rate={self.error_rate:.2f}>'
+
+
+class ProxyPool:
+    """
+    Spread tasks over several upstream proxies, weighted by measured throughput and error rate.
+    Proxies failing too often are ejected for eject_time seconds, then re-probed by a single task.
+    """
+
+    def __init__(self, proxies_list, alpha=0.3, eject_failures=3, eject_error_rate=0.5, eject_time=30.0):
+        self.entries = [ProxyEntry(p) for p in proxies_list]
+        self.alpha = alpha
+        self.eject_failures = eject_failures
+        self.eject_error_rate = eject_error_rate
+        self.eject_time = eject_time
+        self._lock = threading.Lock()
+
+    def acquire(self) -> ProxyEntry:
+        with self._lock:
+            now = time.monotonic()
+            healthy = [e for e in self.entries if e.ejected_until <= now and not e.probing]
+            for entry in healthy:
+                if entry.ejected_until > 0:
+                    # ejection expired, let one task probe it
+                    entry.probing = True
+                    entry.in_flight += 1
+                    return entry
+            if not healthy:
+                # everything ejected, use the one coming back first
+                entry = min(self.entries, key=lambda e: e.ejected_until)
+                entry.in_flight += 1
+                return entry
+            known = [e.rate for e in healthy if e.rate is not None]
+            default_rate = max(known) if known else 1.0  # explore unmeasured proxies
+            weights = [
+                (e.rate if e.rate is not None else default_rate) * (1 - e.error_rate) / (1 + e.in_flight) + 1e-9
+                for e in healthy
+            ]
+            entry = random.choices(healthy, weights)[0]
+            entry.in_flight += 1
+            return entry
+
+    def release(self, entry: ProxyEntry, size, seconds, success, cancelled=False):
+        # cancelled: stopped by us (hedge lost, queue stopped), says nothing about the proxy's health
+        with self._lock:
+            entry.in_flight -= 1
+            a = self.alpha
+            if cancelled and not success:
+                if seconds > 0 and size > 0:
+                    rate = size / seconds
+                    entry.rate = rate if entry.rate is None else (1 - a) * entry.rate + a * rate
+                entry.probing = False  # ejection still expired, next acquire probes again
+                return
+            entry.error_rate = (1 - a) * entry.error_rate + a * (0 if success else 1)
+            if success:
+                entry.consecutive_failures = 0
+                if seconds > 0 and size > 0:
+                    rate = size / seconds
+                    entry.rate = rate if entry.rate is None else (1 - a) * entry.rate + a * rate
+                if entry.probing:
+                    entry.probing = False
+                    entry.ejected_until = 0.0
+                    entry.error_rate = 0.0
+                return
+            entry.consecutive_failures += 1
+            if (entry.probing or entry.consecutive_failures >= self.eject_failures
+                    or entry.error_rate >= self.eject_error_rate):
+                entry.probing = False
+                entry.ejected_until = time.monotonic() + self.eject_time
+
+    def summary(self) -> typing.List[dict]:
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                'proxies': e.proxies, 'rate': e.rate, 'error_rate': e.error_rate,
+                'ejected': e.ejected_until > now,
+            } for e in self.entries]
+
+
+def _test_cancelled():
+    pool = ProxyPool([{}], eject_failures=3)
+    for _ in range(10):
+        entry = pool.acquire()
+        pool.release(entry, 1000, 1.0, False, cancelled=True)
+    entry = pool.entries[0]
+    assert entry.error_rate == 0.0 and entry.consecutive_failures == 0 and entry.ejected_until == 0.0
+    assert entry.rate == 1000 and entry.in_flight == 0
+    for _ in range(3):
+        pool.release(pool.acquire(), 0, 1.0, False)
+    assert entry.ejected_until > 0
+    print('check ok')
+
+
+def get_proxy_pool(options) -> typing.Optional[ProxyPool]:
+    if not options.proxy_pool:
+        return None
+    return ProxyPool(options.proxy_pool, eject_time=options.proxy_eject_time)
+
+
+if __name__ == '__main__':
+    _test_cancelled()
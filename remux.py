@@ -0,0 +1,264 @@
+"""
+Remux scheduler: ffmpeg jobs run in background threads, several at once, with live progress.
+
+Conversion with -c copy is mostly disk bound, so besides a total limit (max_jobs, by CPU count)
+at most max_per_disk jobs read from / write to the same disk at a time.
+Progress comes from ffmpeg -progress (out_time, speed), percentage and ETA from the playlist duration.
+Segments are fed to ffmpeg as one MPEG-TS stream where possible (see ts_concat), else ffmpeg reads the playlist.
+"""
+import io
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import typing
+from dataclasses import dataclass, field
+
+import profiling
+import project as project_
+import ts_concat
+
+
+def default_jobs():
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+@dataclass
+class RemuxJob:
+    id: int
+    output: str
+    cwd: str
+    args: typing.List[str]
+    duration: float = 0.0  # sec of media to convert, 0 = unknown
+    name: str = ''
+    feed: typing.Optional[typing.Callable[[typing.BinaryIO], None]] = field(default=None, repr=False)  # writes stdin
+    mode: str = ''  # how input is read: concat / playlist
+    note: str = ''  # e.g. why not concat
+
+    state: str = 'queued'  # queued / running / done / failed / cancelled
+    out_time: float = 0.0  # sec converted
+    speed: typing.Optional[float] = None  # x realtime
+    error: str = ''
+    submitted: float = field(default_factory=time.monotonic)
+    started: typing.Optional[float] = None
+    finished: typing.Optional[float] = None
+    callback: typing.Optional[typing.Callable[['RemuxJob'], None]] = field(default=None, repr=False)
+    _process: typing.Optional[subprocess.Popen] = field(default=None, repr=False)
+    _devices: typing.Set[int] = field(default_factory=set, repr=False)
+
+    @property
+    def progress(self) -> typing.Optional[float]:
+        if self.state == 'done':
+            return 1.0
+        return min(1.0, self.out_time / self.duration) if self.duration > 0 else None
+
+    def eta(self) -> typing.Optional[float]:
+        if self.state != 'running' or not self.speed or self.duration <= 0:
+            return None
+        return max(0.0, self.duration - self.out_time) / self.speed
+
+    def timings(self) -> typing.Dict[str, float]:
+        # sec waiting for a slot / running
+        result = {}
+        if self.started is not None:
+            result['wait'] = self.started - self.submitted
+            result['run'] = (self.finished or time.monotonic()) - self.started
+        return result
+
+    def describe(self) -> str:
+        text = f'{self.name or os.path.basename(self.output)}: {self.state}'
+        if self.state == 'running':
+            progress = self.progress
+            text += f' {progress:.0%}' if progress is not None else f' {self.out_time:.0f}s'
+            if self.speed:
+                text += f' {self.speed:.1f}x'
+            eta = self.eta()
+            if eta is not None:
+                text += f' ETA {int(eta // 60)}:{int(eta % 60):02d}'
+        elif self.state == 'failed':
+            text += f' ({self.error.strip().splitlines()[-1] if self.error.strip() else "?"})'
+        return text
+
+
+def parse_progress(lines) -> typing.Iterator[typing.Dict[str, str]]:
+    # ffmpeg -progress output: key=value lines, each block ends with progress=continue / end
+    block = {}
+    for line in lines:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        block[key] = value
+        if key == 'progress':
+            yield block
+            block = {}
+
+
+def _device(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+class RemuxPool:
+    def __init__(self, max_jobs=0, max_per_disk=2, callback: typing.Callable[[RemuxJob], None] = None,
+                 fast_concat=True):
+        self.max_jobs = 0
+        self.max_per_disk = max_per_disk
+        self.fast_concat = fast_concat
+        self.callback = callback  # called (in job threads) when state / progress of a job changes
+        self.jobs: typing.List[RemuxJob] = []  # queued / running
+        self._cond = threading.Condition()
+        self._running: typing.List[RemuxJob] = []
+        self._next_id = 1
+        self.configure(max_jobs, fast_concat)
+
+    def configure(self, max_jobs=0, fast_concat=True):
+        # after options change, applies to queued and new jobs
+        with self._cond:
+            self.max_jobs = max_jobs or default_jobs()
+            self.fast_concat = fast_concat
+            self._cond.notify_all()
+
+    def submit(self, args, cwd, output, duration=0.0, name='', callback=None, feed=None) -> RemuxJob:
+        # args: ffmpeg command line (without progress / log options), callback: like pool callback, for this job
+        # feed: called (in a thread) with ffmpeg stdin, for input pipe:0
+        with self._cond:
+            job = RemuxJob(self._next_id, output, cwd, list(args), duration, name, feed=feed, callback=callback)
+            self._next_id += 1
+            job._devices = {d for d in (_device(cwd), _device(os.path.dirname(output) or '.')) if d is not None}
+            self.jobs.append(job)
+        threading.Thread(target=self._run, args=(job,), name=f'Remux #{job.id}', daemon=True).start()
+        return job
+
+    def submit_rendition(self, dirname, rendition, output, start_offset=0, name='', callback=None) -> RemuxJob:
+        r_dir = project_.rendition_dir(dirname, rendition)
+        duration = max(0.0, sum(project_.segment_durations(dirname, rendition)) - int(start_offset))
+        files, reason = None, 'disabled'
+        if self.fast_concat:
+            files, offset, reason = ts_concat.plan(r_dir, rendition, int(start_offset))
+        if files is not None:
+            job = self.submit(project_.remux_args(rendition, output, offset, source='pipe:0'), r_dir, output,
+                              duration, name, callback, feed=lambda out: ts_concat.feed(files, out))
+            job.mode = 'concat'
+        else:
+            job = self.submit(project_.remux_args(rendition, output, int(start_offset)), r_dir, output,
+                              duration, name, callback)
+            job.mode, job.note = 'playlist', reason
+        return job
+
+    def cancel(self, job: RemuxJob):
+        with self._cond:
+            if job.state in ('queued', 'running'):
+                job.state = 'cancelled'
+                self._cond.notify_all()
+            process = job._process
+        if process is not None:
+            process.kill()
+
+    def wait(self, jobs=None, timeout=None) -> bool:
+        # until jobs (default: all submitted so far) are finished, False on timeout
+        jobs = list(self.jobs) if jobs is None else jobs
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: all(job.state not in ('queued', 'running') for job in jobs), timeout)
+
+    def active(self) -> typing.List[RemuxJob]:
+        with self._cond:
+            return list(self.jobs)
+
+    def _can_start(self, job):
+        if len(self._running) >= self.max_jobs:
+            return False
+        for device in job._devices:
+            if sum(1 for other in self._running if device in other._devices) >= self.max_per_disk:
+                return False
+        return True
+
+    def _notify(self, job):
+        self.callback and self.callback(job)
+        job.callback and job.callback(job)
+
+    def _run(self, job: RemuxJob):
+        with self._cond:
+            self._cond.wait_for(lambda: job.state == 'cancelled' or self._can_start(job))
+            cancelled = job.state == 'cancelled'
+            if cancelled:
+                job.finished = time.monotonic()
+                self.jobs.remove(job)
+                self._cond.notify_all()
+            else:
+                job.state = 'running'
+                job.started = time.monotonic()
+                self._running.append(job)
+        if cancelled:
+            self._notify(job)
+            return
+        try:
+            self._notify(job)
+            self._run_ffmpeg(job)
+        except Exception as e:
+            job.error = repr(e)
+        finally:
+            with self._cond:
+                self._running.remove(job)
+                if job.state == 'running':
+                    job.state = 'failed' if job.error else 'done'
+                job.finished = time.monotonic()
+                job._process = None
+                self.jobs.remove(job)
+                self._cond.notify_all()
+            self._notify(job)
+
+    def _run_ffmpeg(self, job: RemuxJob):
+        args = list(job.args)
+        options = ['-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1']
+        if job.feed is None:
+            options.insert(3, '-nostdin')
+        args[1:1] = options
+        with tempfile.TemporaryFile() as stderr, profiling.span('ffmpeg'):
+            with self._cond:
+                if job.state != 'running':
+                    return
+                job._process = subprocess.Popen(args, cwd=job.cwd, stdout=subprocess.PIPE, stderr=stderr,
+                                                stdin=subprocess.DEVNULL if job.feed is None else subprocess.PIPE)
+            process = job._process
+            feeder = None
+            if job.feed is not None:
+                feeder = threading.Thread(target=job.feed, args=(process.stdin,), name=f'Remux #{job.id} input',
+                                          daemon=True)
+                feeder.start()
+            for block in parse_progress(io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace')):
+                out_time = block.get('out_time_us', block.get('out_time_ms', ''))  # both are microseconds
+                if out_time.isdigit():
+                    job.out_time = int(out_time) / 1e6
+                speed = block.get('speed', '').rstrip('x')
+                try:
+                    job.speed = float(speed)
+                except ValueError:
+                    pass
+                self._notify(job)
+            returncode = process.wait()
+            feeder is not None and feeder.join()
+            if returncode != 0 and job.state == 'running':
+                stderr.seek(0)
+                job.error = f'ffmpeg exited with {returncode}: ' + stderr.read().decode('utf-8', errors='replace')
+
+
+def _test_pool():
+    # cancelled while queued: callback sees it; raising max_jobs starts queued jobs
+    cancelled = threading.Event()
+    pool = RemuxPool(1, callback=lambda job: job.state == 'cancelled' and cancelled.set())
+    pool._running.append(RemuxJob(0, 'busy.mp4', '.', []))  # slot taken
+    job = pool.submit(['ffmpeg'], '.', 'out.mp4')
+    pool.cancel(job)
+    assert cancelled.wait(5) and not pool.active()
+    assert not pool._can_start(job)
+    pool.configure(2, fast_concat=False)
+    assert pool._can_start(job) and not pool.fast_concat
+    print('check ok')
+
+
+if __name__ == '__main__':
+    _test_pool()
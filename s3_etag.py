@@ -1,17 +1,29 @@
+import concurrent.futures
 import hashlib
+import io
+import mmap
+import os
+import threading
 
+_executor = None
+_executor_lock = threading.Lock()
 
-# https://stackoverflow.com/questions/12186993/what-is-the-algorithm-to-compute-the-amazon-s3-etag-for-a-file-larger-than-5gb
 
-def s3_etag(file_or_bytes, multipart_chunksize=10 * 1024 * 1024):
-    if isinstance(file_or_bytes, bytes):
-        contents = iter(
-            file_or_bytes[i:i + multipart_chunksize] for i in range(0, len(file_or_bytes), multipart_chunksize))
-    else:
-        file_or_bytes.seek(0)
-        contents = iter(lambda: file_or_bytes.read(multipart_chunksize), b'')
-    hashes = [hashlib.md5(part).digest() for part in contents]
+def _get_executor():
+    # shared by all callers, hashlib releases GIL for large buffers so threads run in parallel
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='s3_etag')
+        return _executor
+
 
+def _md5_digest(part):
+    return hashlib.md5(part).digest()
+
+
+def _etag_from_hashes(hashes):
     if len(hashes) > 1:
         md5hash = hashlib.md5()
         for h in hashes:
@@ -21,6 +33,55 @@ def s3_etag(file_or_bytes, multipart_chunksize=10 * 1024 * 1024):
         return f'"{hashes[0].hex()}"'
 
 
+def _etag_of_buffer(buf: memoryview, multipart_chunksize):
+    if len(buf) == 0:
+        return f'"{hashlib.md5().hexdigest()}"'
+    # zero-copy slices, must be released before the underlying buffer (mmap / BytesIO) is closed / resized
+    parts = [buf[i:i + multipart_chunksize] for i in range(0, len(buf), multipart_chunksize)]
+    try:
+        if len(parts) > 1:
+            hashes = list(_get_executor().map(_md5_digest, parts))
+        else:
+            hashes = [_md5_digest(parts[0])]
+    finally:
+        for part in parts:
+            part.release()
+    return _etag_from_hashes(hashes)
+
+
+def _etag_of_stream(file, multipart_chunksize):
+    file.seek(0)
+    contents = iter(lambda: file.read(multipart_chunksize), b'')
+    hashes = [hashlib.md5(part).digest() for part in contents]
+    if not hashes:
+        return f'"{hashlib.md5().hexdigest()}"'
+    return _etag_from_hashes(hashes)
+
+
+# https://stackoverflow.com/questions/12186993/what-is-the-algorithm-to-compute-the-amazon-s3-etag-for-a-file-larger-than-5gb
+
+def s3_etag(file_or_bytes, multipart_chunksize=10 * 1024 * 1024):
+    # buffers: hashed through memoryview slices
+    # on-disk files: mmap, fallback to read() for unmappable streams
+    if isinstance(file_or_bytes, (bytes, bytearray, memoryview, mmap.mmap)):
+        with memoryview(file_or_bytes) as mv, mv.cast('B') as buf:
+            return _etag_of_buffer(buf, multipart_chunksize)
+    if isinstance(file_or_bytes, io.BytesIO):
+        with file_or_bytes.getbuffer() as buf:
+            return _etag_of_buffer(buf, multipart_chunksize)
+    try:
+        file_or_bytes.flush()  # file may be opened for writing, mmap reads from OS
+        fileno = file_or_bytes.fileno()
+        if os.fstat(fileno).st_size == 0:
+            return _etag_of_stream(file_or_bytes, multipart_chunksize)
+        m = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        return _etag_of_stream(file_or_bytes, multipart_chunksize)
+    with m:
+        with memoryview(m) as buf:
+            return _etag_of_buffer(buf, multipart_chunksize)
+
+
 def guess_chunksize(file_or_bytes, filesize, etag, chunksize_step=1024):
     import re
     import math
@@ -87,5 +148,29 @@ def test_etag():
         print('check ok')
 
 
+def _test_zero_copy():
+    import tempfile
+
+    def reference(data, chunksize):
+        hashes = [hashlib.md5(data[i:i + chunksize]).digest() for i in range(0, len(data), chunksize)]
+        return _etag_from_hashes(hashes)
+
+    for size in (1, 1000, 1024, 4096 * 3 + 5):
+        data = os.urandom(size)
+        expected = reference(data, 1024)
+        assert s3_etag(data, 1024) == expected
+        assert s3_etag(bytearray(data), 1024) == expected
+        with io.BytesIO(data) as f:
+            assert s3_etag(f, 1024) == expected
+            f.write(b'resizable after hashing')
+        with tempfile.TemporaryFile('w+b') as f:
+            f.write(data)  # not flushed yet
+            assert s3_etag(f, 1024) == expected
+            f.truncate(0)  # mmap must be closed
+    assert s3_etag(b'') == '"d41d8cd98f00b204e9800998ecf8427e"'
+    print('check ok')
+
+
 if __name__ == '__main__':
+    _test_zero_copy()
     test_etag()
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import typing
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
+FICLONE = 0x40049409  # linux/fs.h, reflink (btrfs / xfs / ...)
+GC_LOW_WATER = 0.9  # gc after add frees down to this part of max_size, so a full store is not rescanned per add
+
+
+def _url_key(url: str) -> str:
+    # strip signed query args, the same object is often served with different tokens
+    url = url.split('?', maxsplit=1)[0]
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def _object_key(url: str, etag: typing.Optional[str], size: int) -> str:
+    if etag:
+        # S3 etag is content derived, objects with the same etag + size share one copy
+        src = f'etag:{etag}:{size}'
+    else:
+        src = f'url:{_url_key(url)}:{size}'
+    return hashlib.sha1(src.encode('utf-8')).hexdigest()
+
+
+def _reflink(src, dst) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as fs, open(dst, 'wb') as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def link_or_copy(src, dst) -> str:
+    # return: method used
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+    if _reflink(src, dst):
+        return 'reflink'
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+class SegmentStore:
+    """
+    Content-addressed segment cache shared across projects.
+
+    Layout:
+      <root>/index/<sha1(url)>.json   -> {"url", "etag", "size", "object"}
+      <root>/objects/<object key>     -> file content
+    Last access time is kept as mtime of the object file (used for LRU gc).
+    With max_size, the store size is counted once at open and kept as a running total, gc only runs when over.
+    """
+
+    def __init__(self, root, max_size=0):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size  # bytes, 0 = unlimited
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, 'index'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+        # bytes in objects/, approximate if other processes share the store (gc recounts)
+        self._total = sum(size for mtime, size, path in self._scan()) if max_size > 0 else 0
+
+    def _scan(self) -> typing.List[typing.Tuple[float, int, str]]:
+        # (mtime, size, path) of every object
+        objects = []
+        with os.scandir(os.path.join(self.root, 'objects')) as it:
+            for entry in it:
+                if not entry.is_file() or '.' in entry.name:
+                    continue
+                st = entry.stat()
+                objects.append((st.st_mtime, st.st_size, entry.path))
+        return objects
+
+    def _index_path(self, url):
+        return os.path.join(self.root, 'index', _url_key(url) + '.json')
+
+    def _object_path(self, key):
+        return os.path.join(self.root, 'objects', key)
+
+    def lookup(self, url) -> typing.Optional[dict]:
+        try:
+            with open(self._index_path(url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        path = self._object_path(entry['object'])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        if size != entry['size']:
+            return None
+        return entry
+
+    def materialize(self, url, dest) -> typing.Optional[dict]:
+        # return: index entry on hit, None on miss
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        path = self._object_path(entry['object'])
+        temp = dest + '.store'
+        try:
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+        try:
+            link_or_copy(path, temp)
+            os.replace(temp, dest)
+        except OSError:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+            return None
+        self._touch(path)
+        return entry
+
+    def add(self, url, filename, headers=None):
+        headers = headers or {}
+        etag = headers.get('etag', None)
+        size = os.path.getsize(filename)
+        key = _object_key(url, etag, size)
+        path = self._object_path(key)
+        if not os.access(path, os.F_OK):
+            temp = path + f'.{os.getpid()}.{threading.get_ident()}'
+            link_or_copy(filename, temp)
+            os.replace(temp, path)
+            with self._lock:
+                self._total += size
+        self._touch(path)
+        entry = {'url': url, 'etag': etag, 'size': size, 'object': key}
+        index = self._index_path(url)
+        temp = index + f'.{os.getpid()}.{threading.get_ident()}'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(temp, index)
+        if 0 < self.max_size < self._total:
+            self.gc(int(self.max_size * GC_LOW_WATER))
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def gc(self, max_size=None) -> int:
+        # remove least recently used objects until total size <= max_size
+        # return: bytes freed
+        max_size = self.max_size if max_size is None else max_size
+        if max_size <= 0:
+            return 0
+        with self._lock:
+            objects = self._scan()
+            total = sum(size for mtime, size, path in objects)
+            self._total = total
+            if total <= max_size:
+                return 0
+            objects.sort()
+            freed = 0
+            for mtime, size, path in objects:
+                if total - freed <= max_size:
+                    break
+                try:
+                    os.remove(path)
+                    freed += size
+                except OSError:
+                    pass
+            self._total = total - freed
+            # index entries pointing at removed objects are dropped lazily by lookup()
+            return freed
+
+
+def get_store(options) -> typing.Optional[SegmentStore]:
+    if not options.segment_store:
+        return None
+    return SegmentStore(options.segment_store, options.segment_store_max_size)
+
+
+def _test_store():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        store = SegmentStore(os.path.join(d, 'store'), max_size=15)
+        src = os.path.join(d, 'a.ts')
+        with open(src, 'wb') as f:
+            f.write(b'0123456789')
+        store.add('https://example.com/a.ts?token=1', src, {'etag': '"abc"'})
+        dest = os.path.join(d, 'b.ts')
+        assert store.materialize('https://example.com/a.ts?token=2', dest)
+        with open(dest, 'rb') as f:
+            assert f.read() == b'0123456789'
+        time.sleep(0.01)
+        src2 = os.path.join(d, 'c.ts')
+        with open(src2, 'wb') as f:
+            f.write(b'abcdefghij')
+        store.add('https://example.com/c.ts', src2, {})
+        assert store.lookup('https://example.com/a.ts') is None  # evicted
+        assert store.lookup('https://example.com/c.ts') is not None
+        assert store._total == 10
+        # running total: no rescan of objects/ while under max_size
+        store = SegmentStore(os.path.join(d, 'store'), max_size=10 ** 9)
+        assert store._total == 10
+        scans = []
+        scan = store._scan
+        store._scan = lambda: scans.append(1) or scan()
+        for n in range(100):
+            with open(src, 'wb') as f:
+                f.write(b'%010d' % n)
+            store.add(f'https://example.com/{n}.ts', src, {})
+        assert not scans and store._total == 10 + 100 * 10
+        store.max_size = 505
+        with open(src, 'wb') as f:
+            f.write(b'x' * 10)
+        store.add('https://example.com/x.ts', src, {})
+        assert len(scans) == 1 and store._total <= 505 * GC_LOW_WATER
+    print('ok')
+
+
+if __name__ == '__main__':
+    _test_store()
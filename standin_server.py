@@ -0,0 +1,382 @@
+"""
+Local HLS / CDN stand-in server, for offline benchmarks and tests.
+
+Serves:
+  /master.m3u8                 master playlist, one variant per entry of ServerOptions.variants
+  /v{n}/index.m3u8             variant playlist
+  /v{n}/seg_{i:05d}.ts         synthetic MPEG-TS segment, with S3 style (multipart) ETag unless ServerOptions.etag off
+  /key.bin                     AES-128 key, segments are encrypted with it if ServerOptions.encrypt
+  /__stats                     JSON counters (bytes sent, requests, faults injected)
+
+Fault injection (ServerOptions.faults, applied to segment requests with probability fault_rate):
+  reset         connection reset (RST) mid-body
+  stall         stop sending mid-body for stall_time seconds
+  short         close connection mid-body (short read)
+  bad_length    wrong (too small) Content-Length, body truncated to match
+  5xx           503 (with Retry-After) to every segment request for burst_time seconds
+  ignore_range  ignore Range header, always answer 200 with full body
+  corrupt       flip bytes in body, fails ETag validation
+"""
+import http.server
+import json
+import random
+import re
+import socket
+import socketserver
+import struct
+import threading
+import time
+import typing
+from dataclasses import dataclass, field, asdict, replace
+
+from s3_etag import s3_etag
+
+TS_PACKET_SIZE = 188
+KEY = bytes(range(16))
+FAULTS = ('reset', 'stall', 'short', 'bad_length', '5xx', 'ignore_range', 'corrupt')
+
+
+@dataclass
+class ServerOptions:
+    variants: typing.List[int] = field(default_factory=lambda: [800 * 1024, 2000 * 1024])  # bits / sec
+    segment_count: int = 20
+    segment_duration: float = 12.0  # sec, #EXTINF
+    segment_size: int = 0  # bytes, 0 = derive from variant bandwidth * segment_duration
+    etag_chunksize: int = 10 * 1024 * 1024  # S3 multipart size, should match validator_chunk_size
+    etag: bool = True  # send ETag header
+    accept_ranges: bool = True
+    encrypt: bool = False  # AES-128 segments (IV = media sequence), needs cryptography
+
+    latency: float = 0.0  # sec, before response headers
+    bandwidth: int = 0  # byte / sec per connection, 0 = unlimited
+    decay: float = 0.0  # per connection throughput decay, rate = bandwidth / (1 + decay * MiB sent)
+    block_size: int = 64 * 1024  # bytes per write
+
+    faults: typing.List[str] = field(default_factory=list)  # see FAULTS
+    fault_rate: float = 0.3  # probability for a segment request to be faulted
+    fault_seed: int = 0
+    stall_time: float = 15.0  # sec, should be longer than client timeout_read
+    burst_time: float = 2.0  # sec, length of one 5xx burst
+
+
+def make_segment(variant, index, size) -> bytes:
+    # deterministic synthetic TS: valid sync bytes and continuity counters, random payload
+    packet_count = max(1, size // TS_PACKET_SIZE)
+    data = bytearray(random.Random(variant * 1000003 + index).randbytes(packet_count * TS_PACKET_SIZE))
+    pid = 0x100
+    for n in range(packet_count):
+        offset = n * TS_PACKET_SIZE
+        data[offset] = 0x47
+        data[offset + 1] = (0x40 if n == 0 else 0) | (pid >> 8)  # payload unit start
+        data[offset + 2] = pid & 0xff
+        data[offset + 3] = 0x10 | (n & 0x0f)  # payload only, continuity counter
+    data[4:10] = b'\x00\x00\x01\xe0\x00\x00'  # PES header: video stream, unbounded length
+    return bytes(data)
+
+
+class _Content:
+    def __init__(self, options: ServerOptions):
+        self.options = options
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def segment_size(self, variant):
+        if self.options.segment_size > 0:
+            return self.options.segment_size
+        return int(self.options.variants[variant] * self.options.segment_duration / 8)
+
+    def segment(self, variant, index) -> typing.Tuple[bytes, str]:
+        key = (variant, index)
+        with self._lock:
+            if key not in self._segments:
+                data = make_segment(variant, index, self.segment_size(variant))
+                if self.options.encrypt:
+                    data = encrypt_segment(data, index)
+                self._segments[key] = (data, s3_etag(data, self.options.etag_chunksize))
+            return self._segments[key]
+
+    def master(self) -> bytes:
+        lines = ['#EXTM3U']
+        for n, bandwidth in enumerate(self.options.variants):
+            height = 360 * (n + 1)
+            lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},AVERAGE-BANDWIDTH={bandwidth},'
+                         f'RESOLUTION={height * 16 // 9}x{height}')
+            lines.append(f'v{n}/index.m3u8')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def variant(self, variant) -> bytes:
+        duration = self.options.segment_duration
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{int(duration + 0.999)}',
+                 '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+        if self.options.encrypt:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="../key.bin"')
+        for i in range(self.options.segment_count):
+            lines.append(f'#EXTINF:{duration:.3f},')
+            lines.append(f'seg_{i:05d}.ts')
+        lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so per connection throughput decay is meaningful
+    server: 'StandinServer'
+
+    def setup(self):
+        super().setup()
+        self.connection_bytes = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def _handle(self, send_body):
+        stats = self.server.stats
+        with self.server.stats_lock:
+            stats['requests'] += 1
+        options = self.server.options
+        content = self.server.content
+        path = self.path.split('?', maxsplit=1)[0]
+        if path == '/__stats':
+            with self.server.stats_lock:
+                body = json.dumps(stats).encode('utf-8')
+            return self._send_simple(200, body, 'application/json', send_body)
+        if path == '/key.bin':
+            return self._send_simple(200, KEY, 'application/octet-stream', send_body)
+        if path == '/master.m3u8':
+            return self._send_simple(200, content.master(), 'application/vnd.apple.mpegurl', send_body)
+        m = re.match(r'^/v(\d+)/index\.m3u8$', path)
+        if m is not None and int(m.group(1)) < len(options.variants):
+            return self._send_simple(200, content.variant(int(m.group(1))), 'application/vnd.apple.mpegurl',
+                                     send_body)
+        m = re.match(r'^/v(\d+)/seg_(\d+)\.ts$', path)
+        if m is not None and int(m.group(1)) < len(options.variants) and int(m.group(2)) < options.segment_count:
+            data, etag = content.segment(int(m.group(1)), int(m.group(2)))
+            return self._send_segment(data, etag, send_body)
+        return self._send_simple(404, b'not found', 'text/plain', send_body)
+
+    def _send_simple(self, code, body, content_type, send_body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _parse_range(self, size) -> typing.Optional[typing.Tuple[int, int]]:
+        m = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m is None:
+            return None
+        start = int(m.group(1))
+        end = int(m.group(2)) + 1 if m.group(2) else size
+        return start, min(end, size)
+
+    def _send_segment(self, data, etag, send_body):
+        options = self.server.options
+        if options.latency > 0:
+            time.sleep(options.latency)
+        fault = self.server.pick_fault() if send_body else None
+        if fault == '5xx':
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if fault == 'ignore_range' or not options.accept_ranges:
+            byte_range = None
+        else:
+            byte_range = self._parse_range(len(data))
+        if byte_range is not None:
+            start, end = byte_range
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(data)}')
+        else:
+            start, end = 0, len(data)
+            self.send_response(200)
+        body = memoryview(data)[start:end]
+        if fault == 'bad_length':
+            body = body[:len(body) // 2]
+        elif fault == 'corrupt':
+            corrupted = bytearray(body)
+            for n in range(0, len(corrupted), 4096):
+                corrupted[n] ^= 0xff
+            body = memoryview(corrupted)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(len(body)))
+        if options.etag:
+            self.send_header('ETag', etag)
+        if options.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not send_body:
+            return
+        if fault in ('reset', 'stall', 'short'):
+            self._write_throttled(body[:len(body) // 2])
+            self.wfile.flush()
+            if fault == 'stall':
+                time.sleep(options.stall_time)
+            elif fault == 'reset':
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+            self.connection.close()
+            return
+        self._write_throttled(body)
+
+    def _write_throttled(self, body: memoryview):
+        options = self.server.options
+        t0 = time.monotonic()
+        sent = 0
+        for offset in range(0, len(body), options.block_size):
+            block = body[offset:offset + options.block_size]
+            self.wfile.write(block)
+            sent += len(block)
+            self.connection_bytes += len(block)
+            with self.server.stats_lock:
+                self.server.stats['bytes_sent'] += len(block)
+            if options.bandwidth > 0:
+                rate = options.bandwidth / (1 + options.decay * self.connection_bytes / (1024 * 1024))
+                # sleep so that average rate of this response <= current rate
+                delay = t0 + sent / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class StandinServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options: ServerOptions = None, host='127.0.0.1', port=0):
+        self.options = options or ServerOptions()
+        unknown = set(self.options.faults) - set(FAULTS)
+        if unknown:
+            raise ValueError(f'Unknown faults {sorted(unknown)}')
+        self.content = _Content(self.options)
+        self.stats = {'requests': 0, 'bytes_sent': 0, 'faults': {}}
+        self.stats_lock = threading.Lock()
+        self._random = random.Random(self.options.fault_seed)
+        self._burst_until = 0.0
+        self._thread = None
+        super().__init__((host, port), _Handler)
+
+    def pick_fault(self) -> typing.Optional[str]:
+        with self.stats_lock:
+            now = time.monotonic()
+            if now < self._burst_until:
+                fault = '5xx'
+            elif self.options.faults and self._random.random() < self.options.fault_rate:
+                fault = self._random.choice(self.options.faults)
+                if fault == '5xx':
+                    self._burst_until = now + self.options.burst_time
+            else:
+                return None
+            self.stats['faults'][fault] = self.stats['faults'].get(fault, 0) + 1
+            return fault
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='Standin server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _serve_in_process(options_dict, conn):
+    server = StandinServer(ServerOptions(**options_dict))
+    conn.send(server.url)
+    server.start()
+    conn.recv()  # wait for stop
+    server.stop()
+
+
+class ServerProcess:
+    """
+    Run the server in a child process, so it does not skew CPU / RSS of the downloader being measured.
+    Usage: with ServerProcess(options) as url: ...
+    """
+
+    def __init__(self, options: ServerOptions = None):
+        self.options = options or ServerOptions()
+        self._process = None
+        self._conn = None
+
+    def __enter__(self) -> str:
+        import multiprocessing
+        parent, child = multiprocessing.Pipe()
+        self._conn = parent
+        self._process = multiprocessing.Process(
+            target=_serve_in_process, args=(asdict(self.options), child), daemon=True)
+        self._process.start()
+        return parent.recv()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._conn.send(None)
+        self._process.join(10)
+
+
+def encrypt_segment(data, index) -> bytes:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(KEY), modes.CBC(index.to_bytes(16, 'big'))).encryptor()
+    return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+
+def expected_segment(options: ServerOptions, variant, index) -> bytes:
+    # un-faulted content, for checking downloaded files (encrypted if options.encrypt)
+    return _Content(options).segment(variant, index)[0]
+
+
+def clear_segment(options: ServerOptions, variant, index) -> bytes:
+    # content before encryption
+    return _Content(replace(options, encrypt=False)).segment(variant, index)[0]
+
+
+def get_stats(url) -> dict:
+    import urllib.request
+    with urllib.request.urlopen(url + '/__stats') as r:
+        return json.load(r)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Local HLS / CDN stand-in server')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--segments', type=int, default=ServerOptions.segment_count)
+    parser.add_argument('--segment-size', type=int, default=ServerOptions.segment_size)
+    parser.add_argument('--latency', type=float, default=ServerOptions.latency)
+    parser.add_argument('--bandwidth', type=int, default=ServerOptions.bandwidth)
+    parser.add_argument('--decay', type=float, default=ServerOptions.decay)
+    parser.add_argument('--faults', default='', help=f'comma separated, from {",".join(FAULTS)}')
+    parser.add_argument('--fault-rate', type=float, default=ServerOptions.fault_rate)
+    parser.add_argument('--encrypt', action='store_true', help='AES-128 encrypted segments')
+    parser.add_argument('--no-etag', action='store_true', help='do not send ETag header')
+    args = parser.parse_args()
+    _server = StandinServer(ServerOptions(
+        segment_count=args.segments, segment_size=args.segment_size,
+        latency=args.latency, bandwidth=args.bandwidth, decay=args.decay,
+        faults=[x for x in args.faults.split(',') if x], fault_rate=args.fault_rate,
+        encrypt=args.encrypt, etag=not args.no_etag,
+    ), port=args.port)
+    print(f'Serving on {_server.url}/master.m3u8')
+    try:
+        _server.serve_forever()
+    except KeyboardInterrupt:
+        pass
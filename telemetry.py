@@ -0,0 +1,161 @@
+import http.server
+import json
+import math
+import socketserver
+import threading
+import time
+import typing
+import urllib.parse
+
+# prometheus style cumulative buckets
+TIME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = tuple(2 ** n * 1024 for n in range(4, 18))  # 16KiB/s ... 128MiB/s
+
+# event kind -> {field: (metric name, buckets)}
+HISTOGRAMS = {
+    'attempt': {
+        'ttfb': ('cookpad_dl_ttfb_seconds', TIME_BUCKETS),
+        'duration': ('cookpad_dl_attempt_seconds', TIME_BUCKETS),
+        'rate': ('cookpad_dl_attempt_bytes_per_second', RATE_BUCKETS),
+    },
+    'validate': {
+        'duration': ('cookpad_dl_validation_seconds', TIME_BUCKETS),
+    },
+    'task': {
+        'duration': ('cookpad_dl_segment_seconds', TIME_BUCKETS),
+        'rate': ('cookpad_dl_segment_bytes_per_second', RATE_BUCKETS),
+    },
+}
+# event kind -> (counter name, label fields, value field or None to count events)
+COUNTERS = {
+    'attempt': [
+        ('cookpad_dl_attempts_total', ('host', 'result'), None),
+        ('cookpad_dl_bytes_total', ('host',), 'bytes'),
+    ],
+    'validate': [
+        ('cookpad_dl_validations_total', ('host', 'valid'), None),
+    ],
+    'task': [
+        ('cookpad_dl_tasks_total', ('host', 'success'), None),
+        ('cookpad_dl_retries_total', ('host',), 'retries'),
+        ('cookpad_dl_min_rate_reconnects_total', ('host',), 'reconnects'),
+    ],
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for n, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[n] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(d):
+    if not d:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in d) + '}'
+
+
+class Telemetry:
+    """
+    Collect download events, write them to a JSON lines log and aggregate them into
+    histograms / counters, optionally served as prometheus text on localhost.
+    """
+
+    def __init__(self, log_path='', port=0):
+        self._lock = threading.Lock()
+        self._log = open(log_path, 'a', encoding='utf-8') if log_path else None
+        self._histograms: typing.Dict[typing.Tuple[str, tuple], Histogram] = {}
+        self._counters: typing.Dict[typing.Tuple[str, tuple], float] = {}
+        self._server = None
+        if port:
+            self.serve(port)
+
+    @staticmethod
+    def host_of(url):
+        return urllib.parse.urlsplit(url).netloc
+
+    def event(self, kind, **fields):
+        fields['event'] = kind
+        fields['ts'] = time.time()
+        with self._lock:
+            if self._log is not None:
+                self._log.write(json.dumps(fields, ensure_ascii=False) + '\n')
+            host = (('host', fields.get('host', '')),)
+            for field_name, (metric, buckets) in HISTOGRAMS.get(kind, {}).items():
+                value = fields.get(field_name)
+                if value is None or not math.isfinite(value):
+                    continue
+                key = (metric, host)
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(buckets)
+                self._histograms[key].observe(value)
+            for metric, label_fields, value_field in COUNTERS.get(kind, []):
+                value = 1 if value_field is None else fields.get(value_field, 0)
+                if not value:
+                    continue
+                key = (metric, tuple((k, str(fields.get(k, ''))) for k in label_fields))
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            for (metric, labels), hist in sorted(self._histograms.items()):
+                cumulative = 0
+                for upper, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{_labels(labels + (("le", upper),))} {cumulative}')
+                lines.append(f'{metric}_sum{_labels(labels)} {hist.sum}')
+                lines.append(f'{metric}_count{_labels(labels)} {hist.count}')
+            for (metric, labels), value in sorted(self._counters.items()):
+                lines.append(f'{metric}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        telemetry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = telemetry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(('127.0.0.1', port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='Telemetry server', daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+
+def get_telemetry(options) -> typing.Optional[Telemetry]:
+    if not options.telemetry_log and not options.telemetry_port:
+        return None
+    return Telemetry(options.telemetry_log, options.telemetry_port)
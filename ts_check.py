@@ -0,0 +1,201 @@
+"""
+Structural check of MPEG-TS segments, for servers that send no ETag (nothing to compare the content with).
+
+Catches truncated / garbage / spliced downloads before they reach ffmpeg:
+  sync byte 0x47 at every 188 byte packet, no transport error flag, valid adaptation field lengths,
+  continuity counter per PID, PES start code where a PES stream starts a unit, PCR per PID moving forward.
+Checks run on whole columns of the packet array with numpy (no per-packet Python loop), the file is mmap'd.
+Without numpy only packet size and sync bytes are checked (strided memoryview).
+"""
+import io
+import mmap
+import os
+import typing
+
+try:
+    import numpy
+except ModuleNotFoundError:
+    numpy = None
+
+from s3_etag import check_etag
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+NULL_PID = 0x1fff
+PCR_WRAP = (1 << 33) * 300  # 27 MHz ticks
+MAX_PCR_GAP = 10 * 27_000_000  # larger forward step (or any step back) is not one continuous stream
+
+
+def _first(mask) -> typing.Optional[int]:
+    n = numpy.flatnonzero(mask)
+    return int(n[0]) if len(n) else None
+
+
+def _check_sync(buf) -> str:
+    with memoryview(buf) as mv, mv.cast('B') as b, b[::TS_PACKET_SIZE] as syncs:
+        data = syncs.tobytes()
+    if data.count(SYNC_BYTE) != len(data):
+        return f'no sync byte at packet {next(n for n, x in enumerate(data) if x != SYNC_BYTE)}'
+    return ''
+
+
+def _step_errors(pid, rows, ok_step):
+    # rows: packet numbers, in stream order; return packet numbers where ok_step(previous, this) fails for same PID
+    order = rows[numpy.argsort(pid[rows], kind='stable')]
+    same = pid[order[1:]] == pid[order[:-1]]
+    return order[1:][same & ~ok_step(order[:-1], order[1:])]
+
+
+def check_buffer(buf) -> str:
+    """Return '' if buf is a plausible MPEG-TS stream, else what is wrong."""
+    size = len(buf)
+    if size == 0:
+        return 'empty'
+    if size % TS_PACKET_SIZE != 0:
+        return f'{size} bytes is not a whole number of packets'
+    if numpy is None:
+        return _check_sync(buf)
+
+    a = numpy.frombuffer(buf, numpy.uint8).reshape(-1, TS_PACKET_SIZE)
+    n = _first(a[:, 0] != SYNC_BYTE)
+    if n is not None:
+        return f'no sync byte at packet {n}'
+    b1, b3, af_len = a[:, 1], a[:, 3], a[:, 4].astype(numpy.int32)
+    n = _first(b1 & 0x80)
+    if n is not None:
+        return f'transport error flag at packet {n}'
+    pid = ((b1 & 0x1f).astype(numpy.int32) << 8) | a[:, 2]
+    afc = b3 >> 4 & 3
+    cc = b3 & 0x0f
+    has_af = (afc & 2) != 0
+    has_payload = (afc & 1) != 0
+    n = _first((afc == 0) | ((afc == 2) & (af_len != 183)) | ((afc == 3) & (af_len > 182)))
+    if n is not None:
+        return f'bad adaptation field at packet {n}'
+    flags = numpy.where(has_af & (af_len > 0), a[:, 5], 0)
+    discontinuity = (flags & 0x80) != 0
+
+    # continuity counter: +1 per payload packet of a PID (0 = duplicate packet), unless discontinuity flag
+    rows = numpy.flatnonzero(has_payload & (pid != NULL_PID))
+    bad = _step_errors(pid, rows, lambda prev, this: (((cc[this] - cc[prev]) & 0x0f) <= 1) | discontinuity[this])
+    if len(bad):
+        return f'continuity counter error at packet {bad.min()} (PID {pid[bad.min()]:#x})'
+
+    # PES: once a PID started a unit with 00 00 01, all of its unit starts must
+    start = 4 + numpy.where(has_af, af_len + 1, 0)
+    pusi = (b1 & 0x40 != 0) & has_payload
+    rows = numpy.flatnonzero(pusi & (start <= TS_PACKET_SIZE - 6))
+    if len(rows):
+        head = a[rows[:, None], start[rows, None] + numpy.arange(6)].astype(numpy.int64)
+        is_pes = (head[:, 0] == 0) & (head[:, 1] == 0) & (head[:, 2] == 1)
+        pes_pids = numpy.unique(pid[rows[is_pes]])
+        bad = rows[numpy.isin(pid[rows], pes_pids) & ~(is_pes & (head[:, 3] >= 0xbc))]
+        if len(bad):
+            return f'bad PES header at packet {bad[0]} (PID {pid[bad[0]]:#x})'
+
+        # PES_packet_length (0 = unbounded) must match the payload up to the next unit start of the PID,
+        # the last unit of a PID may continue in the next segment
+        pes_length = numpy.zeros(len(a), numpy.int64)
+        pes_length[rows] = head[:, 4] << 8 | head[:, 5]
+        packets = numpy.flatnonzero(numpy.isin(pid, pes_pids) & has_payload)
+        packets = packets[numpy.argsort(pid[packets], kind='stable')]
+        # a unit begins at every unit start and at every PID change, units beginning without a unit start are
+        # the rest of a PES from the previous segment and not checked
+        new_unit = pusi[packets] | numpy.append(True, pid[packets[1:]] != pid[packets[:-1]])
+        unit = numpy.cumsum(new_unit) - 1
+        unit_bytes = numpy.bincount(unit, TS_PACKET_SIZE - start[packets])[pusi[packets[new_unit]]]
+        starts = packets[pusi[packets]]
+        last = numpy.append(pid[starts[1:]] != pid[starts[:-1]], True)
+        expected = pes_length[starts] + 6
+        bad = starts[(pes_length[starts] > 0) & ((unit_bytes > expected) | ((unit_bytes < expected) & ~last))]
+        if len(bad):
+            return f'PES length mismatch at packet {bad.min()} (PID {pid[bad.min()]:#x})'
+
+    # PCR
+    rows = numpy.flatnonzero(has_af & (af_len >= 7) & (flags & 0x10 != 0))
+    if len(rows):
+        p = a[:, 6:12].astype(numpy.int64)
+        ext = (p[:, 4] & 1) << 8 | p[:, 5]
+        n = _first(ext[rows] >= 300)
+        if n is not None:
+            return f'bad PCR at packet {rows[n]}'
+        pcr = numpy.zeros(len(a), numpy.int64)
+        pcr[rows] = ((p[rows, 0] << 25 | p[rows, 1] << 17 | p[rows, 2] << 9 | p[rows, 3] << 1 | p[rows, 4] >> 7)
+                     * 300 + ext[rows])
+        bad = _step_errors(pid, rows, lambda prev, this: ((pcr[this] - pcr[prev]) % PCR_WRAP <= MAX_PCR_GAP)
+                           | discontinuity[this])
+        if len(bad):
+            return f'PCR jump at packet {bad.min()} (PID {pid[bad.min()]:#x})'
+    return ''
+
+
+def check_file(file_or_bytes) -> str:
+    # like s3_etag: buffers directly, files mmap'd (fallback: read())
+    if isinstance(file_or_bytes, (bytes, bytearray, memoryview, mmap.mmap)):
+        return check_buffer(file_or_bytes)
+    if isinstance(file_or_bytes, io.BytesIO):
+        with file_or_bytes.getbuffer() as buf:
+            return check_buffer(buf)
+    try:
+        file_or_bytes.flush()
+        fileno = file_or_bytes.fileno()
+        if os.fstat(fileno).st_size == 0:
+            return 'empty'
+        m = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        file_or_bytes.seek(0)
+        return check_buffer(file_or_bytes.read())
+    with m:
+        return check_buffer(m)
+
+
+def check_header(file_or_bytes, header, multipart_chunksize=10 * 1024 * 1024):
+    # drop-in for s3_etag.check_etag_header: ETag if the server sent one, else structure of the segment
+    etag = header.get('etag', None)
+    if etag is not None:
+        return check_etag(file_or_bytes, etag, multipart_chunksize)
+    return not check_file(file_or_bytes)
+
+
+def _test():
+    import time
+    import standin_server
+
+    data = standin_server.make_segment(0, 0, 188 * 100000)
+    assert check_buffer(data) == '', check_buffer(data)
+    assert check_buffer(data[:-1]).endswith('whole number of packets')
+    broken = bytearray(data)
+    broken[188 * 500] = 0
+    assert check_buffer(broken) == 'no sync byte at packet 500'
+    broken = bytearray(data)
+    broken[188 * 700 + 3] ^= 0x05
+    assert check_buffer(broken).startswith('continuity counter error at packet 70')
+    spliced = data[:188 * 1000] + standin_server.make_segment(0, 1, 188 * 1000)
+    assert check_buffer(spliced) != ''
+    assert check_buffer(b'<html>' + bytes(182)) == 'no sync byte at packet 0'
+    # audio PES of 2 packets
+    pes = bytearray(standin_server.make_segment(1, 0, 188 * 4))
+    for n in range(4):
+        pes[188 * n + 1] = (0x40 if n % 2 == 0 else 0) | 0x01
+        pes[188 * n + 2] = 0x01
+    for n in (0, 2):
+        pes[188 * n + 4:188 * n + 10] = b'\x00\x00\x01\xc0' + (184 * 2 - 6).to_bytes(2, 'big')
+    assert check_buffer(pes) == '', check_buffer(pes)
+    pes[4 + 5] -= 1
+    assert check_buffer(pes).startswith('PES length mismatch at packet 0')
+    # bounded PES on one PID, then the rest of a unit from the previous segment on another PID
+    two = bytearray(standin_server.make_segment(2, 0, 188 * 3))
+    for n, (pid, unit_start, cc) in enumerate([(0x100, True, 0), (0x101, False, 0), (0x101, True, 1)]):
+        two[188 * n + 1:188 * n + 4] = bytes([(0x40 if unit_start else 0) | pid >> 8, pid & 0xff, 0x10 | cc])
+    two[4:10] = b'\x00\x00\x01\xc0' + (184 - 6).to_bytes(2, 'big')
+    two[188 * 2 + 4:188 * 2 + 10] = b'\x00\x00\x01\xe0\x00\x00'
+    assert check_buffer(two) == '', check_buffer(two)
+    t = time.perf_counter()
+    for _ in range(10):
+        check_buffer(data)
+    print(f'{len(data) * 10 / (time.perf_counter() - t) / 1e6:.0f} MB/s')
+    print('check ok')
+
+
+if __name__ == '__main__':
+    _test()
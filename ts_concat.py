@@ -0,0 +1,99 @@
+"""
+Fast path for conversion: stream the downloaded segments, in playlist order, as one MPEG-TS into ffmpeg's stdin,
+instead of letting ffmpeg's HLS demuxer open every segment file (slow with thousands of files on network storage).
+
+Whole segments before the start offset are skipped here, only the rest is left to -ss.
+Not used (plan() returns a reason) for discontinuities, segments still encrypted, or missing / malformed segments,
+conversion then goes through the patched playlist as before.
+"""
+import errno
+import itertools
+import os
+import shutil
+import typing
+
+import m3u8
+
+TS_PACKET_SIZE = 188
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+def check_segment(path) -> bool:
+    # cheap check of the container: whole packets, sync byte at first and last packet
+    try:
+        size = os.path.getsize(path)
+        if size == 0 or size % TS_PACKET_SIZE != 0:
+            return False
+        with open(path, 'rb') as f:
+            first = f.read(1)
+            f.seek(size - TS_PACKET_SIZE)
+            last = f.read(1)
+        return first == last == b'\x47'
+    except OSError:
+        return False
+
+
+def plan(rendition_dir, rendition, start_offset=0) -> typing.Tuple[typing.Optional[typing.List[str]], float, str]:
+    """
+    Return (files, remaining offset, reason):
+      files: full filenames to concatenate, None if the fast path can not be used (reason says why)
+      remaining offset: sec still to skip with -ss
+    """
+    if rendition.get('keys') and not rendition.get('decrypt'):
+        return None, start_offset, 'segments are encrypted'
+    with open(os.path.join(rendition_dir, rendition['playlist_patched']), 'r', encoding='utf-8') as f:
+        playlist = m3u8.loads(f.read())
+    segments = playlist.segments
+    if len(segments) != len(rendition['download_list']):
+        return None, start_offset, 'playlist does not match project'
+    if any(seg.discontinuity for seg in segments[1:]):
+        return None, start_offset, 'playlist has discontinuities'
+    if any(seg.init_section is not None for seg in segments):
+        return None, start_offset, 'fragmented MP4 segments'
+    # skip whole segments before start offset
+    starts = list(itertools.accumulate((seg.duration or 0.0 for seg in segments), initial=0.0))
+    first = 0
+    while first < len(segments) - 1 and starts[first + 1] <= start_offset:
+        first += 1
+    files = []
+    for url, filename, info in rendition['download_list'][first:]:
+        path = os.path.join(rendition_dir, filename)
+        if not check_segment(path):
+            return None, start_offset, f'{filename} is missing or not MPEG-TS'
+        files.append(path)
+    return files, max(0.0, start_offset - starts[first]), ''
+
+
+def _copy(src, out, chunk_size):
+    # whole file into out (binary, unbuffered or flushed), sendfile where the OS supports it
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                sent = os.sendfile(out.fileno(), src.fileno(), offset, min(chunk_size, size - offset))
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+    src.seek(offset)
+    shutil.copyfileobj(src, out, chunk_size)
+
+
+def feed(files, out, chunk_size=COPY_CHUNK):
+    # write files one after another into out (e.g. ffmpeg stdin), closes out; stops if the reader went away
+    try:
+        for path in files:
+            with open(path, 'rb') as src:
+                _copy(src, out, chunk_size)
+            out.flush()
+    except BrokenPipeError:
+        pass  # ffmpeg exited, its return code tells why
+    finally:
+        try:
+            out.close()
+        except BrokenPipeError:
+            pass
@@ -0,0 +1,250 @@
+"""
+Bandwidth probe and automatic variant selection.
+
+A few segments from the middle of each variant playlist are downloaded in parallel (queue_size connections, like the
+real download), giving per-segment latency (time to response headers), per-connection and total throughput,
+and the real bytes per second of media of each variant.
+Download time of a variant = segments * (latency + segment size / connection rate) / queue_size,
+but not faster than all its bytes at the total throughput.
+
+Policies (DownloaderOptions.variant_policy):
+  best      highest bitrate, no probe
+  budget    highest bitrate finishing within time_budget sec (the fastest one if none does)
+  smallest  smallest size with height >= min_height (the highest resolution if none is)
+
+Link measurements are cached per CDN host in probe_cache.json for probe_cache_ttl sec,
+with a fresh cache entry only the variant playlists are fetched, sizes come from the declared bandwidth.
+"""
+import concurrent.futures
+import json
+import os
+import statistics
+import threading
+import time
+import typing
+import urllib.parse
+from dataclasses import dataclass, asdict
+
+import requests
+
+import project as project_
+
+CACHE_FILE = 'probe_cache.json'
+POLICIES = ('best', 'budget', 'smallest')
+
+
+@dataclass
+class LinkProbe:
+    host: str
+    throughput: float  # bytes / sec, all connections together
+    connection_rate: float  # bytes / sec of one connection, after the response headers
+    latency: float  # sec until response headers, median
+    queue_size: int
+    measured: float  # time.time()
+    samples: int = 0
+
+
+@dataclass
+class VariantEstimate:
+    variant_id: int  # 1-based
+    bandwidth: int  # declared, bits / sec
+    width: int
+    height: int
+    segments: int
+    duration: float  # sec of media
+    total_bytes: int
+    seconds: float = 0.0  # estimated download time
+
+
+def _load_cache():
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    temp = CACHE_FILE + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(temp, CACHE_FILE)
+
+
+def cached_link(host, options) -> typing.Optional[LinkProbe]:
+    entry = _load_cache().get(host)
+    if entry is None or time.time() - entry.get('measured', 0) > options.probe_cache_ttl:
+        return None
+    if entry.get('queue_size') != options.queue_size:
+        return None  # throughput depends on connection count
+    try:
+        return LinkProbe(**entry)
+    except TypeError:
+        return None
+
+
+def sample_indexes(count, n) -> typing.List[int]:
+    # n segments spread over the middle, first / last may be short
+    if count <= 2:
+        return list(range(count))[:n]
+    return sorted({1 + (count - 2) * (k + 1) // (n + 1) for k in range(n)})
+
+
+def measure(urls, options) -> typing.List[typing.Optional[typing.Tuple[int, float, float]]]:
+    # download urls with queue_size connections, return (bytes, latency, body time) of each, None on failure
+    local = threading.local()
+    sessions = []
+    headers = {'User-Agent': None}
+    headers.update(options.headers)
+    kwargs = dict(cookies=options.cookies, proxies=options.proxies,
+                  timeout=(options.timeout_connect, options.timeout_read))
+
+    def fetch(url):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            sessions.append(local.session)
+        t0 = time.monotonic()
+        try:
+            with local.session.get(url, headers=headers, stream=True, **kwargs) as r:
+                t1 = time.monotonic()
+                if r.status_code != 200:
+                    return None
+                size = sum(len(chunk) for chunk in r.iter_content(options.chunk_size))
+            return size, t1 - t0, time.monotonic() - t1
+        except requests.exceptions.RequestException:
+            return None
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options.queue_size) as ex:
+            return list(ex.map(fetch, urls))
+    finally:
+        for session in sessions:
+            session.close()
+
+
+def probe(m3u8_obj, options, use_cache=True) -> typing.Tuple[typing.Optional[LinkProbe], typing.List[VariantEstimate]]:
+    """
+    m3u8_obj: master playlist. Return link measurement (None if every sample failed) and estimates of all variants.
+    """
+    estimates = []
+    samples = []  # (estimate index, url, media duration)
+    playlists = []
+    for variant_id, playlist in enumerate(m3u8_obj.playlists, start=1):
+        content, variant = project_.fetch_playlist(playlist.absolute_uri, options)
+        durations = [seg.duration or 0.0 for seg in variant.segments]
+        w, h = playlist.stream_info.resolution or (0, 0)
+        bandwidth = project_.variant_bandwidth(playlist)
+        estimates.append(VariantEstimate(variant_id, bandwidth, w, h, len(durations), sum(durations),
+                                         int(bandwidth * sum(durations) / 8)))
+        playlists.append(variant)
+    host = urllib.parse.urlsplit(playlists[0].segments[0].absolute_uri).netloc if playlists[0].segments else ''
+    link = cached_link(host, options) if use_cache else None
+    if link is None:
+        for n, variant in enumerate(playlists):
+            for i in sample_indexes(len(variant.segments), options.probe_segments):
+                samples.append((n, variant.segments[i].absolute_uri, variant.segments[i].duration or 0.0))
+        t = time.monotonic()
+        results = measure([url for n, url, duration in samples], options)
+        wall = time.monotonic() - t
+        ok = [(sample, result) for sample, result in zip(samples, results) if result is not None]
+        if ok:
+            total = sum(size for sample, (size, latency, body) in ok)
+            link = LinkProbe(
+                host=host,
+                throughput=total / wall if wall > 0 else 0.0,
+                connection_rate=total / max(1e-6, sum(body for sample, (size, latency, body) in ok)),
+                latency=statistics.median(latency for sample, (size, latency, body) in ok),
+                queue_size=options.queue_size,
+                measured=time.time(),
+                samples=len(ok))
+            cache = _load_cache()
+            cache[host] = asdict(link)
+            try:
+                _save_cache(cache)
+            except OSError:
+                pass  # cache is optional
+            # real size of sampled variants, declared bandwidth may be far off
+            for n, est in enumerate(estimates):
+                sampled = [(size, duration) for (m, url, duration), (size, latency, body) in ok if m == n]
+                media = sum(duration for size, duration in sampled)
+                if media > 0:
+                    est.total_bytes = int(sum(size for size, duration in sampled) / media * est.duration)
+    if link is not None:
+        for est in estimates:
+            segment_bytes = est.total_bytes / max(1, est.segments)
+            per_segment = link.latency + segment_bytes / max(1.0, link.connection_rate)
+            est.seconds = max(est.segments * per_segment / max(1, link.queue_size),
+                              est.total_bytes / max(1.0, link.throughput))
+    return link, estimates
+
+
+def choose(estimates: typing.List[VariantEstimate], policy, time_budget=0, min_height=0) -> int:
+    # 1-based variant id by policy, 0 if no variants
+    if not estimates:
+        return 0
+    by_quality = sorted(estimates, key=lambda est: (est.bandwidth, est.height))
+    if policy == 'budget':
+        if time_budget <= 0:
+            return by_quality[-1].variant_id
+        fitting = [est for est in by_quality if est.seconds <= time_budget]
+        return (fitting[-1] if fitting else min(estimates, key=lambda est: est.seconds)).variant_id
+    if policy == 'smallest':
+        allowed = [est for est in estimates if est.height >= min_height]
+        if not allowed:
+            return max(estimates, key=lambda est: (est.height, est.bandwidth)).variant_id
+        return min(allowed, key=lambda est: (est.total_bytes, -est.height)).variant_id
+    return by_quality[-1].variant_id
+
+
+def recommend(m3u8_obj, options) -> typing.Tuple[int, typing.Optional[LinkProbe], typing.List[VariantEstimate]]:
+    # variant id by options.variant_policy, probes only if the policy needs it
+    if options.variant_policy not in POLICIES:
+        raise ValueError(f'Unknown variant_policy {options.variant_policy!r}, should be one of {POLICIES}')
+    if options.variant_policy == 'best':
+        return project_.best_variant(m3u8_obj), None, []
+    link, estimates = probe(m3u8_obj, options)
+    if link is None and options.variant_policy == 'budget':
+        return project_.best_variant(m3u8_obj), None, estimates  # can not tell, same as without probe
+    return choose(estimates, options.variant_policy, options.time_budget, options.min_height), link, estimates
+
+
+def format_seconds(sec):
+    sec = int(sec)
+    return f'{sec // 3600}:{sec // 60 % 60:02d}:{sec % 60:02d}'
+
+
+def describe(link: typing.Optional[LinkProbe], estimates: typing.List[VariantEstimate]) -> typing.List[str]:
+    lines = []
+    if link is not None:
+        lines.append(f'Link to {link.host}: {link.throughput * 8 / 1e6:.1f} Mbit/s with {link.queue_size} connections, '
+                     f'{link.connection_rate * 8 / 1e6:.1f} Mbit/s per connection, latency {link.latency * 1000:.0f} ms')
+    for est in estimates:
+        text = f'{est.variant_id}: {est.width}x{est.height} about {est.total_bytes / 1024 / 1024:.0f}MB'
+        if link is not None:
+            text += f', download {format_seconds(est.seconds)}'
+        lines.append(text)
+    return lines
+
+
+def _test():
+    import download
+    import standin_server
+
+    server = standin_server.StandinServer(standin_server.ServerOptions(
+        variants=[800 * 1024, 2000 * 1024, 6000 * 1024], segment_count=20, segment_duration=2.0,
+        bandwidth=2 * 1024 * 1024, latency=0.05))
+    server.start()
+    try:
+        options = download.DownloaderOptions(queue_size=3, probe_segments=2)
+        content, master = project_.fetch_playlist(server.url + '/master.m3u8', options)
+        link, estimates = probe(master, options, use_cache=False)
+        print('\n'.join(describe(link, estimates)))
+        for budget in (5, 20, 60):
+            print(f'budget {budget}s ->', choose(estimates, 'budget', budget))
+        print('smallest ->', choose(estimates, 'smallest'))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,166 @@
+import concurrent.futures
+import json
+import os
+import typing
+
+import requests
+
+from s3_etag import s3_etag
+
+ETAGS_FILE = 'etags.json'
+
+
+def load_etags(dirname) -> typing.Dict[str, str]:
+    try:
+        with open(os.path.join(dirname, ETAGS_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_etags(dirname, etags):
+    temp = os.path.join(dirname, ETAGS_FILE + '.tmp')
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(etags, f)
+    os.replace(temp, os.path.join(dirname, ETAGS_FILE))
+
+
+def record_etags(dirname, tasks, etags_by_index):
+    # tasks: DownloadQueue tasks (url, filename_full, info), etags_by_index: DownloadQueue.etags
+    etags = load_etags(dirname)
+    for i, etag in etags_by_index.items():
+        if etag is None:
+            continue
+        url, filename, info = tasks[i]
+        etags[os.path.relpath(filename, dirname)] = etag
+    save_etags(dirname, etags)
+
+
+def hash_file(filename, multipart_chunksize) -> typing.Optional[str]:
+    # runs in worker process
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return s3_etag(f, multipart_chunksize)  # mmap'd by s3_etag
+
+
+def fetch_server_etags(urls, options, max_workers=None) -> typing.Dict[str, typing.Optional[str]]:
+    # HEAD every url with bounded concurrency
+    def head(url):
+        headers = {'User-Agent': None}
+        headers.update(options.headers)
+        try:
+            r = requests.head(url, headers=headers, cookies=options.cookies, proxies=options.proxies,
+                              timeout=(options.timeout_connect, options.timeout_read), allow_redirects=True)
+            if r.status_code != 200:
+                return None
+            return r.headers.get('etag', None)
+        except requests.exceptions.RequestException:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or options.queue_size) as ex:
+        return dict(zip(urls, ex.map(head, urls)))
+
+
+def verify_project(dirname, download_list, options, use_server=False, max_workers=None, local_only=()):
+    """
+    Hash every local segment and compare with etags recorded at download time,
+    or etags from the server (for files with no record, or all files if use_server).
+    local_only: filenames changed after download (decrypted segments), server etags do not apply to them,
+      they are only compared with the recorded etag (of the changed file), unchecked if there is none.
+
+    return: (bad, unchecked)
+      bad: list of (url, filename, info, reason), reason is 'missing' / 'empty' / 'mismatch'
+      unchecked: count of files with no etag to compare
+    """
+    recorded = load_etags(dirname)
+    bad = []
+    to_check = []
+    for url, filename, info in download_list:
+        filename_full = os.path.join(dirname, filename)
+        if not os.access(filename_full, os.F_OK):
+            bad.append((url, filename, info, 'missing'))
+        else:
+            to_check.append((url, filename, info))
+
+    expected = {filename: recorded.get(filename) for url, filename, info in to_check}
+    local_only = set(local_only)
+    need_server = [url for url, filename, info in to_check
+                   if filename not in local_only and (use_server or expected[filename] is None)]
+    if need_server:
+        server_etags = fetch_server_etags(need_server, options, max_workers)
+        for url, filename, info in to_check:
+            if filename not in local_only and server_etags.get(url) is not None:
+                expected[filename] = server_etags[url]
+
+    unchecked = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as ex:
+        futures = {}
+        for task in to_check:
+            url, filename, info = task
+            if expected[filename] is None:
+                unchecked += 1
+                continue
+            future = ex.submit(hash_file, os.path.join(dirname, filename), options.validator_chunk_size)
+            futures[future] = task
+        for future in concurrent.futures.as_completed(futures):
+            url, filename, info = futures[future]
+            etag = future.result()
+            if etag is None:
+                bad.append((url, filename, info, 'empty'))
+            elif etag != expected[filename]:
+                bad.append((url, filename, info, 'mismatch'))
+    return bad, unchecked
+
+
+def requeue(dirname, bad):
+    # remove corrupt files (and their records), so next download run fetches them again
+    etags = load_etags(dirname)
+    for url, filename, info, reason in bad:
+        etags.pop(filename, None)
+        if reason != 'missing':
+            try:
+                os.remove(os.path.join(dirname, filename))
+            except FileNotFoundError:
+                pass
+    save_etags(dirname, etags)
+
+
+def _test_decrypted():
+    # segments decrypted on download: server ETags (of encrypted bytes) must not be used for them
+    import tempfile
+    import download
+    import project as project_
+    import standin_server
+
+    server = standin_server.StandinServer(standin_server.ServerOptions(
+        segment_count=5, segment_duration=4.0, segment_size=188 * 100, encrypt=True))
+    server.start()
+    try:
+        options = download.DownloaderOptions(hide_progress_bar=True, no_output=True, decrypt_segments=True)
+        dirname = tempfile.mkdtemp()
+        rendition = project_.resolve_rendition(server.url + '/master.m3u8', 1, options)
+        rendition['stream_id'] = 1
+        project = project_.save_renditions(dirname, [rendition], {'info_json': '?', 'start_offset': 0})
+        tasks = project_.pending_tasks(dirname, project)
+        dq = download.DownloadQueue(tasks, options,
+                                    post_process=project_.segment_post_process(dirname, project, options))
+        dq.run()
+        record_etags(dirname, tasks, dq.etags)
+        download_list = project_.flat_download_list(project)
+        local_only = project_.decrypted_files(project)
+        assert len(local_only) == 5
+        assert verify_project(dirname, download_list, options, True, local_only=local_only) == ([], 0)
+        with open(os.path.join(dirname, download_list[2][1]), 'r+b') as f:
+            f.write(b'\0')
+        bad, unchecked = verify_project(dirname, download_list, options, True, local_only=local_only)
+        assert [(filename, reason) for url, filename, info, reason in bad] == [(download_list[2][1], 'mismatch')]
+        os.remove(os.path.join(dirname, ETAGS_FILE))
+        assert verify_project(dirname, download_list, options, True, local_only=local_only) == ([], 5)
+        print('check ok')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    _test_decrypted()